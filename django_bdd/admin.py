@@ -1,5 +1,179 @@
+"""
+Admin for investigating production data.
+
+The run and step tables get to millions of rows, so the changelists here stay
+away from anything that scans them: counts of the whole table are estimated
+from the planner statistics on PostgreSQL, filters only use indexed columns
+with fixed choices, searches match indexed columns exactly, related objects
+are joined in instead of loaded per row, foreign keys use raw id widgets, and
+inlines show a bounded number of rows.
+"""
+import operator
+
 from django.contrib import admin
-from django_bdd.models import Test, TestRun
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
+from django.db import connections
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.forms.models import BaseInlineFormSet
+from django.utils.html import format_html
+
+from django_bdd.models import SuiteRun, Test, TestEditHistory, TestRun, TestRunStep
+
+# tables with fewer rows than this are counted exactly
+APPROXIMATE_COUNT_THRESHOLD = 100000
+
+# how many rows an inline shows at most
+INLINE_ROWS = 100
+
+
+class ApproximateCountQuerySet(QuerySet):
+    """Estimates the count of a whole table from PostgreSQL's statistics
+    instead of counting every row. Filtered querysets are counted exactly,
+    their filters are meant to use an index.
+    """
+
+    def count(self):
+        if self.query.where or self._result_cache is not None:
+            return super(ApproximateCountQuerySet, self).count()
+
+        connection = connections[self.db]
+        if connection.vendor != u'postgresql':
+            return super(ApproximateCountQuerySet, self).count()
+
+        # a partitioned table has no rows of its own, its partitions do
+        cursor = connection.cursor()
+        cursor.execute(
+            u'SELECT coalesce(sum(greatest(c.reltuples, 0)), 0) FROM pg_class c '
+            u'WHERE c.oid = %s::regclass OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)',
+            [self.model._meta.db_table] * 2
+        )
+        estimate = int(cursor.fetchone()[0])
+        if estimate < APPROXIMATE_COUNT_THRESHOLD:
+            return super(ApproximateCountQuerySet, self).count()
+        return estimate
+
+
+class ApproximateCountAdmin(admin.ModelAdmin):
+    def get_queryset(self, request):
+        return super(ApproximateCountAdmin, self).get_queryset(request)._clone(klass=ApproximateCountQuerySet)
+
+    def get_search_results(self, request, queryset, search_term):
+        """Matches the term exactly when every search field is an = one.
+        Django searches those with iexact, which PostgreSQL compares as
+        upper(column::text) and can't use the column's index for.
+        """
+        search_term = search_term.strip()
+        if not search_term or not all(name.startswith(u'=') for name in self.search_fields):
+            return super(ApproximateCountAdmin, self).get_search_results(request, queryset, search_term)
+
+        lookups = []
+        for name in self.search_fields:
+            field = self.model._meta.get_field(name[1:])
+            # a foreign key is searched by the id it holds
+            target = field.rel.get_related_field() if field.rel else field
+            try:
+                lookups.append(Q(**{name[1:]: target.to_python(search_term)}))
+            except ValidationError:
+                # like a user name searched as a test id
+                pass
+        if not lookups:
+            return queryset.none(), False
+        return queryset.filter(reduce(operator.or_, lookups)), False
+
+
+class BoundedInlineFormSet(BaseInlineFormSet):
+    """Shows the first INLINE_ROWS rows of an inline."""
+
+    def get_queryset(self):
+        if not hasattr(self, u'_bounded_queryset'):
+            # evaluated once, the forms index into it
+            self._bounded_queryset = super(BoundedInlineFormSet, self).get_queryset()[:INLINE_ROWS]
+            len(self._bounded_queryset)
+        return self._bounded_queryset
+
+
+class ReadOnlyInline(admin.TabularInline):
+    formset = BoundedInlineFormSet
+    extra = 0
+    max_num = 0
+    can_delete = False
+
+    def get_readonly_fields(self, request, obj=None):
+        return self.fields
+
+    def has_add_permission(self, request):
+        return False
+
+
+class TestRunStepInline(ReadOnlyInline):
+    model = TestRunStep
+    fields = (u'example_row_num', u'num', u'text', u'status', u'timestamp_start', u'timestamp_end', u'duration', u'screenshot_s3_key')
+    ordering = (u'example_row_num', u'num')
+    verbose_name_plural = u'Test run steps (the first {})'.format(INLINE_ROWS)
+
+
+class TestEditHistoryInline(ReadOnlyInline):
+    model = TestEditHistory
+    fields = (u'version', u'user', u'timestamp', u'steps')
+    ordering = (u'-version',)
+    verbose_name_plural = u'Test edit history (the latest {})'.format(INLINE_ROWS)
+
+
+class TestAdmin(ApproximateCountAdmin):
+    list_display = (u'id', u'name', u'user')
+    search_fields = (u'name', u'=user')
+    inlines = (TestEditHistoryInline,)
+
+
+class TestRunAdmin(ApproximateCountAdmin):
+    list_display = (u'id', u'test', u'user', u'status', u'timestamp', u'duration', u'step_count', u'failed_steps', u'shard_count')
+    list_select_related = (u'test',)
+    list_filter = (u'status', u'timestamp')
+    search_fields = (u'=user', u'=test')
+    raw_id_fields = (u'test', u'parent', u'suite')
+    readonly_fields = (u'result_page', u'step_count', u'passed_steps', u'failed_steps', u'skipped_steps', u'error_steps', u'current_step',
+                       u'last_progress', u'counted_status', u'counted_duration')
+    inlines = (TestRunStepInline,)
+
+    def result_page(self, obj):
+        if not obj.pk:
+            return u''
+        url = reverse(u'bdd-test-run-detail', kwargs={u'test_id': obj.test_id, u'test_run_id': obj.pk})
+        return format_html(u'<a href="{}">all steps and screenshots</a>', url)
+
+
+class TestRunStepAdmin(ApproximateCountAdmin):
+    list_display = (u'id', u'run_link', u'example_row_num', u'num', u'text', u'status', u'duration', u'timestamp_start')
+    list_filter = (u'status',)
+    search_fields = (u'=run',)
+    raw_id_fields = (u'run',)
+
+    def run_link(self, obj):
+        # by id, the run's name would load the run and its test for every row
+        return format_html(u'<a href="{}">{}</a>', reverse(u'admin:django_bdd_testrun_change', args=(obj.run_id,)), obj.run_id)
+    run_link.short_description = u'Run'
+
+
+class TestEditHistoryAdmin(ApproximateCountAdmin):
+    list_display = (u'id', u'test', u'version', u'user', u'timestamp')
+    list_select_related = (u'test',)
+    list_filter = (u'timestamp',)
+    search_fields = (u'=user', u'=test')
+    raw_id_fields = (u'test',)
+
+
+class SuiteRunAdmin(admin.ModelAdmin):
+    list_display = (u'id', u'name', u'user', u'status', u'timestamp', u'run_count', u'finished_runs', u'failed_runs', u'error_runs')
+    list_filter = (u'status', u'timestamp')
+    search_fields = (u'=user', u'name')
+    readonly_fields = (u'run_count', u'finished_runs', u'passed_runs', u'failed_runs', u'skipped_runs', u'error_runs', u'cancelled_runs',
+                       u'duration', u'timestamp_end')
+
 
-admin.site.register(Test)
-admin.site.register(TestRun)
+admin.site.register(Test, TestAdmin)
+admin.site.register(TestRun, TestRunAdmin)
+admin.site.register(TestRunStep, TestRunStepAdmin)
+admin.site.register(TestEditHistory, TestEditHistoryAdmin)
+admin.site.register(SuiteRun, SuiteRunAdmin)
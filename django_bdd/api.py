@@ -0,0 +1,817 @@
+"""
+The rest api, and the views the engine and scripts call.
+
+Nothing in here needs the ui's dependencies (django_tables2, tinymce,
+django_ajax), so processes that only serve the api can route to
+django_bdd.api_urls and never import django_bdd.views. Behave is only loaded,
+through the step catalog, the first time a test's steps are validated.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified, Http404, StreamingHttpResponse
+
+from rest_framework import viewsets
+from rest_framework.decorators import action, api_view, link
+from rest_framework.response import Response
+
+from django_bdd import events, examples, exports, features, metrics, partitions, serialization, steps
+from django_bdd.caching import get_cached_payload, get_cache_seconds, get_run_history_validators,\
+    get_run_validators, is_cacheable, not_modified, set_validators
+from django_bdd.comparison import compare_runs, get_comparison_etag, is_comparison_cacheable
+from django_bdd.models import StepStatsRefresh, SuiteRun, Test, TestRun, TestRunStep, QUEUED_STATUSES
+from django_bdd.runs import cancel_runs, create_run, get_run_steps, select_runs
+from django_bdd.screenshots import get_screenshot_storage
+from django_bdd.serializers import SuiteRunSerializer, TestSerializer, TestRunSerializer,\
+    TestRunStepSerializer
+from django_bdd.steps import VARIABLE_RE
+from django_bdd.suites import start_suite
+from django_bdd.tags import add_tags, remove_tags, rename_tag, select_tests
+
+# Check out this URL for more info on potential method overrides:
+# http://www.django-rest-framework.org/api-guide/viewsets
+
+# how many of the latest suites are listed
+SUITE_LIST_SIZE = 50
+
+log = logging.getLogger(u'django-bdd')
+
+
+def get_user(request):
+    """given a web request, attempts to pull 'REMOTE_USER' out of the request
+    :return: the user. defaults to 'nobody'
+    """
+    user = request.environ.get(u'REMOTE_USER', u'nobody')
+    if user == u'nobody':
+        log.error(u'user not detected through REMOTE_USER environment variable')
+    return user
+
+
+def is_true(value):
+    """Reads a boolean flag out of request data, where it may be a string."""
+    return unicode(value).lower() in (u'1', u'true', u'yes', u'on')
+
+
+def get_list(data, key, separator=u','):
+    """Reads a list out of request data, where it may be a json list, a
+    repeated form field or a string of separated values.
+    :rtype: list(unicode)
+    """
+    if hasattr(data, u'getlist'):
+        values = data.getlist(key)
+    else:
+        values = data.get(key) or []
+        if not isinstance(values, list):
+            values = [values]
+    return [part.strip() for value in values for part in unicode(value).split(separator) if part.strip()]
+
+
+def filter_tags(test_queryset, tags):
+    """
+    @param test_queryset: a Test object query set
+    @type test_queryset: QuerySet
+    @param tags: list of tags
+    @type tags: list
+    """
+    # every filter call on a multi-valued relation joins the tags again, so
+    # chaining them keeps only the tests that have every tag
+    for tag in set(tags):
+        test_queryset = test_queryset.filter(tags__name=tag)
+    return test_queryset
+
+
+class JSONResponse(HttpResponse):
+    """
+    An HttpResponse that renders its content into JSON.
+    """
+    def __init__(self, data, **kwargs):
+        content = serialization.render(data)
+        kwargs[u'content_type'] = u'application/json'
+        super(JSONResponse, self).__init__(content, **kwargs)
+
+
+def get_step_variables(steps):
+    """
+    extracts any <xyz> style text from a bdd scenario. these are the variables
+    for a scenario outline.
+
+    @param steps: bdd scenario outline steps text
+    @type steps: unicode
+    @return: the parsed out set of variable names
+    @rtype: set(basestring)
+    """
+    return set(VARIABLE_RE.findall(steps))
+
+
+def form_examples(request, step_variables):
+    """
+    extract the examples from the request data, if possible
+
+    @param request: http request object
+    @type request rest_framework.request.Request
+    @param step_variables: set of variable names from the bdd test
+    @type step_variables: set(basestring)
+    @return: none if no examples or failed, or formed examples and an error msg,
+        if applicable
+    @rtype: (basestring, basestring)
+    """
+    if u'examples' not in request.DATA:
+        return None, None
+
+    examples = request.DATA[u'examples']
+    log.debug(u'request has examples:\n{}'.format(examples))
+
+    # examples should be an array of json objects, each object being an
+    # example row
+    if not isinstance(examples, list):
+        return None, u'examples payload was not an array'
+    if not examples:
+        return None, u'examples array was empty'
+
+    # form the actual gherkin example text (sans "Examples:", engine adds it)
+    text = [u'|' + u'|'.join(step_variables) + u'|']
+    for ex in examples:
+        # verify the example obj has all the expected headers/fields
+        ex_field_diffs = step_variables.difference(ex.keys())
+        if ex_field_diffs:
+            return None, u'an example object was missing some fields: {} given: {}'.format(ex_field_diffs, ex)
+
+        vals = [unicode(ex[key]) for key in step_variables]
+        text.append(u'|' + u'|'.join(vals) + u'|')
+    text = u'\n'.join(text)
+
+    log.debug(u'resulting example text\n{}'.format(text))
+    return text, None
+
+
+def undefined_steps_response(undefined):
+    """Returns the error response for a test with undefined steps."""
+    return JSONResponse({
+        u'error': u'the test has steps no step definition matches',
+        u'undefined_steps': undefined,
+        u'messages': steps.describe_undefined_steps(undefined),
+    }, status=400)
+
+
+class GZipMixin(object):
+    """Gzips the big responses of a viewset for clients that accept gzip."""
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(GZipMixin, self).finalize_response(request, response, *args, **kwargs)
+        # responses the rest framework renders later, like the browsable api, are left alone
+        if getattr(response, u'is_rendered', True):
+            response = serialization.gzip_response(request, response)
+        return response
+
+
+class TestViewSet(viewsets.ModelViewSet):
+    queryset = Test.objects.all()
+    serializer_class = TestSerializer
+
+    def update(self, request, pk=None):
+        """
+        Update the specified test.
+
+        Base code from https://github.com/tomchristie/django-rest-framework/blob/master/rest_framework/mixins.py
+        """
+        log.debug(u'updating test {} via api'.format(pk))
+
+        test = self.get_object_or_none()
+        if test is None:
+            return JSONResponse({u'error': u'no test found with id {}'.format(pk)})
+
+        try:
+            test_serializer = TestSerializer(test, data=request.DATA)
+            if test_serializer.is_valid():
+                undefined = steps.validate_steps(test_serializer.object.steps)
+                if steps.is_rejected(undefined):
+                    return undefined_steps_response(undefined)
+
+                # save the test
+                test_serializer.save()
+
+                # log an entry in the test edit history
+                # pull the user out of the data
+                user = test_serializer.data[u'user']
+                log.debug(u'user {} is updating test {} via api'.format(user, pk))
+
+                log.debug(u'querying test edit history')
+                test = Test.objects.get(pk=pk)
+                version = test.testedithistory_set.count() + 1
+
+                log.debug(u'saving test {} history version {}'.format(pk, version))
+                history_entry = test.testedithistory_set.create(user=user, version=version, steps=test.steps)
+                log.debug(u'created test {} history entry {}'.format(pk, history_entry.id))
+
+                return JSONResponse({u'undefined_steps': undefined} if undefined else {}, status=200)
+            else:
+                return JSONResponse(test_serializer.errors, status=400)
+        except Exception as e:
+            log.error(u'exception when calling delete: {}'.format(unicode(e)))
+
+        return JSONResponse({}, status=400)
+
+    def destroy(self, requset, pk=None):
+        """Delete the specified test."""
+        try:
+            log.debug(u'retrieving test {} to delete it'.format(pk))
+            test = Test.objects.get(pk=pk)
+
+            log.debug(u'deleting test {}'.format(pk))
+            test.delete()
+            log.debug(u'test {} deleted, returning success'.format(pk))
+
+            return JSONResponse({}, status=200)
+        except Exception as e:
+            log.error(u'exception when calling delete: {}'.format(unicode(e)))
+
+        return JSONResponse({}, status=400)
+
+    @action()
+    def start(self, request, pk=None):
+        """
+        creates a test run to be picked up by the engine.
+
+        also does extra stuff to allow specifying example rows through the run
+        api.
+
+        @param request: the http request
+        @type request: rest_framework.request.Request
+        @param pk: primary key to use to get data
+        @return: json response
+        """
+        log.info(u'starting test run with test {}'.format(pk))
+
+        # get the test
+        test = self.get_object_or_none()
+        if not test:
+            log.error(u'self.get_object() returned None, no test object to start a run with')
+            return JSONResponse({u'error': u'unknown test id: {}'.format(pk)}, status=400)
+
+        step_variables = get_step_variables(test.steps)
+
+        # pull the user out of the request data
+        user = request.DATA.get(u'user', None)
+        if user is None:
+            log.error(u'no user specified, returning error')
+            return JSONResponse({u'error': u'user not specified'}, status=400)
+
+        # big example tables can be uploaded as a csv or json lines file instead
+        dataset = request.FILES.get(u'examples_file', None)
+        if dataset is not None:
+            return self.start_with_dataset(request, test, user, step_variables, dataset)
+
+        # this enables running example-less outlines through the api
+        example, error_msg = form_examples(request, step_variables)
+        if not example:
+            # set up blank text to create the test run with
+            example = u''
+
+        if error_msg:
+            log.error(error_msg)
+            return JSONResponse({u'error': error_msg}, status=400)
+
+        # ensure that if this run is an example-less outline, that we have
+        # example text
+        if step_variables and not example and not u'Examples:' in test.steps:
+            error_msg = u'a test run for a scenario outline was requested without ' \
+                        u'an example being provided in the request body or the step text'
+            log.error(error_msg)
+            return JSONResponse({u'error': error_msg}, status=400)
+
+        # optionally split the example rows over several runs the engine can
+        # pick up independently
+        try:
+            shards = int(request.DATA.get(u'shards', 1))
+        except (TypeError, ValueError):
+            return JSONResponse({u'error': u'shards must be a number'}, status=400)
+
+        # undefined steps are caught before the run takes up a queue slot
+        undefined = steps.validate_steps(test.steps, example)
+        if steps.is_rejected(undefined):
+            return undefined_steps_response(undefined)
+
+        # create a test run for the engine package to pick up and run
+        # the status being "NEW" will trigger the engine to pick it up
+        # an identical run that's still queued gets reused unless forced
+        log.debug(u'creating test run')
+
+        force = is_true(request.DATA.get(u'force', False))
+        test_run, coalesced = create_run(test, user, example_text=example, shards=shards, force=force)
+
+        log.debug(u'created test run')
+
+        data = TestRunSerializer(test_run).data
+        data[u'coalesced'] = coalesced
+        if undefined:
+            data[u'undefined_steps'] = undefined
+        return JSONResponse(data, status=200)
+
+    def start_with_dataset(self, request, test, user, step_variables, dataset):
+        """Creates a test run with the example rows of an uploaded dataset.
+        The rows are stored in chunks as they're read, in the same
+        transaction as the run, so the engine never picks up a run with only
+        some of its rows.
+        """
+        if not step_variables:
+            return JSONResponse({u'error': u'example rows were uploaded for a test that is not a scenario outline'}, status=400)
+        if unicode(request.DATA.get(u'shards', 1)) != u'1':
+            return JSONResponse({u'error': u'runs with an uploaded dataset can not be sharded'}, status=400)
+
+        # the steps without variables, the rows aren't read yet
+        undefined = steps.validate_steps(test.steps)
+        if steps.is_rejected(undefined):
+            return undefined_steps_response(undefined)
+
+        dataset_format = request.DATA.get(u'examples_format', None) or examples.guess_format(dataset.name)
+        if dataset_format not in examples.DATASET_FORMATS:
+            return JSONResponse({u'error': u'examples_format must be one of {}'.format(u', '.join(examples.DATASET_FORMATS))}, status=400)
+
+        try:
+            with transaction.atomic():
+                columns, rows = examples.read_dataset(dataset, step_variables, dataset_format)
+                header = u'|' + u'|'.join(columns) + u'|'
+
+                # runs only differ by their dataset, so they're never coalesced
+                test_run, coalesced = create_run(test, user, example_text=header, force=True)
+                test_run.example_row_count = examples.store_rows(test_run, rows)
+                if not test_run.example_row_count:
+                    raise examples.ExampleDatasetError(u'the dataset has no rows')
+                test_run.save(update_fields=[u'example_row_count'])
+        except (examples.ExampleDatasetError, UnicodeDecodeError) as e:
+            log.error(u'unable to read the examples uploaded for test {}: {}'.format(test.id, unicode(e)))
+            return JSONResponse({u'error': unicode(e)}, status=400)
+
+        log.debug(u'created test run {} with {} uploaded example rows'.format(test_run.id, test_run.example_row_count))
+
+        data = TestRunSerializer(test_run).data
+        data[u'coalesced'] = False
+        if undefined:
+            data[u'undefined_steps'] = undefined
+        return JSONResponse(data, status=200)
+
+
+class TestRunViewSet(GZipMixin, viewsets.ModelViewSet):
+    serializer_class = TestRunSerializer
+
+    # if this isn't defined, then a call to the nested router will always
+    # return all the entries in the table
+    # http://www.django-rest-framework.org/api-guide/filtering.html#filtering-against-the-url
+    def get_queryset(self):
+        # in the auto url router, the key is labeled test_pk
+        # bdd/api/tests/123/runs, 123 -> test_pk
+        test_id = self.kwargs[u'test_pk']
+        # descend sort the runs, so we can get the latest run id
+        # shards are left out, their parent run stands in for them
+        queryset = TestRun.objects.filter(test=test_id, parent__isnull=True).order_by(u'-id')
+        if u'pk' in self.kwargs:
+            queryset = partitions.prune_runs(queryset, self.kwargs[u'pk'])
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        """Returns the runs of a test, or a 304 if none of them changed since
+        the client last asked.
+        """
+        etag, last_modified = get_run_history_validators(self.kwargs[u'test_pk'], request.get_full_path())
+        if not_modified(request, etag, last_modified):
+            return HttpResponseNotModified()
+
+        if serialization.is_enabled() and request.accepted_renderer.format == u'json':
+            response = self.fast_list(request)
+        else:
+            response = super(TestRunViewSet, self).list(request, *args, **kwargs)
+        return set_validators(response, etag, last_modified)
+
+    def fast_list(self, request):
+        """Lists the runs from values_list() rows instead of the serializer,
+        for clients that asked for json.
+        """
+        rows = self.filter_queryset(self.get_queryset()).values_list(*serialization.RUN_FIELDS)
+        page = self.paginate_queryset(rows)
+        if page is None:
+            data = serialization.serialize_runs(rows)
+        else:
+            data = serialization.paginated(request, page, serialization.serialize_runs(page.object_list))
+        return serialization.json_response(serialization.render(data))
+
+    def retrieve(self, request, *args, **kwargs):
+        """Returns a run. Finished runs don't change, so their responses are
+        cached and the client gets a 304 if it already has the run.
+        """
+        run = self.get_object()
+        if not is_cacheable(run):
+            return Response(self.get_serializer(run).data)
+
+        etag, last_modified = get_run_validators(run, u'run')
+        if not_modified(request, etag, last_modified):
+            return HttpResponseNotModified()
+
+        data = get_cached_payload(etag, u'run', lambda: self.get_serializer(run).data)
+        return set_validators(Response(data), etag, last_modified, max_age=get_cache_seconds())
+
+    @action()
+    def cancel(self, request, pk=None, **kwargs):
+        """Cancels the run if it's queued or running. Returns the ids of the
+        runs cancelled, a sharded run's shards included.
+        """
+        run = self.get_object()
+        if run.status not in QUEUED_STATUSES:
+            return JSONResponse({u'error': u'run {} is already {}'.format(run.id, run.status)}, status=400)
+        return JSONResponse({u'cancelled': cancel_runs(TestRun.objects.filter(id=run.id), get_user(request))}, status=200)
+
+    @link()
+    def examples(self, request, pk=None, **kwargs):
+        """Returns a range of the example rows uploaded for the run. Query
+        parameters:
+            start - the first row number, starting at 1 (default 1)
+            count - how many rows, at most BDD_EXAMPLE_FETCH_LIMIT (the default)
+        """
+        run = self.get_object()
+        limit = examples.get_fetch_limit()
+        try:
+            start = max(int(request.QUERY_PARAMS.get(u'start', 1)), 1)
+            count = min(int(request.QUERY_PARAMS.get(u'count', limit)), limit)
+        except ValueError:
+            return JSONResponse({u'error': u'start and count must be numbers'}, status=400)
+
+        return JSONResponse({
+            u'columns': [column.strip() for column in run.example_text.strip().strip(u'|').split(u'|')],
+            u'start': start,
+            u'total': run.example_row_count,
+            u'rows': examples.get_rows(run, start, count) if run.example_row_count else [],
+        }, status=200)
+
+
+class TestRunStepViewSet(GZipMixin, viewsets.ModelViewSet):
+    serializer_class = TestRunStepSerializer
+
+    # turn off pagination for steps, if someone is getting step results they probably want them all
+    # http://www.django-rest-framework.org/api-guide/pagination
+    paginate_by = None
+
+    # if this isn't defined, then a call to the nested router will always
+    # return all the entries in the table
+    # http://www.django-rest-framework.org/api-guide/filtering.html#filtering-against-the-url
+    def get_queryset(self):
+        # in the auto url router, the key is labeled run_pk
+        # bdd/api/tests/1/runs/123/steps, 123 -> run_pk
+        run_id = self.kwargs[u'run_pk']
+        queryset = TestRunStep.objects.filter(run=run_id).order_by(u'num')
+        if partitions.is_enabled():
+            queryset = partitions.prune_steps(queryset, self.get_run())
+        return queryset
+
+    def get_run(self):
+        """Returns the run the steps are of, or None."""
+        if not hasattr(self, u'_run'):
+            run_id = self.kwargs[u'run_pk']
+            self._run = partitions.prune_runs(TestRun.objects.all(), run_id).filter(pk=run_id).first()
+        return self._run
+
+    def list(self, request, **kwargs):
+        """Returns a list of step results for a given test and run id.
+
+        The steps of a finished run don't change, so they're cached and the
+        client gets a 304 if it already has them.
+        """
+        run = self.get_run()
+        if run is None or not is_cacheable(run):
+            return serialization.json_response(self.render_steps(run))
+
+        etag, last_modified = get_run_validators(run, u'steps')
+        if not_modified(request, etag, last_modified):
+            return HttpResponseNotModified()
+
+        # the rendered json is cached, so it's only rendered once too
+        content = get_cached_payload(etag, u'steps-json', lambda: self.render_steps(run))
+        response = serialization.json_response(content)
+        return set_validators(response, etag, last_modified, max_age=get_cache_seconds())
+
+    def render_steps(self, run):
+        if serialization.is_enabled():
+            steps = serialization.serialize_steps(run, self.get_queryset())
+        else:
+            steps = self.serialize_steps(run)
+        return serialization.render({u'steps': steps})
+
+    def serialize_steps(self, run):
+        if run is not None and run.shard_count:
+            # the steps of a sharded run are stored with its shards
+            queryset = get_run_steps(run, u'num')
+        else:
+            queryset = self.get_queryset()
+        return TestRunStepSerializer(queryset, many=True).data
+
+
+def get_compared_runs(base_run_id, other_run_id):
+    """Returns the two runs to compare, or raises Http404."""
+    runs = TestRun.objects.in_bulk([base_run_id, other_run_id])
+    if int(base_run_id) not in runs or int(other_run_id) not in runs:
+        raise Http404
+    return runs[int(base_run_id)], runs[int(other_run_id)]
+
+
+def add_screenshot_urls(comparison):
+    """Adds a screenshot_url next to every screenshot_key of a comparison."""
+    screenshot_storage = get_screenshot_storage()
+    for step in comparison[u'steps']:
+        for side in (step[u'base'], step[u'other']):
+            if side is not None:
+                key = side[u'screenshot_key']
+                side[u'screenshot_url'] = screenshot_storage.url(key) if key else None
+    return comparison
+
+
+@api_view([u'GET'])
+def compare_runs_api(request, base_run_id, other_run_id):
+    """Returns the steps of two runs lined up by example row and step number,
+    with the status and duration changes and the first diverging step.
+    """
+    base, other = get_compared_runs(base_run_id, other_run_id)
+    if not is_comparison_cacheable(base, other):
+        return JSONResponse(add_screenshot_urls(compare_runs(base, other)), status=200)
+
+    etag = get_comparison_etag(base, other)
+    if not_modified(request, etag, None):
+        return HttpResponseNotModified()
+
+    response = JSONResponse(add_screenshot_urls(compare_runs(base, other)), status=200)
+    return set_validators(response, etag, None)
+
+
+@api_view([u'POST'])
+def upload_screenshot(request):
+    """Stores the png posted as 'screenshot' and returns the key to save in
+    TestRunStep.screenshot_s3_key. Identical screenshots share the same key, so
+    they're only stored once.
+    """
+    upload = request.FILES.get(u'screenshot', None)
+    if upload is None:
+        return JSONResponse({u'error': u'no screenshot file given'}, status=400)
+
+    key = get_screenshot_storage().store(upload.read())
+    return JSONResponse({u'key': key}, status=200)
+
+
+def export_features(request):
+    """Streams tests as Gherkin. Query parameters:
+        format - feature (default) for a single .feature file, tar or zip for
+                 an archive with a .feature file per test
+        tag - only tests with this tag, can be given more than once
+    """
+    export_format = request.GET.get(u'format', features.FEATURE_FILE)
+    if export_format not in features.EXPORT_FORMATS:
+        return JSONResponse({u'error': u'format must be one of {}'.format(u', '.join(features.EXPORT_FORMATS))}, status=400)
+
+    tests = filter_tags(Test.objects.all(), request.GET.getlist(u'tag'))
+    response = StreamingHttpResponse(features.export_features(tests, export_format), content_type=features.CONTENT_TYPES[export_format])
+    file_name = u'tests.feature' if export_format == features.FEATURE_FILE else u'tests.{}'.format(export_format)
+    response[u'Content-Disposition'] = u'attachment; filename="{}"'.format(file_name)
+    return response
+
+
+def get_history(data):
+    """Returns the runs an export request selects, see
+    exports.select_history, and when they start.
+
+    @raise ValueError: for dates or statuses that can't be read
+    """
+    since = exports.parse_time(data[u'since']) if data.get(u'since') else None
+    until = exports.parse_time(data[u'until'], end=True) if data.get(u'until') else None
+    runs = exports.select_history(since, until, get_list(data, u'status'), data.get(u'user', u'').strip(), get_list(data, u'tag', u'+'))
+    return runs, since
+
+
+def export_history(request, kind):
+    """Streams the runs, or the steps of the runs, matching all of:
+        since - runs created on or after this date or time
+        until - runs created on or before this date, or before this time
+        status - runs in one of these statuses, can be given more than once
+        user - runs this user started
+        tag - runs of tests with every one of these tags, can be given more
+              than once
+    format is csv (default), jsonl or, with pyarrow installed, parquet.
+    """
+    export_format = request.GET.get(u'format', exports.CSV)
+    if export_format not in exports.EXPORT_FORMATS:
+        return JSONResponse({u'error': u'format must be one of {}'.format(u', '.join(exports.EXPORT_FORMATS))}, status=400)
+
+    try:
+        runs, since = get_history(request.GET)
+    except ValueError as e:
+        return JSONResponse({u'error': unicode(e)}, status=400)
+
+    # the rows are read after the view returns, when the router has forgotten the request
+    runs = runs.using(runs.db)
+    response = StreamingHttpResponse(exports.export_history(kind, runs, export_format, since), content_type=exports.CONTENT_TYPES[export_format])
+    response[u'Content-Disposition'] = u'attachment; filename="{}.{}"'.format(kind, export_format)
+    return response
+
+
+@api_view([u'POST'])
+def import_features(request):
+    """Creates and updates tests from the .feature file or tar or zip archive
+    posted as 'features'. Tests are matched by name and only changed ones are
+    updated. Post dry_run to see what would change without changing anything.
+    """
+    upload = request.FILES.get(u'features', None)
+    if upload is None:
+        return JSONResponse({u'error': u'no features file given'}, status=400)
+
+    user = request.DATA.get(u'user', None) or get_user(request)
+    try:
+        result = features.import_features(features.read_features(upload, upload.name), user,
+                                          dry_run=is_true(request.DATA.get(u'dry_run', False)))
+    except (features.FeatureError, UnicodeDecodeError) as e:
+        return JSONResponse({u'error': unicode(e)}, status=400)
+
+    return JSONResponse(result, status=200)
+
+
+def event_stream(request):
+    """Streams run, step and queue events as server-sent events.
+
+    Clients can narrow the stream down with the query parameters:
+        type - only events of this type, can be given more than once
+        run - only run and step events of this run, can be given more than once
+
+    The stream ends after BDD_EVENT_STREAM_SECONDS so it doesn't tie up a
+    worker forever, browsers reconnect on their own and pick up where they
+    left off with the Last-Event-ID header. It needs async workers, like
+    gevent's, a sync worker is held for the whole stream.
+    """
+    broker = events.get_broker()
+    event_types = set(request.GET.getlist(u'type'))
+    run_ids = set(int(run_id) for run_id in request.GET.getlist(u'run') if run_id.isdigit())
+    stream_seconds = getattr(settings, u'BDD_EVENT_STREAM_SECONDS', 5 * 60)
+
+    last_id = request.META.get(u'HTTP_LAST_EVENT_ID', u'')
+    last_id = int(last_id) if last_id.isdigit() else broker.get_last_id()
+
+    def wanted(event):
+        event_id, event_type, data = event
+        if event_types and event_type not in event_types:
+            return False
+        if run_ids and event_type == events.RUN_EVENT:
+            return data[u'id'] in run_ids or data[u'parent_id'] in run_ids
+        if run_ids and event_type == events.STEP_EVENT:
+            return data[u'run_id'] in run_ids
+        return True
+
+    def stream():
+        # tell the browser how long to wait before reconnecting
+        yield u'retry: 2000\n\n'
+
+        deadline = time.time() + stream_seconds
+        last = last_id
+        while time.time() < deadline:
+            new_events = broker.wait(last, timeout=15)
+            if not new_events:
+                # keeps proxies from closing an idle connection
+                yield u': keep-alive\n\n'
+                continue
+
+            last = new_events[-1][0]
+            for event in new_events:
+                if wanted(event):
+                    yield events.format_event(event)
+
+    response = StreamingHttpResponse(stream(), content_type=u'text/event-stream')
+    response[u'Cache-Control'] = u'no-cache'
+    return response
+
+
+def metrics_report(request):
+    """Returns the request metrics histograms collected in this process by
+    the in memory metrics sink, per view and api action.
+    """
+    sink = metrics.get_memory_sink()
+    if sink is None:
+        return JSONResponse({u'error': u'the in memory metrics sink is not configured'}, status=404)
+    return JSONResponse(sink.snapshot(), status=200)
+
+
+def step_stats(request):
+    """Returns the time spent in and the failure rate of every step definition,
+    hottest first. Query parameters:
+        sort - the field to sort by, prefixed with - to sort descending
+               (default -total)
+    """
+    try:
+        report = steps.get_step_report(request.GET.get(u'sort', u'-total'))
+    except ValueError as e:
+        return JSONResponse({u'error': unicode(e)}, status=400)
+
+    refresh = StepStatsRefresh.objects.order_by(u'-id').first()
+    return JSONResponse({
+        u'refreshed': refresh.timestamp.isoformat() if refresh else None,
+        u'last_run_id': refresh.last_run_id if refresh else None,
+        u'steps': report,
+    }, status=200)
+
+
+@api_view([u'POST'])
+def bulk_tags(request, operation):
+    """Adds, removes or renames tags on many tests at once, without touching
+    their steps or edit history. The tests are the ones matching all of:
+        test_ids - test ids
+        tagged - tags the tests all have, tags can be joined with +
+        search - text in the tests' names
+    add and remove take tags, the tags to add or remove. rename takes old and
+    new, and renames the tag on every test if no tests are selected.
+    """
+    data = request.DATA
+    try:
+        test_ids = [int(test_id) for test_id in get_list(data, u'test_ids')]
+    except ValueError:
+        return JSONResponse({u'error': u'test_ids must be numbers'}, status=400)
+    tagged = get_list(data, u'tagged', u'+')
+    search = data.get(u'search', u'').strip()
+
+    try:
+        if operation == u'rename':
+            queryset = select_tests(test_ids, tagged, search) if test_ids or tagged or search else None
+            result = {u'renamed': rename_tag(data.get(u'old', u''), data.get(u'new', u''), queryset)}
+        elif operation == u'add':
+            result = {u'added': add_tags(select_tests(test_ids, tagged, search), get_list(data, u'tags'))}
+        else:
+            result = {u'removed': remove_tags(select_tests(test_ids, tagged, search), get_list(data, u'tags'))}
+    except ValueError as e:
+        return JSONResponse({u'error': unicode(e)}, status=400)
+
+    log.info(u'{} bulk tag {}: {}'.format(get_user(request), operation, result))
+    return JSONResponse(result, status=200)
+
+
+def get_cancelled_runs(data):
+    """Returns the runs a cancel request selects, see select_runs.
+
+    @raise ValueError: if the request selects nothing, or ids aren't numbers
+    """
+    try:
+        run_ids = [int(run_id) for run_id in get_list(data, u'run_ids')]
+        test_ids = [int(test_id) for test_id in get_list(data, u'test_ids')]
+    except ValueError:
+        raise ValueError(u'run_ids and test_ids must be numbers')
+    return select_runs(run_ids, test_ids, data.get(u'user', u'').strip(), get_list(data, u'tagged', u'+'))
+
+
+@api_view([u'POST'])
+def cancel_runs_api(request):
+    """Cancels the queued and running runs matching all of:
+        run_ids - run ids
+        test_ids - the runs of these tests
+        user - the runs this user started
+        tagged - the runs of tests with every one of these tags, tags can be
+                 joined with +
+    Returns the ids of the runs cancelled, sharded runs' shards included.
+    """
+    try:
+        queryset = get_cancelled_runs(request.DATA)
+    except ValueError as e:
+        return JSONResponse({u'error': unicode(e)}, status=400)
+    return JSONResponse({u'cancelled': cancel_runs(queryset, get_user(request))}, status=200)
+
+
+@api_view([u'GET', u'POST'])
+def suites_api(request):
+    """GET lists the latest suites, of the user given as user if any. POST
+    starts a suite with a run of every test matching all of:
+        test_ids - test ids
+        tagged - tags the tests all have, tags can be joined with +
+    name names the suite, notify sends one email when it's done instead of one
+    per run. Tests that can't be run are left out and returned as skipped.
+    """
+    if request.method == u'GET':
+        suites = SuiteRun.objects.order_by(u'-id')
+        user = request.QUERY_PARAMS.get(u'user', u'').strip()
+        if user:
+            suites = suites.filter(user=user)
+        return JSONResponse(SuiteRunSerializer(suites[:SUITE_LIST_SIZE], many=True).data, status=200)
+
+    data = request.DATA
+    try:
+        test_ids = [int(test_id) for test_id in get_list(data, u'test_ids')]
+    except ValueError:
+        return JSONResponse({u'error': u'test_ids must be numbers'}, status=400)
+
+    try:
+        suite, skipped = start_suite(data.get(u'user') or get_user(request), test_ids, get_list(data, u'tagged', u'+'),
+                                     name=data.get(u'name', u'').strip(), notify=is_true(data.get(u'notify', False)))
+    except ValueError as e:
+        return JSONResponse({u'error': unicode(e)}, status=400)
+
+    result = SuiteRunSerializer(suite).data
+    result[u'skipped'] = skipped
+    return JSONResponse(result, status=200)
+
+
+@api_view([u'GET'])
+def suite_api(request, suite_id):
+    """Returns a suite's status and counters, from its one row."""
+    suite = SuiteRun.objects.filter(id=suite_id).first()
+    if suite is None:
+        return JSONResponse({u'error': u'unknown suite id: {}'.format(suite_id)}, status=404)
+    return JSONResponse(SuiteRunSerializer(suite).data, status=200)
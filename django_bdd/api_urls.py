@@ -0,0 +1,54 @@
+from django.conf.urls import patterns, url, include
+from rest_framework import routers
+from rest_framework_nested import routers as nested_routers
+from django_bdd import api
+
+# router docs
+# http://www.django-rest-framework.org/api-guide/routers
+# https://github.com/alanjds/drf-nested-routers
+# router code: https://github.com/tomchristie/django-rest-framework/blob/master/rest_framework/routers.py
+
+# these are the api urls only, they're included by django_bdd.urls under api/
+# processes that only serve the api can include this module on its own, and
+# never load the ui's dependencies
+
+# setup and route urls for api calls
+# trailing slash removes the requirement of having a trailing slash to api calls
+# im just not used to it so imma nuke it
+# wrap into a default router to get the root list functionality
+api_router_tests = routers.DefaultRouter(trailing_slash=False)
+api_router_tests.register(r'tests', api.TestViewSet)
+
+# wire up a nested router to get specific runs of a test and their status
+api_router_runs = nested_routers.NestedSimpleRouter(api_router_tests, r'tests', lookup='test', trailing_slash=False)
+
+# since our views have custom queryset getters, the base name needs to be given
+# or else django will throw errors, cuz it cant route the request
+api_router_runs.register(r'runs', api.TestRunViewSet, base_name='runs')
+
+# wire up a nested router to runs to get the specific steps and their status
+api_router_steps = nested_routers.NestedSimpleRouter(api_router_runs, r'runs', lookup='run', trailing_slash=False)
+
+# since our views have custom queryset getters, the base name needs to be given
+# or else django will throw errors, cuz it cant route the request
+api_router_steps.register(r'steps', api.TestRunStepViewSet, base_name='steps')
+
+urlpatterns = patterns('',
+    url(r'^screenshots$', api.upload_screenshot, name='bdd-upload-screenshot'),
+    url(r'^metrics$', api.metrics_report, name='bdd-metrics'),
+    url(r'^runs/(?P<base_run_id>\d+)/compare/(?P<other_run_id>\d+)$', api.compare_runs_api, name='bdd-compare-runs-api'),
+    url(r'^runs/cancel$', api.cancel_runs_api, name='bdd-cancel-runs-api'),
+    url(r'^suites$', api.suites_api, name='bdd-suite-runs-api'),
+    url(r'^suites/(?P<suite_id>\d+)$', api.suite_api, name='bdd-suite-run-api'),
+    url(r'^features$', api.export_features, name='bdd-export-features'),
+    url(r'^(?P<kind>runs|steps)/export$', api.export_history, name='bdd-export-history'),
+    url(r'^features/import$', api.import_features, name='bdd-import-features'),
+    url(r'^steps/stats$', api.step_stats, name='bdd-step-stats-api'),
+    # before the router, which would take tags for a test id
+    url(r'^tests/tags/(?P<operation>add|remove|rename)$', api.bulk_tags, name='bdd-bulk-tags'),
+    url(r'', include(api_router_tests.urls)),
+    # even though the nested router was init and django should technically
+    # know this is a 'subtree' of bdd_api, it dont. so have to add manually
+    url(r'', include(api_router_runs.urls)),
+    url(r'', include(api_router_steps.urls)),
+)
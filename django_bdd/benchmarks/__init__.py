@@ -0,0 +1,8 @@
+"""
+Performance benchmarks for django-bdd.
+
+data.py generates synthetic tests, runs and steps at a configurable scale,
+suite.py times the views, the api and notifications against that data and
+startup.py times importing the app in fresh processes. They're driven by the
+bdd_generate_data and bdd_benchmark management commands.
+"""
@@ -0,0 +1,183 @@
+"""
+Synthetic data for benchmarking: tests with tags and edit history, runs of
+those tests, and the step results of the runs. One of the runs is sharded,
+its steps are stored with its SHARDS shards.
+
+Everything is written with bulk inserts, and screenshots go to a local
+screenshot storage so nothing is uploaded to s3.
+"""
+import logging
+import random
+import struct
+import zlib
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from taggit.models import Tag, TaggedItem
+
+from django_bdd.models import Test, TestRun, TestRunStep, TestEditHistory, NEW, RUNNING, PASSED, FAILED,\
+    SKIPPED, ERROR
+
+# preset sizes, steps is the number of steps per example row
+SCALES = {
+    u'small': {u'tests': 50, u'tags': 10, u'runs': 3, u'steps': 10, u'example_rows': 1, u'history': 2},
+    u'medium': {u'tests': 500, u'tags': 50, u'runs': 5, u'steps': 15, u'example_rows': 2, u'history': 5},
+    u'large': {u'tests': 2000, u'tags': 200, u'runs': 10, u'steps': 20, u'example_rows': 2, u'history': 10},
+}
+
+# every generated test is named with this prefix
+TEST_NAME_PREFIX = u'synthetic'
+
+# how the statuses of finished runs are spread
+RUN_STATUSES = [PASSED] * 6 + [FAILED] * 2 + [SKIPPED, ERROR]
+
+STEP_TEXTS = [
+    u'Given I wait for the page to load',
+    u'When I tap on "<button>"',
+    u'When I type "<text>" into "<field>"',
+    u'Then I see "<text>"',
+    u'And I swipe left',
+]
+
+# the number of distinct screenshots, runs share them like real runs do
+SCREENSHOT_VARIANTS = 20
+
+BATCH_SIZE = 500
+
+# how many shards the sharded run has
+SHARDS = 2
+
+log = logging.getLogger(u'django-bdd')
+
+
+def make_png(seed):
+    """Returns the bytes of a tiny solid color png, no imaging library needed."""
+    def chunk(kind, data):
+        return struct.pack(b'>I', len(data)) + kind + data + struct.pack(b'>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    width = height = 8
+    color = struct.pack(b'>BBB', seed % 256, (seed * 7) % 256, (seed * 13) % 256)
+    raw = b''.join(b'\x00' + color * width for _ in range(height))
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack(b'>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def _bulk_create(model, objs):
+    """Bulk inserts objects and returns the ids they got, in insertion order.
+    bulk_create doesn't hand the ids back, so they're read back by range.
+    """
+    last_id = model.objects.order_by(u'-id').values_list(u'id', flat=True).first() or 0
+    model.objects.bulk_create(objs, batch_size=BATCH_SIZE)
+    return list(model.objects.filter(id__gt=last_id).order_by(u'id').values_list(u'id', flat=True))
+
+
+def generate(tests, tags, runs, steps, example_rows, history, storage, user=u'synthetic', seed=0):
+    """Generates synthetic data.
+
+    @param tests: how many tests to create
+    @param tags: how many distinct tags to spread over the tests
+    @param runs: how many runs to create per test
+    @param steps: how many steps per example row each run has
+    @param example_rows: how many example rows each run has
+    @param history: how many edit history entries each test has
+    @param storage: where to store screenshots
+    @type storage: django_bdd.screenshots.ScreenshotStorage
+    @return: the ids of the created tests
+    @rtype: list(int)
+    """
+    rand = random.Random(seed)
+    screenshot_keys = [storage.store(make_png(i)) for i in range(SCREENSHOT_VARIANTS)]
+
+    with transaction.atomic():
+        log.info(u'generating {} tests'.format(tests))
+        test_steps = [u'\n'.join(rand.choice(STEP_TEXTS) for _ in range(steps)) for _ in range(tests)]
+        test_ids = _bulk_create(Test, [
+            Test(user=user, name=u'{} {}'.format(TEST_NAME_PREFIX, i), steps=test_steps[i])
+            for i in range(tests)
+        ])
+
+        log.info(u'tagging tests with {} tags'.format(tags))
+        tag_names = [u'{}-{}'.format(TEST_NAME_PREFIX, i) for i in range(tags)]
+        # tag names are unique, the tags of an earlier run are reused
+        existing = dict(Tag.objects.filter(name__in=tag_names).values_list(u'name', u'id'))
+        tag_ids = [existing[name] for name in tag_names if name in existing]
+        tag_ids.extend(_bulk_create(Tag, [
+            Tag(name=name, slug=u'{}-{}-{}'.format(TEST_NAME_PREFIX, seed, i))
+            for i, name in enumerate(tag_names) if name not in existing
+        ]))
+        content_type = ContentType.objects.get_for_model(Test)
+        tagged_items = []
+        for test_id in test_ids:
+            for tag_id in rand.sample(tag_ids, min(len(tag_ids), rand.randint(1, 3))):
+                tagged_items.append(TaggedItem(tag_id=tag_id, content_type=content_type, object_id=test_id))
+        TaggedItem.objects.bulk_create(tagged_items, batch_size=BATCH_SIZE)
+
+        log.info(u'generating {} edit history entries per test'.format(history))
+        TestEditHistory.objects.bulk_create([
+            TestEditHistory(test_id=test_id, user=user, version=version, steps=test_steps[i])
+            for i, test_id in enumerate(test_ids)
+            for version in range(1, history + 1)
+        ], batch_size=BATCH_SIZE)
+
+        log.info(u'generating {} runs per test'.format(runs))
+        run_tests = [(i, test_id) for i, test_id in enumerate(test_ids) for _ in range(runs)]
+        run_statuses = [rand.choice(RUN_STATUSES) for _ in run_tests]
+
+        # leave a few runs in the queue
+        for i in range(min(len(run_statuses), max(1, len(run_statuses) // 100))):
+            run_statuses[-(i + 1)] = rand.choice([NEW, RUNNING])
+
+        # the steps are bulk created, so their counters are set up front
+        run_ids = _bulk_create(TestRun, [
+            TestRun(test_id=test_id, user=user, status=status, duration=rand.uniform(1, 300),
+                    step_count=len(test_steps[i].splitlines()) * example_rows,
+                    passed_steps=len(test_steps[i].splitlines()) * example_rows if status != NEW else 0,
+                    current_step=len(test_steps[i].splitlines()))
+            for (i, test_id), status in zip(run_tests, run_statuses)
+        ])
+
+        log.info(u'generating {} steps per run'.format(steps * example_rows))
+        batch = []
+        for (i, test_id), run_id, status in zip(run_tests, run_ids, run_statuses):
+            lines = test_steps[i].splitlines()
+            for row in range(1, example_rows + 1):
+                for num, text in enumerate(lines, 1):
+                    batch.append(TestRunStep(
+                        run_id=run_id,
+                        num=num,
+                        example_row_num=row,
+                        text=text,
+                        status=PASSED if status != NEW else NEW,
+                        duration=rand.uniform(0.1, 10),
+                        screenshot_s3_key=rand.choice(screenshot_keys)
+                    ))
+            if len(batch) >= BATCH_SIZE:
+                TestRunStep.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+                batch = []
+        TestRunStep.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+
+        log.info(u'generating a run sharded {} ways'.format(SHARDS))
+        lines = test_steps[0].splitlines()
+        shard_steps = len(lines) * example_rows
+        parent = TestRun.objects.create(
+            test_id=test_ids[0], user=user, status=PASSED, duration=rand.uniform(1, 300), shard_count=SHARDS,
+            example_row_count=example_rows * SHARDS, step_count=shard_steps * SHARDS,
+            passed_steps=shard_steps * SHARDS, current_step=len(lines))
+        for shard in range(SHARDS):
+            run = TestRun.objects.create(
+                test_id=test_ids[0], user=user, status=PASSED, duration=rand.uniform(1, 300), parent=parent,
+                shard_row_offset=shard * example_rows, example_row_count=example_rows,
+                step_count=shard_steps, passed_steps=shard_steps, current_step=len(lines))
+            TestRunStep.objects.bulk_create([
+                TestRunStep(run_id=run.id, num=num, example_row_num=row, text=text, status=PASSED,
+                            duration=rand.uniform(0.1, 10), screenshot_s3_key=rand.choice(screenshot_keys))
+                for row in range(1, example_rows + 1)
+                for num, text in enumerate(lines, 1)
+            ], batch_size=BATCH_SIZE)
+
+    return test_ids
@@ -0,0 +1,350 @@
+"""
+Load test against a running server and its database.
+
+Engine workers start runs through the api and write their step results with
+the orm, like the engine does, dashboards poll the steps of the runs in
+progress and the queue page, and editors save tests through the edit form.
+Every request and engine write is timed per endpoint, and with postgresql the
+time spent waiting on locks is sampled from pg_stat_activity as well.
+
+The engine workers need the database the server uses, so run it on the same
+settings as the server, against a dev server and its local database. The
+tests it creates are named with LOAD_TEST_PREFIX, and they're deleted with
+their runs and steps afterwards unless keep is given. Their step has to be one
+the server's step validation accepts.
+"""
+import collections
+import logging
+import random
+import re
+import threading
+import time
+
+from django.core.urlresolvers import reverse
+from django.db import connection, DatabaseError
+from django.utils import timezone
+
+from django_bdd import steps
+from django_bdd.benchmarks.suite import percentile
+from django_bdd.models import Test, TestRun, TestRunStep, RUNNING, PASSED, FAILED, SKIPPED
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+# every test the load test creates is named with this prefix
+LOAD_TEST_PREFIX = u'load test'
+
+# how the steps of the simulated runs finish
+STEP_STATUSES = [PASSED] * 17 + [FAILED, SKIPPED]
+
+STEP_TEXT = u'Given I wait for the page to load'
+
+# how often waiting locks are sampled, in seconds
+LOCK_SAMPLE_INTERVAL = 0.1
+
+# the table a waiting query is on, for telling lock waits apart
+TABLE_RE = re.compile(r'(?:from|into|update)\s+"?(\w+)"?', re.IGNORECASE)
+
+log = logging.getLogger(u'django-bdd')
+
+
+class Recorder(object):
+    """Collects the latencies, errors and lock waits of every endpoint, from
+    every thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.lock_waits = collections.Counter()
+
+    def record(self, endpoint, seconds, ok=True):
+        with self.lock:
+            self.latencies[endpoint].append(seconds * 1000.0)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def record_lock_wait(self, endpoint, seconds):
+        with self.lock:
+            self.lock_waits[endpoint] += seconds
+
+    def timed(self, endpoint, call, *args, **kwargs):
+        """Calls call and records how long it took. Responses with an error
+        status, or another status than expected_status if it's given, and
+        database and connection errors count as errors.
+        :return: what call returned, None if it raised a database or
+            connection error
+        """
+        expected_status = kwargs.pop(u'expected_status', None)
+        start = time.time()
+        try:
+            result = call(*args, **kwargs)
+        except (DatabaseError, requests.RequestException):
+            # sqlite gives up on locks with "database is locked", a busy dev server drops connections
+            log.exception(u'{} failed'.format(endpoint))
+            self.record(endpoint, time.time() - start, ok=False)
+            return None
+        status_code = getattr(result, u'status_code', 200)
+        if expected_status is None:
+            ok = status_code < 400
+        else:
+            ok = status_code == expected_status
+        self.record(endpoint, time.time() - start, ok=ok)
+        return result
+
+    def report(self, duration):
+        """
+        :return: one result per endpoint, by name
+        :rtype: list(dict)
+        """
+        results = []
+        for endpoint in sorted(set(self.latencies) | set(self.lock_waits)):
+            latencies = self.latencies.get(endpoint) or [0.0]
+            results.append({
+                u'endpoint': endpoint,
+                u'requests': len(self.latencies.get(endpoint, [])),
+                u'errors': self.errors[endpoint],
+                u'throughput': len(self.latencies.get(endpoint, [])) / duration,
+                u'latency_ms': {
+                    u'median': percentile(latencies, 50),
+                    u'p95': percentile(latencies, 95),
+                    u'p99': percentile(latencies, 99),
+                    u'max': max(latencies),
+                },
+                u'lock_wait_ms': self.lock_waits[endpoint] * 1000.0,
+            })
+        return results
+
+
+class LoadContext(object):
+    """What the simulated clients share: the server, the tests they use and
+    the runs in progress."""
+
+    def __init__(self, base_url, recorder, tests, steps_per_run, poll_interval, deadline):
+        self.base_url = base_url.rstrip(u'/')
+        self.recorder = recorder
+        self.tests = tests
+        self.steps_per_run = steps_per_run
+        self.poll_interval = poll_interval
+        self.deadline = deadline
+        self.active_runs = set()
+        # the database backend pid of every engine worker, and what it's doing
+        self.engine_operations = {}
+
+    def url(self, name, **kwargs):
+        return self.base_url + reverse(name, kwargs=kwargs)
+
+    def running(self):
+        return time.time() < self.deadline
+
+
+class Client(threading.Thread):
+    """A simulated client, keeps doing its thing until the deadline."""
+
+    def __init__(self, context, number):
+        super(Client, self).__init__(name=u'{}-{}'.format(self.__class__.__name__.lower(), number))
+        self.daemon = True
+        self.context = context
+        self.recorder = context.recorder
+        self.random = random.Random(number)
+
+        self.session = requests.Session()
+
+    def run(self):
+        try:
+            while self.context.running():
+                self.step()
+        except Exception:
+            log.exception(u'{} stopped'.format(self.name))
+        finally:
+            # the orm opened a connection for this thread
+            connection.close()
+
+    def step(self):
+        raise NotImplementedError
+
+
+class EngineWorker(Client):
+    """Starts runs and writes their steps one at a time, like the engine."""
+
+    # the backend pid of the worker's database connection, with postgresql
+    pid = None
+
+    def timed_write(self, endpoint, call, *args, **kwargs):
+        if self.pid is None and connection.vendor == u'postgresql':
+            connection.ensure_connection()
+            self.pid = connection.connection.get_backend_pid()
+        self.context.engine_operations[self.pid] = endpoint
+        try:
+            return self.recorder.timed(endpoint, call, *args, **kwargs)
+        finally:
+            self.context.engine_operations.pop(self.pid, None)
+
+    def step(self):
+        test = self.random.choice(self.context.tests)
+        response = self.recorder.timed(u'api start', self.session.post, self.context.url(u'test-start', pk=test.id),
+                                       data={u'user': self.name, u'force': u'true'})
+        if response is None or not response.ok:
+            time.sleep(self.context.poll_interval)
+            return
+
+        run = TestRun.objects.get(id=response.json()[u'id'])
+        run.status = RUNNING
+        self.timed_write(u'engine claim run', run.save, update_fields=[u'status'])
+        self.context.active_runs.add((test.id, run.id))
+        try:
+            started = time.time()
+            for num in range(1, self.context.steps_per_run + 1):
+                if not self.context.running():
+                    break
+                step = self.timed_write(u'engine start step', TestRunStep.objects.create,
+                                        run=run, num=num, text=STEP_TEXT, status=RUNNING)
+                if step is None:
+                    continue
+                step.status = self.random.choice(STEP_STATUSES)
+                step.duration = self.random.uniform(0.1, 2.0)
+                step.timestamp_end = timezone.now()
+                self.timed_write(u'engine finish step', step.save, update_fields=[u'status', u'duration', u'timestamp_end'])
+
+            run.status = PASSED
+            run.duration = time.time() - started
+            self.timed_write(u'engine finish run', run.save, update_fields=[u'status', u'duration'])
+        finally:
+            self.context.active_runs.discard((test.id, run.id))
+
+
+class DashboardPoller(Client):
+    """Polls the steps of a run in progress, and the queue page."""
+
+    def step(self):
+        active_runs = list(self.context.active_runs)
+        if active_runs:
+            test_id, run_id = self.random.choice(active_runs)
+            self.recorder.timed(u'api steps', self.session.get, self.context.url(u'steps-list', test_pk=test_id, run_pk=run_id))
+        self.recorder.timed(u'queue page', self.session.get, self.context.url(u'bdd-test-queue'))
+        time.sleep(self.context.poll_interval)
+
+
+class Editor(Client):
+    """Opens tests in the edit form and saves them."""
+
+    def step(self):
+        test = self.random.choice(self.context.tests)
+        url = self.context.url(u'bdd-edit-test', test_id=test.id)
+        page = self.recorder.timed(u'edit page', self.session.get, url)
+        if page is None or not page.ok:
+            time.sleep(self.context.poll_interval)
+            return
+
+        # without the csrf token of the page the form post is rejected
+        data = {
+            u'user': self.name,
+            u'name': test.name,
+            u'steps': u'<p>{}</p>'.format(STEP_TEXT),
+            u'tags': u'load',
+            u'csrfmiddlewaretoken': self.session.cookies.get(u'csrftoken', u''),
+        }
+        # a saved test redirects, the form is rendered again with a 200 when it's rejected
+        self.recorder.timed(u'edit save', self.session.post, url, data=data, headers={u'Referer': url}, allow_redirects=False,
+                            expected_status=302)
+        time.sleep(self.context.poll_interval * 5)
+
+
+class LockSampler(threading.Thread):
+    """Samples the queries waiting on locks in postgresql and adds the time
+    to the engine operation or, for the server's queries, the table they're
+    waiting on.
+    """
+
+    def __init__(self, context):
+        super(LockSampler, self).__init__(name=u'lock-sampler')
+        self.daemon = True
+        self.context = context
+
+    def run(self):
+        try:
+            cursor = connection.cursor()
+            while self.context.running():
+                cursor.execute(u"SELECT pid, query FROM pg_stat_activity "
+                               u"WHERE wait_event_type = 'Lock' AND datname = current_database()")
+                for pid, query in cursor.fetchall():
+                    endpoint = self.context.engine_operations.get(pid)
+                    if endpoint is None:
+                        match = TABLE_RE.search(query)
+                        endpoint = u'server {} {}'.format(query.split(None, 1)[0].upper(), match.group(1) if match else u'')
+                    self.context.recorder.record_lock_wait(endpoint.strip(), LOCK_SAMPLE_INTERVAL)
+                time.sleep(LOCK_SAMPLE_INTERVAL)
+        finally:
+            connection.close()
+
+
+def create_tests(count):
+    """Creates the tests the load test runs and edits.
+    :rtype: list(django_bdd.models.Test)
+    """
+    return [Test.objects.create(user=u'load', name=u'{} {}'.format(LOAD_TEST_PREFIX, i), steps=STEP_TEXT)
+            for i in range(count)]
+
+
+def delete_tests(tests):
+    """Deletes the tests the load test created, with their runs and steps.
+    Other tests named like them are left alone.
+    """
+    Test.objects.filter(id__in=[test.id for test in tests]).delete()
+
+
+def check_step_text():
+    """Makes sure the server accepts the step the load test runs and saves,
+    otherwise every start and edit would be rejected.
+
+    @raise ValueError: if the step isn't defined and undefined steps are rejected
+    """
+    undefined = steps.validate_steps(STEP_TEXT)
+    if steps.is_rejected(undefined):
+        raise ValueError(u'the load test step is rejected, {}; load the step definitions that define it or set '
+                         u'BDD_STEP_VALIDATION to warn'.format(u'; '.join(steps.describe_undefined_steps(undefined))))
+
+
+def run_load_test(base_url, workers=4, pollers=8, editors=1, duration=60, steps_per_run=20, poll_interval=1.0,
+                  tests=10, keep=False):
+    """Runs the simulated clients against the server for duration seconds.
+
+    @param base_url: the server, like http://127.0.0.1:8000
+    @param workers: how many engine workers start runs and write steps
+    @param pollers: how many dashboards poll steps and the queue
+    @param editors: how many users edit tests
+    @param steps_per_run: how many steps the engine workers write per run
+    @param poll_interval: how many seconds pollers wait between polls
+    @param tests: how many tests to create to run and edit
+    @param keep: keep the tests, runs and steps created
+    @return: the results per endpoint, and whether lock waits were sampled
+    @rtype: dict
+    @raise ValueError: if the server rejects the load test's step
+    """
+    check_step_text()
+    recorder = Recorder()
+    context = LoadContext(base_url, recorder, create_tests(tests), steps_per_run, poll_interval, time.time() + duration)
+    threads = [EngineWorker(context, i) for i in range(workers)]
+    threads.extend(DashboardPoller(context, i) for i in range(pollers))
+    threads.extend(Editor(context, i) for i in range(editors))
+    sample_locks = connection.vendor == u'postgresql'
+    if sample_locks:
+        threads.append(LockSampler(context))
+
+    started = time.time()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if not keep:
+            delete_tests(context.tests)
+
+    return {
+        u'duration': time.time() - started,
+        u'lock_waits_sampled': sample_locks,
+        u'results': recorder.report(time.time() - started),
+    }
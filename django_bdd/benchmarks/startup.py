@@ -0,0 +1,88 @@
+"""
+Benchmarks of how long it takes to import the app.
+
+Every gunicorn worker and management command pays for what django_bdd imports
+when it starts, so every entry point is imported in a fresh python process,
+a few times each. Besides the time, the results list which of the heavy
+dependencies got loaded along the way.
+"""
+import json
+import os
+import subprocess
+import sys
+
+from django_bdd.benchmarks.suite import percentile
+
+# the modules processes start from: the api alone, the whole url conf, the ui
+# and what the engine imports
+ENTRY_POINTS = [
+    (u'import_models', u'django_bdd.models'),
+    (u'import_api_urls', u'django_bdd.api_urls'),
+    (u'import_urls', u'django_bdd.urls'),
+    (u'import_views', u'django_bdd.views'),
+]
+
+# dependencies that are slow to import and only some code paths need
+HEAVY_MODULES = [u'requests', u'bs4', u'tinymce', u'django_tables2', u'django_ajax', u'mobilebdd', u'behave', u's3util', u'boto']
+
+# runs in the fresh process, prints the measurements as json
+IMPORT_SCRIPT = u'''
+import json, resource, sys, time
+start = time.time()
+from django.conf import settings
+settings.INSTALLED_APPS
+configured = time.time()
+__import__({module!r})
+end = time.time()
+print(json.dumps({{
+    u'settings_ms': (configured - start) * 1000.0,
+    u'import_ms': (end - configured) * 1000.0,
+    u'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    u'heavy_modules': [name for name in {heavy!r} if name in sys.modules],
+}}))
+'''
+
+
+def measure_import(module):
+    """Imports a module in a fresh python process, with the same settings and
+    python path as this one.
+    :rtype: dict
+    """
+    env = dict(os.environ)
+    env[u'PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    script = IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, u'-c', script], env=env)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_startup_benchmarks(repeat=5, names=None):
+    """Times importing every entry point.
+
+    @param repeat: how many fresh processes to time every import in
+    @param names: only run the benchmarks with these names, all if None
+    @return: one result per entry point, shaped like suite.run_benchmarks' results
+    @rtype: list(dict)
+    """
+    results = []
+    for name, module in ENTRY_POINTS:
+        if names and name not in names:
+            continue
+
+        runs = [measure_import(module) for _ in range(repeat)]
+        latencies = [run[u'import_ms'] for run in runs]
+        results.append({
+            u'scale': u'startup',
+            u'benchmark': name,
+            u'repeat': repeat,
+            u'latency_ms': {
+                u'min': min(latencies),
+                u'median': percentile(latencies, 50),
+                u'mean': sum(latencies) / len(latencies),
+                u'p95': percentile(latencies, 95),
+                u'max': max(latencies),
+            },
+            u'queries': 0,
+            u'peak_memory_kb': max(run[u'maxrss_kb'] for run in runs),
+            u'heavy_modules': runs[-1][u'heavy_modules'],
+        })
+    return results
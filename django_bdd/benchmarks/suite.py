@@ -0,0 +1,218 @@
+"""
+Benchmarks for the views, the api and notifications.
+
+Every benchmark is timed a few times per data scale. For every run the number
+of database queries and the peak memory are recorded too, and the results can
+be written as json and compared against the results of another commit.
+"""
+import gc
+import logging
+import math
+import time
+
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+from django_bdd import notifications, serialization
+from django_bdd.benchmarks.data import TEST_NAME_PREFIX
+from django_bdd.models import Test, TestRun, TestRunStep, NEW, RUNNING
+from django_bdd.serializers import TestRunSerializer, TestRunStepSerializer
+
+log = logging.getLogger(u'django-bdd')
+
+
+class StubS3Util(object):
+    """Stands in for S3Util so benchmarks never talk to aws."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def make_s3_url(self, key, extension=u''):
+        return u'/stub-s3/{}{}'.format(key, extension)
+
+    def put_metric(self, *args, **kwargs):
+        pass
+
+
+class BenchmarkContext(object):
+    """The objects benchmarks are run against, picked out of the generated data."""
+
+    def __init__(self):
+        self.client = Client(REMOTE_USER=u'synthetic')
+
+        # a finished run, and a test that has it
+        self.run = TestRun.objects.exclude(status__in=[NEW, RUNNING]).select_related(u'test').order_by(u'-id')[0]
+        self.test = self.run.test
+        self.tag = self.test.tags.names()[0]
+
+        # a finished sharded run, its steps are served from its shards
+        self.sharded_run = TestRun.objects.filter(shard_count__gt=0).exclude(status__in=[NEW, RUNNING]).order_by(u'-id').first()
+
+    def get_runs(self):
+        return TestRun.objects.filter(test=self.test.id, parent__isnull=True).order_by(u'-id')
+
+    def get_steps(self):
+        return TestRunStep.objects.filter(run=self.run.id).order_by(u'num')
+
+
+def get(path):
+    """Makes a benchmark out of a GET request to the path given by path(context)."""
+    def benchmark(context):
+        response = context.client.get(path(context))
+        if response.status_code != 200:
+            raise AssertionError(u'GET {} returned {}'.format(path(context), response.status_code))
+    return benchmark
+
+
+def serialize_runs(context):
+    JSONRenderer().render(TestRunSerializer(context.get_runs(), many=True).data)
+
+
+def serialize_runs_fast(context):
+    serialization.render(serialization.serialize_runs(context.get_runs().values_list(*serialization.RUN_FIELDS)))
+
+
+def serialize_steps(context):
+    JSONRenderer().render(TestRunStepSerializer(context.get_steps(), many=True).data)
+
+
+def serialize_steps_fast(context):
+    serialization.render(serialization.build_steps(context.get_steps().values_list(*serialization.STEP_COLUMNS)))
+
+
+def notify(context):
+    with override_settings(EMAIL_BACKEND=u'django.core.mail.backends.locmem.EmailBackend'):
+        notifications.notify(context.run)
+
+
+BENCHMARKS = [
+    (u'tests', get(lambda c: reverse(u'bdd-test-list'))),
+    (u'tests_by_tag', get(lambda c: reverse(u'bdd-test-list') + u'?tag=' + c.tag)),
+    (u'test_runs', get(lambda c: reverse(u'bdd-all-runs'))),
+    (u'test_run_detail', get(lambda c: reverse(u'bdd-test-run-detail', kwargs={u'test_id': c.test.id, u'test_run_id': c.run.id}))),
+    (u'test_queue', get(lambda c: reverse(u'bdd-test-queue'))),
+    (u'api_runs', get(lambda c: reverse(u'runs-list', kwargs={u'test_pk': c.test.id}))),
+    (u'api_steps', get(lambda c: reverse(u'steps-list', kwargs={u'test_pk': c.test.id, u'run_pk': c.run.id}))),
+    (u'serialize_runs', serialize_runs),
+    (u'serialize_runs_fast', serialize_runs_fast),
+    (u'serialize_steps', serialize_steps),
+    (u'serialize_steps_fast', serialize_steps_fast),
+    (u'notify', notify),
+]
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of a list of numbers."""
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+
+def measure(benchmark, context, repeat):
+    """Runs a benchmark repeat times, after one warm up run.
+    :return: latency stats in milliseconds, the query count and the peak memory in kb
+    :rtype: dict
+    """
+    benchmark(context)
+
+    latencies = []
+    queries = 0
+    peak_memory = 0
+    for _ in range(repeat):
+        gc.collect()
+        if tracemalloc is not None:
+            tracemalloc.start()
+
+        with CaptureQueriesContext(connection) as captured:
+            start = time.time()
+            benchmark(context)
+            latencies.append((time.time() - start) * 1000.0)
+
+        if tracemalloc is not None:
+            peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1] // 1024)
+            tracemalloc.stop()
+        else:
+            # without tracemalloc only the peak of the whole process is known
+            peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queries = max(queries, len(captured))
+
+    return {
+        u'latency_ms': {
+            u'min': min(latencies),
+            u'median': percentile(latencies, 50),
+            u'mean': sum(latencies) / len(latencies),
+            u'p95': percentile(latencies, 95),
+            u'max': max(latencies),
+        },
+        u'queries': queries,
+        u'peak_memory_kb': peak_memory,
+    }
+
+
+def run_benchmarks(scale, repeat=5, names=None):
+    """Runs the benchmarks against the data in the database.
+
+    @param scale: the name of the data scale, recorded with the results
+    @param repeat: how many times to time every benchmark
+    @param names: only run the benchmarks with these names, all if None
+    @return: one result per benchmark
+    @rtype: list(dict)
+    """
+    if not Test.objects.filter(name__startswith=TEST_NAME_PREFIX).exists():
+        raise ValueError(u'no synthetic data to benchmark against')
+
+    s3_util = notifications.S3Util
+    notifications.S3Util = StubS3Util
+    try:
+        context = BenchmarkContext()
+        # timing the fast serialization path only means something if it renders the same json
+        differences = serialization.check_compatibility(context.get_runs(), context.get_steps(), context.sharded_run)
+        if differences:
+            raise AssertionError(u'the fast serialization path renders different json:\n' + u'\n'.join(differences))
+
+        results = []
+        for name, benchmark in BENCHMARKS:
+            if names and name not in names:
+                continue
+            log.info(u'benchmarking {} at scale {}'.format(name, scale))
+            result = {u'scale': scale, u'benchmark': name, u'repeat': repeat}
+            result.update(measure(benchmark, context, repeat))
+            results.append(result)
+    finally:
+        notifications.S3Util = s3_util
+    return results
+
+
+def compare(old, new):
+    """Lines up two sets of results by scale and benchmark.
+    :return: (scale, benchmark, old median ms, new median ms, change in percent, old queries, new queries)
+    :rtype: list(tuple)
+    """
+    old_results = dict(((r[u'scale'], r[u'benchmark']), r) for r in old[u'results'])
+    rows = []
+    for result in new[u'results']:
+        previous = old_results.get((result[u'scale'], result[u'benchmark']))
+        if previous is None:
+            continue
+        old_median = previous[u'latency_ms'][u'median']
+        new_median = result[u'latency_ms'][u'median']
+        change = (new_median - old_median) / old_median * 100.0 if old_median else 0.0
+        rows.append((
+            result[u'scale'],
+            result[u'benchmark'],
+            old_median,
+            new_median,
+            change,
+            previous[u'queries'],
+            result[u'queries'],
+        ))
+    return rows
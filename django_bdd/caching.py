@@ -0,0 +1,125 @@
+"""
+Conditional requests and payload caching for finished runs.
+
+Once a run is finished its steps and report don't change, so responses about
+it get an ETag and Last-Modified header and requests that send them back get a
+304. The serialized payloads are cached too, keyed by the ETag, so if the
+engine ever writes to the run again the ETag changes and the old payload is
+simply never looked up again.
+
+settings.BDD_FINISHED_RUN_CACHE_SECONDS is how long payloads are cached and
+how long clients may reuse a response without asking again (default 3600).
+"""
+import calendar
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from django_bdd.models import TestRun, TestRunStep, FINISHED_STATUSES, NEW, RUNNING
+from django_bdd.partitions import prune_steps
+
+GZIP_ETAG_SUFFIX = u';gzip'
+
+
+def get_cache_seconds():
+    return getattr(settings, u'BDD_FINISHED_RUN_CACHE_SECONDS', 60 * 60)
+
+
+def _latest(*timestamps):
+    timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+    return max(timestamps) if timestamps else None
+
+
+def make_etag(*parts):
+    return hashlib.sha1(u'|'.join(unicode(part) for part in parts).encode(u'utf-8')).hexdigest()
+
+
+def get_run_validators(run, *extra):
+    """Returns the ETag and last modified time of a run and its steps. Costs
+    one aggregate query over the steps.
+
+    @type run: django_bdd.models.TestRun
+    @param extra: anything else the response depends on, mixed into the ETag
+    @rtype: (unicode, datetime.datetime)
+    """
+    if run.shard_count:
+        steps = TestRunStep.objects.filter(run__parent=run.id)
+    else:
+        steps = TestRunStep.objects.filter(run=run.id)
+    stats = prune_steps(steps, run).aggregate(count=Count(u'id'), last_id=Max(u'id'), duration=Sum(u'duration'),
+                            last_start=Max(u'timestamp_start'), last_end=Max(u'timestamp_end'))
+
+    etag = make_etag(
+        run.id, run.status, run.duration, hashlib.sha1(run.text.encode(u'utf-8')).hexdigest(),
+        stats[u'count'], stats[u'last_id'], stats[u'duration'], stats[u'last_end'], *extra
+    )
+    return etag, _latest(run.timestamp, stats[u'last_start'], stats[u'last_end'])
+
+
+def get_run_history_validators(test_id, *extra):
+    """Returns the ETag and last modified time of the list of runs of a test.
+    Costs two queries over the runs.
+
+    @param extra: anything else the response depends on, mixed into the ETag
+    @rtype: (unicode, datetime.datetime)
+    """
+    runs = TestRun.objects.filter(test=test_id, parent__isnull=True)
+    stats = runs.aggregate(count=Count(u'id'), last_id=Max(u'id'), duration=Sum(u'duration'), last=Max(u'timestamp'))
+    # queued runs change progress without changing status
+    queued = runs.filter(status__in=[NEW, RUNNING]).values_list(u'id', u'status', u'step_count', u'passed_steps',
+                                                                u'failed_steps', u'skipped_steps', u'error_steps', u'current_step')
+
+    etag = make_etag(test_id, stats[u'count'], stats[u'last_id'], stats[u'duration'], sorted(queued), *extra)
+    return etag, stats[u'last']
+
+
+def is_cacheable(run):
+    return run.status in FINISHED_STATUSES
+
+
+def not_modified(request, etag, last_modified):
+    """Checks the request's If-None-Match and If-Modified-Since headers.
+    :return: True if the client already has the current response
+    """
+    if_none_match = request.META.get(u'HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # gzipped responses have their ETag marked, see django.middleware.gzip
+        etags = [tag[:-len(GZIP_ETAG_SUFFIX)] if tag.endswith(GZIP_ETAG_SUFFIX) else tag for tag in parse_etags(if_none_match)]
+        return etag in etags or u'*' in etags
+
+    if_modified_since = parse_http_date_safe(request.META.get(u'HTTP_IF_MODIFIED_SINCE', u''))
+    if if_modified_since and last_modified:
+        return calendar.timegm(last_modified.utctimetuple()) <= if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified, max_age=None):
+    """Adds the ETag, Last-Modified and Cache-Control headers to a response."""
+    response[u'ETag'] = quote_etag(etag)
+    if last_modified:
+        response[u'Last-Modified'] = http_date(calendar.timegm(last_modified.utctimetuple()))
+    if max_age is not None:
+        response[u'Cache-Control'] = u'max-age={}'.format(max_age)
+    else:
+        # the client has to check every time, but can still get a 304
+        response[u'Cache-Control'] = u'no-cache'
+    return response
+
+
+def get_cached_payload(etag, kind, build):
+    """Returns the cached payload of a finished run, building and caching it
+    if it isn't cached yet.
+
+    @param etag: the run's ETag, from get_run_validators
+    @param kind: what kind of payload this is, like u'steps'
+    @param build: function that builds the payload
+    """
+    key = u'bdd:run-payload:{}:{}'.format(kind, etag)
+    payload = cache.get(key)
+    if payload is None:
+        payload = build()
+        cache.set(key, payload, get_cache_seconds())
+    return payload
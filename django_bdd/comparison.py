@@ -0,0 +1,140 @@
+"""
+Step by step comparison of two runs.
+
+The steps of both runs are lined up by (example_row_num, num), so a step is
+compared with the step at the same position of the other run even if the
+scenario was edited in between. Comparisons of two finished runs never change,
+so they're cached for BDD_FINISHED_RUN_CACHE_SECONDS.
+"""
+from django.core.cache import cache
+
+from django_bdd.caching import get_cache_seconds, is_cacheable, make_etag
+from django_bdd.models import TestRunStep
+from django_bdd.partitions import prune_steps
+
+STEP_FIELDS = (u'example_row_num', u'num', u'text', u'status', u'duration', u'screenshot_s3_key')
+
+
+def get_step_values(run):
+    """Returns the steps of a run as dicts with STEP_FIELDS, in one query. The
+    steps of a sharded run have their example row numbers shifted the same way
+    get_run_steps does.
+
+    @type run: django_bdd.models.TestRun
+    @rtype: list(dict)
+    """
+    if not run.shard_count:
+        return list(prune_steps(TestRunStep.objects.filter(run=run.id), run).values(*STEP_FIELDS))
+
+    steps = TestRunStep.objects.filter(run__parent=run.id)
+    steps = list(prune_steps(steps, run).values(u'run__shard_row_offset', *STEP_FIELDS))
+    for step in steps:
+        step[u'example_row_num'] += step.pop(u'run__shard_row_offset')
+    return steps
+
+
+def _side(step):
+    if step is None:
+        return None
+    return {
+        u'text': step[u'text'],
+        u'status': step[u'status'],
+        u'duration': step[u'duration'],
+        u'screenshot_key': step[u'screenshot_s3_key'],
+    }
+
+
+def _run_summary(run):
+    return {
+        u'id': run.id,
+        u'test_id': run.test_id,
+        u'status': run.status,
+        u'duration': run.duration,
+        u'timestamp': run.timestamp.isoformat() if run.timestamp else None,
+    }
+
+
+def build_comparison(base, other):
+    """Lines up the steps of two runs.
+
+    A step diverges when it's missing from one of the runs, or its text or
+    status differs. The first diverging step is usually where a scenario that
+    used to pass started failing.
+
+    @param base: the run to compare against, usually the older one
+    @type base: django_bdd.models.TestRun
+    @param other: the run to compare
+    @type other: django_bdd.models.TestRun
+    @rtype: dict
+    """
+    base_steps = dict(((step[u'example_row_num'], step[u'num']), step) for step in get_step_values(base))
+    other_steps = dict(((step[u'example_row_num'], step[u'num']), step) for step in get_step_values(other))
+
+    steps = []
+    first_diverging = None
+    counts = {u'status_changed': 0, u'text_changed': 0, u'missing': 0}
+    for position in sorted(set(base_steps) | set(other_steps)):
+        base_step = base_steps.get(position)
+        other_step = other_steps.get(position)
+
+        missing = base_step is None or other_step is None
+        status_changed = not missing and base_step[u'status'] != other_step[u'status']
+        text_changed = not missing and base_step[u'text'] != other_step[u'text']
+        duration_change = None if missing else other_step[u'duration'] - base_step[u'duration']
+
+        counts[u'missing'] += missing
+        counts[u'status_changed'] += status_changed
+        counts[u'text_changed'] += text_changed
+
+        diverges = missing or status_changed or text_changed
+        if diverges and first_diverging is None:
+            first_diverging = len(steps)
+
+        steps.append({
+            u'example_row_num': position[0],
+            u'num': position[1],
+            u'base': _side(base_step),
+            u'other': _side(other_step),
+            u'status_changed': status_changed,
+            u'text_changed': text_changed,
+            u'duration_change': duration_change,
+            u'diverges': diverges,
+        })
+
+    return {
+        u'base': _run_summary(base),
+        u'other': _run_summary(other),
+        u'status_changed': base.status != other.status,
+        u'duration_change': other.duration - base.duration,
+        u'first_diverging_step': first_diverging,
+        u'counts': counts,
+        u'steps': steps,
+    }
+
+
+def get_comparison_etag(base, other):
+    return make_etag(u'comparison', base.id, base.status, base.duration, other.id, other.status, other.duration)
+
+
+def is_comparison_cacheable(base, other):
+    return is_cacheable(base) and is_cacheable(other)
+
+
+def compare_runs(base, other):
+    """Returns the comparison of two runs, from the cache if both runs are
+    finished. Screenshots are given by key, urls to them may expire so they
+    aren't cached.
+
+    @type base: django_bdd.models.TestRun
+    @type other: django_bdd.models.TestRun
+    @rtype: dict
+    """
+    if not is_comparison_cacheable(base, other):
+        return build_comparison(base, other)
+
+    key = u'bdd:run-comparison:{}'.format(get_comparison_etag(base, other))
+    comparison = cache.get(key)
+    if comparison is None:
+        comparison = build_comparison(base, other)
+        cache.set(key, comparison, get_cache_seconds())
+    return comparison
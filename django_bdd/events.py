@@ -0,0 +1,204 @@
+"""
+Push channel for run status and queue changes.
+
+Whenever a run changes status, a step result is saved or the queue gets longer
+or shorter, an event is published to the broker. The bdd-events view streams
+the events to the queue and result pages as server-sent events, so they don't
+have to reload every few seconds to notice a change.
+
+settings.BDD_EVENT_BROKER picks the broker, by name or by dotted path to a
+class taking no arguments:
+    u'local' (default) - keeps events in memory, so it only sees the writes of
+                         the process serving the pages. The engine and
+                         bdd_executor run in processes of their own, so with
+                         it the result page reloads on a timer instead and
+                         the queue page isn't refreshed.
+    u'cache' - passes events through the django cache, works across processes
+               on a single node or with a shared cache like memcached
+
+Brokers with cross_process = False only work in a single process deployment,
+the pages only subscribe to brokers that reach across processes.
+
+Every open page holds a request to bdd-events for BDD_EVENT_STREAM_SECONDS
+(default 300) before it reconnects, so the pages subscribing need a server
+that doesn't spend a worker per request, like gunicorn with gevent workers.
+With sync workers, every open page takes a worker for as long as it's open.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_by_path
+
+from django_bdd.models import TestRun, TestRunStep, NEW, RUNNING
+
+# event types
+RUN_EVENT = u'run'
+STEP_EVENT = u'step'
+QUEUE_EVENT = u'queue'
+
+# how many events a broker keeps around for clients that reconnect
+EVENT_BACKLOG = 1000
+
+log = logging.getLogger(u'django-bdd')
+
+
+class LocalBroker(object):
+    """Keeps events in this process."""
+
+    # runs written by other processes never show up here
+    cross_process = False
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=EVENT_BACKLOG)
+        self.last_id = 0
+
+    def publish(self, event_type, data):
+        with self.condition:
+            self.last_id += 1
+            self.events.append((self.last_id, event_type, data))
+            self.condition.notify_all()
+
+    def get_last_id(self):
+        return self.last_id
+
+    def wait(self, last_id, timeout):
+        """Returns the events after last_id, waiting up to timeout seconds for one.
+        :rtype: list((int, unicode, dict))
+        """
+        with self.condition:
+            if self.last_id <= last_id:
+                self.condition.wait(timeout)
+            return [event for event in self.events if event[0] > last_id]
+
+
+class CacheBroker(object):
+    """Passes events through the django cache. Waiting clients check the last
+    event id in the cache every BDD_EVENT_POLL_SECONDS, which is a lot cheaper
+    than reloading a page.
+    """
+    cross_process = True
+    LAST_ID_KEY = u'bdd:events:last-id'
+    EVENT_KEY = u'bdd:events:{}'
+    EVENT_SECONDS = 60 * 10
+
+    def __init__(self):
+        self.poll_seconds = getattr(settings, u'BDD_EVENT_POLL_SECONDS', 0.5)
+
+    def publish(self, event_type, data):
+        try:
+            event_id = cache.incr(self.LAST_ID_KEY)
+        except ValueError:
+            # first event, or the cache was cleared. add() only ever sets the
+            # key once, other processes may be doing the same thing right now
+            cache.add(self.LAST_ID_KEY, 0, None)
+            event_id = cache.incr(self.LAST_ID_KEY)
+        cache.set(self.EVENT_KEY.format(event_id), (event_id, event_type, data), self.EVENT_SECONDS)
+
+    def get_last_id(self):
+        return cache.get(self.LAST_ID_KEY) or 0
+
+    def wait(self, last_id, timeout):
+        deadline = time.time() + timeout
+        current_id = self.get_last_id()
+        while current_id <= last_id and time.time() < deadline:
+            time.sleep(self.poll_seconds)
+            current_id = self.get_last_id()
+
+        # don't go further back than the backlog if the client fell behind
+        first_id = max(last_id + 1, current_id - EVENT_BACKLOG + 1)
+        keys = [self.EVENT_KEY.format(event_id) for event_id in range(first_id, current_id + 1)]
+        events = cache.get_many(keys)
+        return [events[key] for key in keys if key in events]
+
+
+BROKERS = {
+    u'local': LocalBroker,
+    u'cache': CacheBroker,
+}
+
+_broker = None
+
+
+def get_broker():
+    """Returns the broker configured with BDD_EVENT_BROKER."""
+    global _broker
+    if _broker is None:
+        name = getattr(settings, u'BDD_EVENT_BROKER', u'local')
+        _broker = (BROKERS[name] if name in BROKERS else import_by_path(name))()
+    return _broker
+
+
+def is_cross_process():
+    """Returns whether the broker sees the events of the engine and executor
+    processes, so pages can wait for events instead of reloading on a timer.
+    Brokers configured by dotted path are taken to, unless they say otherwise.
+    """
+    return getattr(get_broker(), u'cross_process', True)
+
+
+def publish(event_type, data):
+    try:
+        get_broker().publish(event_type, data)
+    except Exception as e:
+        # events are a nicety, never fail a write because of them
+        log.error(u'unable to publish {} event: {}'.format(event_type, unicode(e)))
+
+
+def format_event(event):
+    """Formats an event as a server-sent event."""
+    event_id, event_type, data = event
+    return u'id: {}\nevent: {}\ndata: {}\n\n'.format(event_id, event_type, json.dumps(data))
+
+
+def get_queue_length():
+    return TestRun.objects.filter(status__in=[NEW, RUNNING], shard_count=0).count()
+
+
+@receiver(post_init, sender=TestRun)
+@receiver(post_init, sender=TestRunStep)
+def remember_status(sender, instance, **kwargs):
+    # lets the save handlers tell if the status changed
+    instance._bdd_loaded_status = instance.status if instance.pk else None
+
+
+@receiver(post_save, sender=TestRun)
+def run_saved(sender, instance, created, **kwargs):
+    old_status = getattr(instance, u'_bdd_loaded_status', None)
+    if not created and old_status == instance.status:
+        return
+    instance._bdd_loaded_status = instance.status
+
+    publish(RUN_EVENT, {
+        u'id': instance.id,
+        u'test_id': instance.test_id,
+        u'parent_id': instance.parent_id,
+        u'status': instance.status,
+    })
+
+    # sharded parents aren't in the queue, their shards are
+    queued = set([NEW, RUNNING])
+    if not instance.shard_count and (old_status in queued) != (instance.status in queued):
+        publish(QUEUE_EVENT, {u'length': get_queue_length()})
+
+
+@receiver(post_save, sender=TestRunStep)
+def step_saved(sender, instance, created, **kwargs):
+    if not created and getattr(instance, u'_bdd_loaded_status', None) == instance.status:
+        return
+    instance._bdd_loaded_status = instance.status
+
+    publish(STEP_EVENT, {
+        u'id': instance.id,
+        u'run_id': instance.run_id,
+        u'num': instance.num,
+        u'example_row_num': instance.example_row_num,
+        u'status': instance.status,
+    })
@@ -0,0 +1,156 @@
+"""
+Example datasets for data-driven scenario outline runs.
+
+Instead of an examples array in the request body, a run can be started with a
+CSV or JSON lines file of example rows. The file is read a line at a time and
+its rows are stored in TestRunExampleChunks of EXAMPLE_CHUNK_SIZE rows each,
+so neither the upload nor the engine has to hold the whole table in memory.
+The run's example_text only gets the header row, and example_row_count says
+how many rows the engine should fetch through the api, a range at a time.
+
+CSV files start with a header row. In JSON lines files every line is an
+object with a value for every variable of the outline.
+"""
+import csv
+import json
+
+from django.conf import settings
+
+from django_bdd.models import TestRunExampleChunk
+
+CSV_FORMAT = u'csv'
+JSONL_FORMAT = u'jsonl'
+DATASET_FORMATS = (CSV_FORMAT, JSONL_FORMAT)
+
+# how many rows are stored together
+EXAMPLE_CHUNK_SIZE = 500
+
+
+class ExampleDatasetError(Exception):
+    """Raised when an uploaded dataset doesn't fit the scenario outline."""
+    pass
+
+
+def get_fetch_limit():
+    """Returns how many rows the engine can fetch at once."""
+    return getattr(settings, u'BDD_EXAMPLE_FETCH_LIMIT', 1000)
+
+
+def guess_format(name):
+    return JSONL_FORMAT if name.lower().endswith((u'.jsonl', u'.json', u'.ndjson')) else CSV_FORMAT
+
+
+def check_columns(columns, step_variables):
+    """Makes sure the dataset has a column for every variable of the outline
+    and nothing else.
+    """
+    if len(set(columns)) != len(columns):
+        raise ExampleDatasetError(u'the dataset has duplicate columns: {}'.format(u', '.join(columns)))
+
+    missing = set(step_variables) - set(columns)
+    unknown = set(columns) - set(step_variables)
+    if missing or unknown:
+        raise ExampleDatasetError(u'the dataset columns don\'t match the outline variables, missing: {} unknown: {}'.format(
+            u', '.join(sorted(missing)) or u'none', u', '.join(sorted(unknown)) or u'none'))
+
+
+def read_dataset(upload, step_variables, dataset_format=CSV_FORMAT):
+    """Reads the columns of a dataset and returns them with an iterator over
+    its rows. Rows are read from the file as they're iterated over.
+
+    @param upload: the uploaded file, iterating over it yields lines
+    @param step_variables: the variables of the scenario outline
+    @type step_variables: set(unicode)
+    @param dataset_format: one of DATASET_FORMATS
+    @return: the columns and the rows, every row a list of values in column order
+    @rtype: (list(unicode), iterator(list(unicode)))
+    """
+    if dataset_format == CSV_FORMAT:
+        reader = csv.reader(upload)
+        try:
+            columns = [column.decode(u'utf-8-sig').strip() for column in next(reader)]
+        except StopIteration:
+            raise ExampleDatasetError(u'the dataset is empty')
+        check_columns(columns, step_variables)
+
+        def rows():
+            for line_num, row in enumerate(reader, 2):
+                if not any(row):
+                    continue
+                if len(row) != len(columns):
+                    raise ExampleDatasetError(u'line {} has {} values, expected {}'.format(line_num, len(row), len(columns)))
+                yield [value.decode(u'utf-8') for value in row]
+        return columns, rows()
+
+    if dataset_format != JSONL_FORMAT:
+        raise ExampleDatasetError(u'unknown dataset format {}'.format(dataset_format))
+
+    # json lines don't have a header, the outline's variables are the columns
+    columns = sorted(step_variables)
+
+    def rows():
+        for line_num, line in enumerate(upload, 1):
+            if not line.strip():
+                continue
+            try:
+                example = json.loads(line)
+            except ValueError:
+                raise ExampleDatasetError(u'line {} is not json'.format(line_num))
+            if not isinstance(example, dict):
+                raise ExampleDatasetError(u'line {} is not a json object'.format(line_num))
+            check_columns(example.keys(), step_variables)
+            yield [unicode(example[column]) for column in columns]
+    return columns, rows()
+
+
+def store_rows(run, rows):
+    """Stores the rows of a dataset for a run, EXAMPLE_CHUNK_SIZE rows at a time.
+
+    @type run: django_bdd.models.TestRun
+    @param rows: the rows, as returned by read_dataset
+    @return: how many rows were stored
+    @rtype: int
+    """
+    count = 0
+    chunk = []
+    chunks = []
+
+    def add_chunk():
+        chunks.append(TestRunExampleChunk(run=run, first_row=count - len(chunk) + 1, row_count=len(chunk),
+                                          rows=json.dumps(chunk, separators=(u',', u':'))))
+
+    for row in rows:
+        chunk.append(row)
+        count += 1
+        if len(chunk) >= EXAMPLE_CHUNK_SIZE:
+            add_chunk()
+            chunk = []
+            # write a few chunks at a time, so only those are held in memory
+            if len(chunks) >= 10:
+                TestRunExampleChunk.objects.bulk_create(chunks)
+                chunks = []
+    if chunk:
+        add_chunk()
+    TestRunExampleChunk.objects.bulk_create(chunks)
+    return count
+
+
+def get_rows(run, start, count):
+    """Returns the uploaded example rows of a run from row number start on,
+    at most count of them.
+
+    @type run: django_bdd.models.TestRun
+    @param start: the first row number, starting at 1
+    @type start: int
+    @type count: int
+    @rtype: list(list(unicode))
+    """
+    end = start + count - 1
+    chunks = TestRunExampleChunk.objects.filter(run=run.id, first_row__lte=end, first_row__gt=start - EXAMPLE_CHUNK_SIZE)\
+        .order_by(u'first_row').values_list(u'first_row', u'rows')
+
+    rows = []
+    for first_row, chunk_rows in chunks:
+        chunk_rows = json.loads(chunk_rows)
+        rows.extend(chunk_rows[max(start - first_row, 0):end - first_row + 1])
+    return rows
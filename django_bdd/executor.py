@@ -0,0 +1,369 @@
+"""
+Runs queued test runs on this machine, without the external engine.
+
+    ./manage.py bdd_executor --processes 4 --timeout 1800
+
+claims NEW runs and runs every one of them in a process of its own, at most
+--processes at a time (BDD_EXECUTOR_PROCESSES, default one per core). Runs
+are claimed with a conditional update, so several executors, and the engine,
+can work off the same queue without running anything twice. Step results are
+written as the steps finish, so the result page and the events stream follow
+along, and the run's status, duration and report are written when it's done.
+The user gets the usual results email.
+
+A run that takes longer than --timeout seconds (BDD_EXECUTOR_TIMEOUT, default
+1800) is killed and marked as an error, a run that's cancelled is killed and
+stays cancelled. SIGTERM or ctrl-c stops claiming runs
+and waits for the ones in progress to finish, a second one kills them.
+
+Runs are run with behave, with the step definitions mobilebdd.runner loads
+into it. BDD_EXECUTOR_RUNNER is the dotted path of the function to run them
+with instead, it's called with the run, its feature text and a StepRecorder
+the steps are reported to, and returns the run's report text.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+import traceback
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_by_path
+
+from django_bdd import examples, runs
+from django_bdd.models import TestRun, TestRunStep, NEW, RUNNING, PASSED, FAILED, ERROR, SKIPPED, CANCELLED
+
+# how many of the oldest queued runs are tried when claiming one, others may claim them first
+CLAIM_CANDIDATES = 10
+
+# how a run that was killed is reported
+TIMEOUT_TEXT = u'The run was stopped after {} seconds.'
+SHUTDOWN_TEXT = u'The run was stopped because the executor shut down.'
+CRASH_TEXT = u'The run stopped unexpectedly with exit code {}.'
+
+# behave's step statuses, steps that never got to run are skipped
+# behave goes past undefined steps, and the ones it skips, without calling the step hooks, they're recorded with their scenario
+BEHAVE_STATUSES = {
+    u'passed': PASSED,
+    u'failed': FAILED,
+    u'skipped': SKIPPED,
+    u'untested': SKIPPED,
+    u'undefined': ERROR,
+}
+
+log = logging.getLogger(u'django-bdd')
+
+
+def get_processes():
+    return getattr(settings, u'BDD_EXECUTOR_PROCESSES', None) or multiprocessing.cpu_count()
+
+
+def get_timeout():
+    return getattr(settings, u'BDD_EXECUTOR_TIMEOUT', 30 * 60)
+
+
+def get_runner():
+    return import_by_path(getattr(settings, u'BDD_EXECUTOR_RUNNER', u'django_bdd.executor.run_behave'))
+
+
+def claim_run():
+    """Marks the oldest queued run as running and returns it, or returns None
+    if the queue is empty. Sharded parents are never queued, their shards are.
+
+    @rtype: django_bdd.models.TestRun or None
+    """
+    candidates = TestRun.objects.filter(status=NEW, shard_count=0).order_by(u'id')[:CLAIM_CANDIDATES]
+    for run in candidates:
+        # the update locks the row until the save commits, a cancel waits for the claim instead of being overwritten
+        with transaction.atomic():
+            # only one of the executors racing for a run gets to update it
+            if not TestRun.objects.filter(id=run.id, status=NEW).update(status=RUNNING):
+                continue
+            # saved again so the run and queue events go out and a sharded parent is updated
+            run.status = RUNNING
+            run.save(update_fields=[u'status'])
+        return run
+    return None
+
+
+def _format_cell(value):
+    return unicode(value).replace(u'\\', u'\\\\').replace(u'|', u'\\|').replace(u'\n', u'\\n')
+
+
+def get_example_lines(run):
+    """Returns the example table a run is run with, the header row first.
+
+    @type run: django_bdd.models.TestRun
+    @rtype: list(unicode)
+    """
+    table = runs.get_example_table(run.test.steps, run.example_text)
+    if run.example_row_count:
+        # uploaded datasets only keep the header row in example_text
+        for start in range(1, run.example_row_count + 1, examples.EXAMPLE_CHUNK_SIZE):
+            for row in examples.get_rows(run, start, examples.EXAMPLE_CHUNK_SIZE):
+                table.append(u'| {} |'.format(u' | '.join(_format_cell(value) for value in row)))
+    return table
+
+
+def build_feature(run):
+    """Returns the feature file text that runs a test run.
+
+    @type run: django_bdd.models.TestRun
+    @rtype: unicode
+    """
+    steps = run.test.steps.split(runs.EXAMPLES_MARKER, 1)[0]
+    table = get_example_lines(run)
+
+    lines = [u'Feature: {}'.format(run.test.name), u'']
+    lines.append(u'  {}: {}'.format(u'Scenario Outline' if table else u'Scenario', run.test.name))
+    lines.extend(u'    ' + line.strip() for line in steps.splitlines() if line.strip())
+    if table:
+        lines.extend([u'', u'    ' + runs.EXAMPLES_MARKER])
+        lines.extend(u'      ' + line for line in table)
+    return u'\n'.join(lines) + u'\n'
+
+
+class StepRecorder(object):
+    """Writes a run's step results as they happen."""
+
+    def __init__(self, run):
+        self.run = run
+        self.example_row_num = 0
+        self.num = 0
+        self.step = None
+        self.statuses = set()
+        self.failed = False
+
+    def start_row(self):
+        """Starts the next example row, or the scenario if it isn't an outline."""
+        self.example_row_num += 1
+        self.num = 0
+
+    def start_step(self, text):
+        self.num += 1
+        self.step = TestRunStep.objects.create(run=self.run, num=self.num, example_row_num=max(self.example_row_num, 1),
+                                               text=text, status=RUNNING)
+
+    def add_step(self, text, status):
+        """Records a step that didn't run, with how it ended."""
+        self.num += 1
+        self.statuses.add(status)
+        TestRunStep.objects.create(run=self.run, num=self.num, example_row_num=max(self.example_row_num, 1),
+                                   text=text, status=status, timestamp_end=timezone.now())
+
+    def finish_step(self, status, duration):
+        self.statuses.add(status)
+        self.step.status = status
+        self.step.duration = duration
+        self.step.timestamp_end = timezone.now()
+        self.step.save(update_fields=[u'status', u'duration', u'timestamp_end'])
+        self.step = None
+
+    def finish(self, failed):
+        """Records whether the runner says the run failed, which it can
+        without a failed step, like when a hook fails."""
+        self.failed = failed
+
+    def get_status(self):
+        """Returns the status of the run from the statuses of its steps and
+        what the runner said."""
+        if ERROR in self.statuses:
+            return ERROR
+        if FAILED in self.statuses or self.failed:
+            return FAILED
+        if not self.statuses or self.statuses == set([SKIPPED]):
+            return SKIPPED
+        return PASSED
+
+
+def run_behave(run, feature, recorder):
+    """Runs a feature with behave and the step definitions of mobilebdd.
+
+    @type run: django_bdd.models.TestRun
+    @param feature: the feature file text
+    @type feature: unicode
+    @type recorder: StepRecorder
+    @return: the report, the errors of the steps that failed
+    @rtype: unicode
+    """
+    from behave.configuration import Configuration
+    from behave.runner import Runner
+    # importing the runner loads mobilebdd's step definitions into behave
+    import mobilebdd.runner  # noqa
+
+    errors = []
+
+    def before_scenario(scenario):
+        recorder.start_row()
+
+    def before_step(step):
+        recorder.start_step(u'{} {}'.format(step.keyword, step.name))
+
+    def get_step_status(step):
+        # behave 1.2.6 has a Status enum, earlier versions plain strings
+        return BEHAVE_STATUSES.get(getattr(step.status, u'name', step.status), ERROR)
+
+    def is_undefined(step):
+        return getattr(step.status, u'name', step.status) == u'undefined'
+
+    def after_step(step):
+        recorder.finish_step(get_step_status(step), step.duration or 0.0)
+
+    def after_scenario(scenario):
+        scenario_steps = list(scenario.all_steps)
+        # a step whose after_step never came
+        if recorder.step is not None:
+            after_step(scenario_steps[recorder.num - 1])
+        # the steps behave went past without running them
+        for step in scenario_steps[recorder.num:]:
+            recorder.add_step(u'{} {}'.format(step.keyword, step.name), get_step_status(step))
+        # behave sets the error message after the after_step hook
+        for step in scenario_steps:
+            if step.error_message:
+                errors.append(u'{} {}: {}'.format(step.keyword, step.name, step.error_message))
+            elif is_undefined(step):
+                errors.append(u'{} {}: the step is undefined'.format(step.keyword, step.name))
+
+    recording_hooks = {
+        u'before_scenario': before_scenario,
+        u'after_scenario': after_scenario,
+        u'before_step': before_step,
+        u'after_step': after_step,
+    }
+
+    class RecordingRunner(Runner):
+        def load_hooks(self, *args, **kwargs):
+            super(RecordingRunner, self).load_hooks(*args, **kwargs)
+            for name, record in recording_hooks.items():
+                self.hooks[name] = _chain_hook(record, self.hooks.get(name))
+
+    directory = tempfile.mkdtemp()
+    try:
+        # behave wants a steps directory next to the feature, the steps are already loaded
+        os.mkdir(os.path.join(directory, u'steps'))
+        path = os.path.join(directory, u'run.feature')
+        with open(path, u'wb') as f:
+            f.write(feature.encode(u'utf-8'))
+
+        failed = RecordingRunner(Configuration(command_args=[path, u'--format', u'null', u'--no-capture', u'--no-summary'])).run()
+        recorder.finish(failed)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return u'\n'.join(errors)
+
+
+def _chain_hook(record, hook):
+    def chained(context, *args):
+        record(*args)
+        if hook is not None:
+            hook(context, *args)
+    return chained
+
+
+def execute_run(run_id):
+    """Runs a claimed run, in the process started for it."""
+    # the executor handles shutdown, a run only stops when it's done or killed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    run = TestRun.objects.select_related(u'test').get(id=run_id)
+    recorder = StepRecorder(run)
+    started = time.time()
+    try:
+        text = get_runner()(run, build_feature(run), recorder)
+        status = recorder.get_status()
+    except Exception:
+        log.exception(u'run {} failed to run'.format(run_id))
+        text = traceback.format_exc().decode(u'utf-8', u'replace')
+        status = ERROR
+    runs.finish_run(run, status, time.time() - started, text)
+
+
+class Executor(object):
+    """Keeps up to processes runs going at a time, one process per run."""
+
+    def __init__(self, processes=None, timeout=None, poll_interval=2.0):
+        self.processes = processes or get_processes()
+        self.timeout = timeout or get_timeout()
+        self.poll_interval = poll_interval
+        self.running = {}
+        self.stopping = False
+        self.killing = False
+
+    def stop(self, signum=None, frame=None):
+        """Stops claiming runs, the second time kills the ones in progress too."""
+        if self.stopping:
+            log.warning(u'stopping {} runs in progress'.format(len(self.running)))
+            self.killing = True
+        else:
+            log.info(u'waiting for {} runs in progress to finish'.format(len(self.running)))
+            self.stopping = True
+
+    def start(self, run):
+        # a forked process can't share the database connection, it opens its own
+        connection.close()
+        process = multiprocessing.Process(target=execute_run, args=(run.id,), name=u'bdd-run-{}'.format(run.id))
+        process.daemon = True
+        process.start()
+        self.running[run.id] = (process, time.time())
+        log.info(u'started run {} in process {}'.format(run.id, process.pid))
+
+    def terminate(self, run_id):
+        process, started = self.running.pop(run_id)
+        process.terminate()
+        process.join()
+        return started
+
+    def kill(self, run_id, text):
+        started = self.terminate(run_id)
+        runs.finish_run(TestRun.objects.get(id=run_id), ERROR, time.time() - started, text)
+
+    def kill_all(self, text):
+        for run_id in list(self.running):
+            self.kill(run_id, text)
+
+    def reap(self):
+        """Forgets finished runs and kills the ones over their timeout or cancelled."""
+        for run_id, (process, started) in list(self.running.items()):
+            if not process.is_alive():
+                del self.running[run_id]
+                if process.exitcode:
+                    log.error(u'run {} exited with {}'.format(run_id, process.exitcode))
+                    runs.finish_run(TestRun.objects.get(id=run_id), ERROR, time.time() - started, CRASH_TEXT.format(process.exitcode))
+            elif time.time() - started > self.timeout:
+                log.warning(u'run {} timed out'.format(run_id))
+                self.kill(run_id, TIMEOUT_TEXT.format(self.timeout))
+
+        if self.running:
+            for run_id in TestRun.objects.filter(id__in=list(self.running), status=CANCELLED).values_list(u'id', flat=True):
+                log.info(u'run {} was cancelled'.format(run_id))
+                self.terminate(run_id)
+
+    def run(self, once=False):
+        """Runs queued runs until stopped.
+
+        @param once: stop once the queue is empty and the runs are done
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            while not self.killing:
+                self.reap()
+                claimed = False
+                while not self.stopping and len(self.running) < self.processes:
+                    run = claim_run()
+                    if run is None:
+                        break
+                    claimed = True
+                    self.start(run)
+
+                if not self.running and (self.stopping or (once and not claimed)):
+                    return
+                time.sleep(self.poll_interval)
+        finally:
+            self.kill_all(SHUTDOWN_TEXT)
@@ -0,0 +1,285 @@
+"""
+Export of run and step history for offline analysis.
+
+Runs, or the steps of runs, are written as csv, json lines or parquet,
+filtered by when the runs were created, their status, their user and the tags
+of their tests. The rows are read EXPORT_CHUNK_SIZE at a time, each chunk a
+short query picking up after the id the last one ended on, and written out as
+they're read, so exports of millions of rows stream with constant memory and
+never hold a long running query or transaction open. The steps are read for
+STEP_RUN_BATCH_SIZE runs at a time, which keeps them on the run_id index.
+
+Parquet needs pyarrow, the format isn't offered without it. A parquet file
+gets a row group per chunk.
+"""
+import csv
+import datetime
+import io
+import json
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from django_bdd.models import TestRun, TestRunStep, STATUS_CHOICES
+from django_bdd.serialization import format_datetime
+from django_bdd.streams import StreamBuffer
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CSV = u'csv'
+JSON_LINES = u'jsonl'
+PARQUET = u'parquet'
+EXPORT_FORMATS = (CSV, JSON_LINES, PARQUET) if pyarrow is not None else (CSV, JSON_LINES)
+
+CONTENT_TYPES = {
+    CSV: u'text/csv; charset=utf-8',
+    JSON_LINES: u'application/x-ndjson',
+    PARQUET: u'application/octet-stream',
+}
+
+RUNS = u'runs'
+STEPS = u'steps'
+
+# the kinds of column values
+INTEGER = u'integer'
+FLOAT = u'float'
+STRING = u'string'
+DATETIME = u'datetime'
+
+# the columns of each export, their names and where values_list gets them from
+# the id comes first, the rows are read in chunks by it
+RUN_COLUMNS = (
+    (u'id', u'id', INTEGER),
+    (u'test_id', u'test_id', INTEGER),
+    (u'test_name', u'test__name', STRING),
+    (u'user', u'user', STRING),
+    (u'status', u'status', STRING),
+    (u'timestamp', u'timestamp', DATETIME),
+    (u'duration', u'duration', FLOAT),
+    (u'step_count', u'step_count', INTEGER),
+    (u'passed_steps', u'passed_steps', INTEGER),
+    (u'failed_steps', u'failed_steps', INTEGER),
+    (u'skipped_steps', u'skipped_steps', INTEGER),
+    (u'error_steps', u'error_steps', INTEGER),
+    (u'example_row_count', u'example_row_count', INTEGER),
+    (u'parent_id', u'parent_id', INTEGER),
+    (u'shard_count', u'shard_count', INTEGER),
+    (u'suite_id', u'suite_id', INTEGER),
+)
+STEP_COLUMNS = (
+    (u'id', u'id', INTEGER),
+    (u'run_id', u'run_id', INTEGER),
+    (u'num', u'num', INTEGER),
+    (u'example_row_num', u'example_row_num', INTEGER),
+    (u'text', u'text', STRING),
+    (u'status', u'status', STRING),
+    (u'timestamp_start', u'timestamp_start', DATETIME),
+    (u'timestamp_end', u'timestamp_end', DATETIME),
+    (u'duration', u'duration', FLOAT),
+    (u'screenshot_s3_key', u'screenshot_s3_key', STRING),
+)
+COLUMNS = {RUNS: RUN_COLUMNS, STEPS: STEP_COLUMNS}
+
+# how many rows are read and written at a time
+EXPORT_CHUNK_SIZE = 2000
+
+# how many runs' steps are read at a time
+STEP_RUN_BATCH_SIZE = 100
+
+log = logging.getLogger(u'django-bdd')
+
+
+def parse_time(value, end=False):
+    """Reads a date or datetime given to filter by. A date means the start
+    of the day, or with end the start of the next one.
+
+    @type value: unicode
+    @rtype: datetime.datetime
+    @raise ValueError: if it's neither
+    """
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(u'{} is not a date or time'.format(value))
+        if end:
+            day += datetime.timedelta(days=1)
+        moment = datetime.datetime.combine(day, datetime.time())
+    # compared with the timestamps the way the database stores them
+    if settings.USE_TZ and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, timezone.get_default_timezone())
+    elif not settings.USE_TZ and timezone.is_aware(moment):
+        moment = timezone.make_naive(moment, timezone.get_default_timezone())
+    return moment
+
+
+def select_history(since=None, until=None, statuses=None, user=None, tags=None):
+    """Returns the runs matching everything given, for exporting.
+
+    @param since: only runs created at or after this
+    @type since: datetime.datetime
+    @param until: only runs created before this
+    @type until: datetime.datetime
+    @param statuses: only runs in one of these statuses
+    @type statuses: list(unicode)
+    @param user: only runs this user started
+    @param tags: only runs of tests tagged with every one of these
+    @rtype: QuerySet
+    @raise ValueError: for unknown statuses
+    """
+    unknown = set(statuses or []) - set(status for status, label in STATUS_CHOICES)
+    if unknown:
+        raise ValueError(u'unknown statuses {}'.format(u', '.join(sorted(unknown))))
+
+    queryset = TestRun.objects.all()
+    if since:
+        queryset = queryset.filter(timestamp__gte=since)
+    if until:
+        queryset = queryset.filter(timestamp__lt=until)
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    if user:
+        queryset = queryset.filter(user=user)
+    for tag in set(tags or []):
+        queryset = queryset.filter(test__tags__name=tag)
+    return queryset
+
+
+def iter_chunks(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields the values_list rows of a queryset chunk_size at a time, by
+    id. fields starts with the id.
+
+    @rtype: generator(list(tuple))
+    """
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id).order_by(u'id').values_list(*fields)[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1][0]
+
+
+def iter_rows(kind, runs, since=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields the rows of runs or of their steps, a chunk at a time.
+
+    @param kind: RUNS or STEPS
+    @param runs: the runs to export, or the runs to export the steps of
+    @type runs: QuerySet
+    @param since: the runs were created at or after this, which lets the
+        steps' partitions be pruned
+    @rtype: generator(list(tuple))
+    """
+    fields = [field for name, field, value_kind in COLUMNS[kind]]
+    if kind == RUNS:
+        for chunk in iter_chunks(runs, fields, chunk_size):
+            yield chunk
+        return
+
+    # the steps are read from the database the runs are, like the replica
+    steps = TestRunStep.objects.using(runs.db)
+    if since:
+        # a run's steps never start before the run was created
+        steps = steps.filter(timestamp_start__gte=since)
+    for run_ids in iter_chunks(runs, [u'id'], STEP_RUN_BATCH_SIZE):
+        for chunk in iter_chunks(steps.filter(run_id__in=[run_id for run_id, in run_ids]), fields, chunk_size):
+            yield chunk
+
+
+def _format_value(value, value_kind):
+    if value_kind == DATETIME:
+        return format_datetime(value)
+    return value
+
+
+def write_csv(columns, chunks):
+    yield u','.join(name for name, field, value_kind in columns).encode(u'utf-8') + b'\r\n'
+    for chunk in chunks:
+        buf = io.BytesIO()
+        writer = csv.writer(buf)
+        for row in chunk:
+            values = (_format_value(value, value_kind) for value, (name, field, value_kind) in zip(row, columns))
+            # python 2's csv module writes bytes
+            writer.writerow([u'' if value is None else unicode(value).encode(u'utf-8') for value in values])
+        yield buf.getvalue()
+
+
+def write_json_lines(columns, chunks):
+    for chunk in chunks:
+        lines = []
+        for row in chunk:
+            values = (_format_value(value, value_kind) for value, (name, field, value_kind) in zip(row, columns))
+            lines.append(json.dumps(OrderedDict(zip((name for name, field, value_kind in columns), values))))
+        yield b'\n'.join(lines) + b'\n'
+
+
+def _to_utc(value):
+    # parquet timestamps are utc, pyarrow wants them naive
+    if value is None:
+        return None
+    if timezone.is_naive(value):
+        # stored in the default time zone without USE_TZ
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return timezone.make_naive(value, timezone.utc)
+
+
+def write_parquet(columns, chunks):
+    types = {
+        INTEGER: pyarrow.int64(),
+        FLOAT: pyarrow.float64(),
+        STRING: pyarrow.string(),
+        DATETIME: pyarrow.timestamp(u'ms', tz=u'UTC'),
+    }
+    schema = pyarrow.schema([pyarrow.field(name, types[value_kind]) for name, field, value_kind in columns])
+    buf = StreamBuffer()
+    writer = pyarrow.parquet.ParquetWriter(buf, schema)
+    for chunk in chunks:
+        arrays = []
+        for index, (name, field, value_kind) in enumerate(columns):
+            values = [row[index] for row in chunk]
+            if value_kind == DATETIME:
+                values = [_to_utc(value) for value in values]
+            arrays.append(pyarrow.array(values, type=types[value_kind]))
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        data = buf.drain()
+        if data:
+            yield data
+    # the footer
+    writer.close()
+    yield buf.drain()
+
+
+WRITERS = {
+    CSV: write_csv,
+    JSON_LINES: write_json_lines,
+    PARQUET: write_parquet,
+}
+
+
+def export_history(kind, runs, export_format=CSV, since=None):
+    """Exports runs or the steps of runs, yielding the output a chunk at a
+    time.
+
+    @param kind: RUNS or STEPS
+    @param runs: the runs, see select_history
+    @type runs: QuerySet
+    @param export_format: one of EXPORT_FORMATS
+    @param since: what the runs were selected with, see iter_rows
+    @rtype: generator(str)
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(u'unknown export format {}'.format(export_format))
+    if kind not in COLUMNS:
+        raise ValueError(u'unknown export {}'.format(kind))
+
+    for data in WRITERS[export_format](COLUMNS[kind], iter_rows(kind, runs, since)):
+        yield data
+    log.info(u'exported {} as {}'.format(kind, export_format))
@@ -0,0 +1,382 @@
+"""
+Import and export of tests as Gherkin .feature files.
+
+Every test becomes a Scenario (or a Scenario Outline, if its steps use <xyz>
+variables) with its tags as @tags. A suite can be exported as one .feature
+file or as a tar or zip archive with a .feature file per test. Exports are
+built a chunk of tests at a time, so they can be streamed without loading
+every test into memory.
+
+Imports go the other way: the scenarios are diffed against the existing tests
+by name and content hash. New scenarios are created, scenarios whose steps or
+tags changed are updated and everything else is left alone. Each batch of
+BDD_FEATURE_IMPORT_BATCH_SIZE scenarios (default 100) is written in its own
+transaction, with its edit history entries created in bulk.
+
+Gherkin tags can't contain whitespace, so whitespace in tag names is exported
+as underscores. Background sections aren't supported, their steps are skipped.
+"""
+import io
+import logging
+import re
+import tarfile
+import time
+import zipfile
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.template.defaultfilters import slugify
+
+from django_bdd.models import Test, TestEditHistory
+from django_bdd.runs import EXAMPLES_MARKER, hash_steps
+from django_bdd.steps import VARIABLE_RE
+from django_bdd.streams import StreamBuffer
+
+FEATURE_FILE = u'feature'
+TAR_ARCHIVE = u'tar'
+ZIP_ARCHIVE = u'zip'
+EXPORT_FORMATS = (FEATURE_FILE, TAR_ARCHIVE, ZIP_ARCHIVE)
+
+CONTENT_TYPES = {
+    FEATURE_FILE: u'text/plain; charset=utf-8',
+    TAR_ARCHIVE: u'application/x-tar',
+    ZIP_ARCHIVE: u'application/zip',
+}
+
+FEATURE_EXTENSION = u'.feature'
+
+# how many tests are loaded at a time when exporting
+EXPORT_CHUNK_SIZE = 200
+
+# how far the steps are indented under the scenario line
+STEP_INDENT = u'    '
+
+SCENARIO_RE = re.compile(r'^(Scenario|Scenario Outline|Scenario Template):\s*(.*)$')
+BACKGROUND_RE = re.compile(r'^Background:')
+FEATURE_RE = re.compile(r'^Feature:')
+
+# what reading a truncated or corrupt archive raises
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipfile, zlib.error, IOError, EOFError)
+
+log = logging.getLogger(u'django-bdd')
+
+
+class FeatureError(Exception):
+    """Raised when an import can't be read."""
+    pass
+
+
+class Scenario(object):
+    """A scenario read from a .feature file."""
+
+    def __init__(self, name, steps, tags, source=u''):
+        self.name = name
+        self.steps = steps
+        self.tags = tags
+        self.source = source
+
+    @property
+    def steps_hash(self):
+        return hash_steps(self.steps)
+
+
+def get_import_batch_size():
+    return getattr(settings, u'BDD_FEATURE_IMPORT_BATCH_SIZE', 100)
+
+
+def to_gherkin_tag(tag):
+    return u'@' + re.sub(r'\s+', u'_', tag.strip())
+
+
+def format_scenario(test, tags):
+    """Formats a test as a Gherkin scenario.
+
+    @type test: django_bdd.models.Test
+    @param tags: the test's tag names
+    @type tags: list(unicode)
+    @rtype: unicode
+    """
+    lines = []
+    if tags:
+        lines.append(u' '.join(to_gherkin_tag(tag) for tag in sorted(tags)))
+
+    outline = EXAMPLES_MARKER in test.steps or VARIABLE_RE.search(test.steps)
+    lines.append(u'{}: {}'.format(u'Scenario Outline' if outline else u'Scenario', test.name))
+    for line in test.steps.splitlines():
+        lines.append(STEP_INDENT + line if line.strip() else u'')
+    return u'\n'.join(lines).rstrip() + u'\n'
+
+
+def _indent(text):
+    return u'\n'.join(STEP_INDENT + line if line else line for line in text.splitlines()) + u'\n'
+
+
+def iter_tests(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields the tests of a queryset with their tags prefetched, loading
+    chunk_size tests at a time by primary key.
+    """
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_id).order_by(u'pk').prefetch_related(u'tags')[:chunk_size])
+        for test in chunk:
+            yield test
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1].pk
+
+
+def _feature_file_names():
+    """Returns a function that picks a unique file name for a test."""
+    used = set()
+
+    def file_name(test):
+        name = slugify(test.name) or u'scenario'
+        if name in used:
+            name = u'{}-{}'.format(name, test.pk)
+        used.add(name)
+        return name + FEATURE_EXTENSION
+    return file_name
+
+
+def export_features(queryset, export_format=FEATURE_FILE, title=u'django-bdd tests'):
+    """Exports tests as .feature files, yielding the output a chunk at a time.
+
+    @param queryset: the tests to export
+    @type queryset: QuerySet
+    @param export_format: one of EXPORT_FORMATS. FEATURE_FILE puts every test
+        in one feature, the archives have a feature file per test
+    @param title: the name of the feature when exporting a single file
+    @rtype: generator(str)
+    """
+    if export_format == FEATURE_FILE:
+        yield u'Feature: {}\n'.format(title).encode(u'utf-8')
+        for test in iter_tests(queryset):
+            scenario = format_scenario(test, [tag.name for tag in test.tags.all()])
+            yield (u'\n' + _indent(scenario)).encode(u'utf-8')
+        return
+
+    if export_format not in (TAR_ARCHIVE, ZIP_ARCHIVE):
+        raise ValueError(u'unknown export format {}'.format(export_format))
+
+    buf = StreamBuffer()
+    file_name = _feature_file_names()
+    if export_format == TAR_ARCHIVE:
+        archive = tarfile.open(fileobj=buf, mode=u'w|')
+    else:
+        archive = zipfile.ZipFile(buf, mode=u'w', compression=zipfile.ZIP_DEFLATED)
+
+    for test in iter_tests(queryset):
+        scenario = format_scenario(test, [tag.name for tag in test.tags.all()])
+        content = (u'Feature: {}\n\n'.format(test.name) + _indent(scenario)).encode(u'utf-8')
+        name = file_name(test)
+
+        if export_format == TAR_ARCHIVE:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = time.time()
+            archive.addfile(info, io.BytesIO(content))
+        else:
+            archive.writestr(name, content)
+
+        data = buf.drain()
+        if data:
+            yield data
+
+    archive.close()
+    yield buf.drain()
+
+
+def _dedent(lines):
+    """Strips the indentation common to the lines and the blank lines at the end."""
+    while lines and not lines[-1].strip():
+        lines.pop()
+    indents = [len(line) - len(line.lstrip()) for line in lines if line.strip()]
+    indent = min(indents) if indents else 0
+    return u'\n'.join(line[indent:] if line.strip() else u'' for line in lines)
+
+
+def parse_feature(text, source=u''):
+    """Yields the scenarios in the text of a .feature file. Tags of the
+    feature apply to every scenario in it.
+
+    @type text: unicode
+    @param source: where the text came from, for error messages
+    @rtype: generator(Scenario)
+    """
+    feature_tags = []
+    pending_tags = []
+    scenario = None
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        match = SCENARIO_RE.match(stripped)
+        starts_section = match or stripped.startswith(u'@') or FEATURE_RE.match(stripped) or BACKGROUND_RE.match(stripped)
+
+        if starts_section and scenario is not None:
+            scenario.steps = _dedent(scenario.steps)
+            yield scenario
+            scenario = None
+
+        if stripped.startswith(u'@'):
+            pending_tags.extend(tag[1:] for tag in stripped.split() if tag.startswith(u'@') and len(tag) > 1)
+        elif FEATURE_RE.match(stripped):
+            feature_tags = pending_tags
+            pending_tags = []
+        elif BACKGROUND_RE.match(stripped):
+            log.warning(u'skipping the background section in {}, backgrounds are not supported'.format(source))
+        elif match:
+            # the body lines are collected in steps until the scenario ends
+            scenario = Scenario(match.group(2).strip(), [], feature_tags + pending_tags, source)
+            pending_tags = []
+        elif scenario is not None:
+            scenario.steps.append(line.rstrip())
+
+    if scenario is not None:
+        scenario.steps = _dedent(scenario.steps)
+        yield scenario
+
+
+def read_features(upload, name=u''):
+    """Yields the scenarios in an uploaded .feature file or tar or zip archive
+    of them. Tar archives are read as a stream.
+
+    @param upload: a file object
+    @param name: the file name, used to tell the format if it isn't a tar or zip
+    @rtype: generator(Scenario)
+    """
+    if zipfile.is_zipfile(upload):
+        upload.seek(0)
+        for file_name, text in _read_archive(_zip_files(upload), name):
+            for scenario in parse_feature(text, file_name):
+                yield scenario
+        return
+
+    upload.seek(0)
+    try:
+        archive = tarfile.open(fileobj=upload, mode=u'r|*')
+    except ARCHIVE_ERRORS:
+        archive = None
+
+    if archive is not None:
+        for file_name, text in _read_archive(_tar_files(archive), name):
+            for scenario in parse_feature(text, file_name):
+                yield scenario
+        return
+
+    upload.seek(0)
+    try:
+        text = upload.read().decode(u'utf-8')
+    except UnicodeDecodeError:
+        raise FeatureError(u'{} is not a utf-8 .feature file or a tar or zip archive'.format(name or u'the upload'))
+    for scenario in parse_feature(text, name):
+        yield scenario
+
+
+def _zip_files(upload):
+    archive = zipfile.ZipFile(upload)
+    for info in archive.infolist():
+        if info.filename.endswith(FEATURE_EXTENSION):
+            yield info.filename, archive.read(info)
+
+
+def _tar_files(archive):
+    for member in archive:
+        if member.isfile() and member.name.endswith(FEATURE_EXTENSION):
+            yield member.name, archive.extractfile(member).read()
+
+
+def _read_archive(files, name):
+    """Yields the name and text of an archive's .feature files, raising
+    FeatureError for a damaged archive or a file that isn't utf-8.
+    """
+    while True:
+        try:
+            file_name, data = next(files)
+        except StopIteration:
+            return
+        except ARCHIVE_ERRORS as e:
+            raise FeatureError(u'{} is a damaged archive: {}'.format(name or u'the upload', e))
+        try:
+            text = data.decode(u'utf-8')
+        except UnicodeDecodeError:
+            raise FeatureError(u'{} is not a utf-8 .feature file'.format(file_name))
+        yield file_name, text
+
+
+def _batches(scenarios, size):
+    batch = []
+    for scenario in scenarios:
+        batch.append(scenario)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_features(scenarios, user, dry_run=False):
+    """Creates or updates tests from scenarios. Tests are matched by name, and
+    only updated when the hash of their steps or their tags differ.
+
+    @param scenarios: the scenarios to import, any iterable
+    @param user: the user to record on the tests and their history
+    @type user: unicode
+    @param dry_run: only count what would change
+    @type dry_run: bool
+    @return: the names of the created, updated and unchanged tests
+    @rtype: dict(unicode, list(unicode))
+    """
+    result = {u'created': [], u'updated': [], u'unchanged': []}
+
+    for batch in _batches(scenarios, get_import_batch_size()):
+        # a name given twice in a batch: the last one wins
+        by_name = OrderedDict((scenario.name, scenario) for scenario in batch)
+
+        # existing tests with the same name, the oldest one is the one that gets updated
+        existing = {}
+        for test in Test.objects.filter(name__in=by_name.keys()).order_by(u'-pk').prefetch_related(u'tags'):
+            existing[test.name] = test
+
+        created = []
+        updated = []
+        for name, scenario in by_name.items():
+            test = existing.get(name)
+            if test is None:
+                created.append(scenario)
+            elif hash_steps(test.steps) != scenario.steps_hash or set(tag.name for tag in test.tags.all()) != set(scenario.tags):
+                updated.append((test, scenario))
+            else:
+                result[u'unchanged'].append(name)
+
+        result[u'created'].extend(scenario.name for scenario in created)
+        result[u'updated'].extend(scenario.name for test, scenario in updated)
+        if dry_run or not (created or updated):
+            continue
+
+        with transaction.atomic():
+            history = []
+
+            versions = dict(
+                TestEditHistory.objects.filter(test__in=[test.pk for test, scenario in updated])
+                .values_list(u'test').annotate(count=Count(u'id')).order_by()
+            )
+            for test, scenario in updated:
+                if hash_steps(test.steps) != scenario.steps_hash:
+                    Test.objects.filter(pk=test.pk).update(steps=scenario.steps, user=user)
+                    history.append(TestEditHistory(test_id=test.pk, user=user, version=versions.get(test.pk, 0) + 1, steps=scenario.steps))
+                test.tags.set(*scenario.tags)
+
+            for scenario in created:
+                test = Test.objects.create(user=user, name=scenario.name, steps=scenario.steps)
+                if scenario.tags:
+                    test.tags.set(*scenario.tags)
+                history.append(TestEditHistory(test_id=test.pk, user=user, version=1, steps=scenario.steps))
+
+            TestEditHistory.objects.bulk_create(history)
+
+        log.info(u'imported a batch of {} scenarios: {} created, {} updated'.format(len(batch), len(created), len(updated)))
+
+    return result
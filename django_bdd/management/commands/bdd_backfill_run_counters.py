@@ -0,0 +1,17 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_bdd import runs
+
+
+class Command(BaseCommand):
+    help = u'Recounts the step counters of every run from its steps.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--batch-size', type=u'int', dest=u'batch_size', default=runs.BACKFILL_BATCH_SIZE, help=u'How many runs to recount per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        updated = runs.backfill_run_counters(batch_size=options[u'batch_size'])
+        self.stdout.write(u'updated the step counters of {} runs'.format(updated))
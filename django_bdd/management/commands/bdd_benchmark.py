@@ -0,0 +1,88 @@
+import datetime
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from django_bdd.benchmarks import data, startup, suite
+from django_bdd.screenshots import LocalScreenshotStorage, set_screenshot_storage
+
+
+def get_commit():
+    """Returns the git commit being benchmarked, if it can be found."""
+    try:
+        return subprocess.check_output([u'git', u'rev-parse', u'HEAD'], stderr=subprocess.STDOUT).strip().decode(u'utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = u'Benchmarks the views, api and notifications against synthetic data in a throwaway test database.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--scale', default=u'small', help=u'Comma separated data scales to benchmark: {}.'.format(u', '.join(sorted(data.SCALES)))),
+        make_option(u'--repeat', type=u'int', default=5, help=u'How many times to time every benchmark.'),
+        make_option(u'--benchmark', action=u'append', dest=u'benchmarks', help=u'Only run this benchmark, can be given more than once.'),
+        make_option(u'--output', help=u'Write the json results to this file instead of stdout.'),
+        make_option(u'--compare', help=u'Json results of an earlier benchmark run to compare against.'),
+        make_option(u'--startup', action=u'store_true', default=False, help=u'Also time importing the api, urls and views in fresh processes.'),
+    )
+
+    def handle(self, *args, **options):
+        scales = options[u'scale'].split(u',')
+        for scale in scales:
+            if scale not in data.SCALES:
+                raise CommandError(u'unknown scale {}'.format(scale))
+
+        results = {
+            u'commit': get_commit(),
+            u'timestamp': datetime.datetime.utcnow().isoformat(),
+            u'python': platform.python_version(),
+            u'database': connection.vendor,
+            u'scales': dict((scale, data.SCALES[scale]) for scale in scales),
+            u'results': [],
+        }
+
+        if options[u'startup']:
+            self.stderr.write(u'benchmarking startup')
+            results[u'results'].extend(startup.run_startup_benchmarks(repeat=options[u'repeat'], names=options[u'benchmarks']))
+
+        setup_test_environment()
+        screenshot_root = tempfile.mkdtemp()
+        previous_storage = set_screenshot_storage(LocalScreenshotStorage(screenshot_root))
+        try:
+            for scale in scales:
+                # every scale gets a fresh database so the sizes don't add up
+                old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                try:
+                    self.stderr.write(u'generating {} data'.format(scale))
+                    data.generate(storage=LocalScreenshotStorage(screenshot_root), **data.SCALES[scale])
+
+                    self.stderr.write(u'benchmarking {} data'.format(scale))
+                    results[u'results'].extend(suite.run_benchmarks(scale, repeat=options[u'repeat'], names=options[u'benchmarks']))
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+        finally:
+            set_screenshot_storage(previous_storage)
+            shutil.rmtree(screenshot_root, ignore_errors=True)
+            teardown_test_environment()
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options[u'output']:
+            with open(options[u'output'], u'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options[u'compare']:
+            with open(options[u'compare']) as f:
+                old = json.load(f)
+            self.stderr.write(u'compared to {}:'.format(old.get(u'commit')))
+            for row in suite.compare(old, results):
+                self.stderr.write(u'{:<8} {:<16} {:>9.1f}ms -> {:>9.1f}ms ({:+.1f}%)  queries {} -> {}'.format(*row))
@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_bdd import executor
+
+
+class Command(BaseCommand):
+    help = u'Claims queued test runs and runs them in a pool of processes, until stopped with SIGTERM or ctrl-c.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--processes', type=u'int', default=None, help=u'How many runs to run at a time, one per core by default.'),
+        make_option(u'--timeout', type=u'int', default=None, help=u'Kill runs that take longer than this many seconds.'),
+        make_option(u'--poll-interval', type=u'float', dest=u'poll_interval', default=2.0, help=u'How many seconds to wait between looking for queued runs.'),
+        make_option(u'--once', action=u'store_true', default=False, help=u'Exit once the queue is empty and the runs are done.'),
+    )
+
+    def handle(self, *args, **options):
+        pool = executor.Executor(processes=options[u'processes'], timeout=options[u'timeout'], poll_interval=options[u'poll_interval'])
+        self.stderr.write(u'running queued runs {} at a time'.format(pool.processes))
+        pool.run(once=options[u'once'])
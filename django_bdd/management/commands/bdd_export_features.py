@@ -0,0 +1,33 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_bdd import features
+from django_bdd.models import Test
+
+
+class Command(BaseCommand):
+    help = u'Exports tests as Gherkin, to a single .feature file or a tar or zip archive with a .feature file per test.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--format', default=features.FEATURE_FILE, help=u'One of {}.'.format(u', '.join(features.EXPORT_FORMATS))),
+        make_option(u'--output', help=u'File to write to, standard output if not given.'),
+        make_option(u'--tag', action=u'append', default=[], help=u'Only export tests with this tag, can be given more than once.'),
+    )
+
+    def handle(self, *args, **options):
+        if options[u'format'] not in features.EXPORT_FORMATS:
+            raise CommandError(u'unknown format {}'.format(options[u'format']))
+
+        tests = Test.objects.all()
+        for tag in set(options[u'tag']):
+            tests = tests.filter(tags__name=tag)
+
+        output = open(options[u'output'], u'wb') if options[u'output'] else sys.stdout
+        try:
+            for data in features.export_features(tests, options[u'format']):
+                output.write(data)
+        finally:
+            if output is not sys.stdout:
+                output.close()
@@ -0,0 +1,43 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_bdd import exports
+
+
+class Command(BaseCommand):
+    help = u'Exports the runs, or the steps of the runs, matching the options as csv, json lines or parquet.'
+    args = u'runs|steps'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--format', default=exports.CSV, help=u'One of {}.'.format(u', '.join(exports.EXPORT_FORMATS))),
+        make_option(u'--output', help=u'File to write to, standard output if not given.'),
+        make_option(u'--since', help=u'Only runs created on or after this date or time.'),
+        make_option(u'--until', help=u'Only runs created on or before this date, or before this time.'),
+        make_option(u'--status', action=u'append', default=[], help=u'Only runs in this status, can be given more than once.'),
+        make_option(u'--user', help=u'Only runs this user started.'),
+        make_option(u'--tag', action=u'append', default=[], help=u'Only runs of tests with this tag, can be given more than once.'),
+    )
+
+    def handle(self, *args, **options):
+        kind = args[0] if args else exports.RUNS
+        if kind not in exports.COLUMNS:
+            raise CommandError(u'export runs or steps, not {}'.format(kind))
+        if options[u'format'] not in exports.EXPORT_FORMATS:
+            raise CommandError(u'unknown format {}'.format(options[u'format']))
+
+        try:
+            since = exports.parse_time(options[u'since']) if options[u'since'] else None
+            until = exports.parse_time(options[u'until'], end=True) if options[u'until'] else None
+            runs = exports.select_history(since, until, options[u'status'], options[u'user'], options[u'tag'])
+        except ValueError as e:
+            raise CommandError(unicode(e))
+
+        output = open(options[u'output'], u'wb') if options[u'output'] else sys.stdout
+        try:
+            for data in exports.export_history(kind, runs, options[u'format'], since):
+                output.write(data)
+        finally:
+            if output is not sys.stdout:
+                output.close()
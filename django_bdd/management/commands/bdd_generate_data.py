@@ -0,0 +1,43 @@
+import os
+import tempfile
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_bdd.benchmarks import data
+from django_bdd.screenshots import LocalScreenshotStorage
+
+
+class Command(BaseCommand):
+    help = u'Generates synthetic tests, runs and steps for benchmarking. Screenshots are stored locally, never on s3.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--scale', default=u'small', help=u'Preset size to start from: {}.'.format(u', '.join(sorted(data.SCALES)))),
+        make_option(u'--tests', type=u'int', help=u'Number of tests.'),
+        make_option(u'--tags', type=u'int', help=u'Number of distinct tags.'),
+        make_option(u'--runs', type=u'int', help=u'Number of runs per test.'),
+        make_option(u'--steps', type=u'int', help=u'Number of steps per example row of a run.'),
+        make_option(u'--example-rows', type=u'int', dest=u'example_rows', help=u'Number of example rows per run.'),
+        make_option(u'--history', type=u'int', help=u'Number of edit history entries per test.'),
+        make_option(u'--screenshot-root', dest=u'screenshot_root', help=u'Where to store screenshots. Defaults to BDD_SCREENSHOT_ROOT or a temp dir.'),
+        make_option(u'--seed', type=u'int', default=0, help=u'Random seed, the same seed generates the same data.'),
+    )
+
+    def handle(self, *args, **options):
+        if options[u'scale'] not in data.SCALES:
+            raise CommandError(u'unknown scale {}'.format(options[u'scale']))
+
+        sizes = dict(data.SCALES[options[u'scale']])
+        for key in sizes:
+            if options.get(key) is not None:
+                sizes[key] = options[key]
+
+        root = options[u'screenshot_root'] or getattr(settings, u'BDD_SCREENSHOT_ROOT', None) or tempfile.mkdtemp()
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+        self.stdout.write(u'generating {} (screenshots in {})'.format(
+            u', '.join(u'{}={}'.format(key, value) for key, value in sorted(sizes.items())), root))
+        test_ids = data.generate(storage=LocalScreenshotStorage(root), seed=options[u'seed'], **sizes)
+        self.stdout.write(u'created {} tests'.format(len(test_ids)))
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_bdd import features
+
+
+class Command(BaseCommand):
+    args = u'<path path ...>'
+    help = u'Creates and updates tests from .feature files or tar or zip archives of them. Tests are matched by name.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--user', default=u'import', help=u'The user to record on created and updated tests.'),
+        make_option(u'--dry-run', action=u'store_true', dest=u'dry_run', default=False, help=u'Only report what would change.'),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError(u'give at least one .feature file or archive')
+
+        def scenarios():
+            for path in paths:
+                with open(path, u'rb') as upload:
+                    for scenario in features.read_features(upload, path):
+                        yield scenario
+
+        try:
+            result = features.import_features(scenarios(), options[u'user'], dry_run=options[u'dry_run'])
+        except (features.FeatureError, IOError) as e:
+            raise CommandError(unicode(e))
+
+        for key in (u'created', u'updated', u'unchanged'):
+            self.stdout.write(u'{} {}'.format(len(result[key]), key))
+            if key != u'unchanged':
+                for name in result[key]:
+                    self.stdout.write(u'  {}'.format(name))
@@ -0,0 +1,55 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_bdd.benchmarks import load
+
+
+class Command(BaseCommand):
+    help = (u'Load tests a running server: engine workers start runs and write steps, dashboards poll them and '
+            u'editors save tests. Run it with the settings of the server, it writes to the same database.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--url', default=u'http://127.0.0.1:8000', help=u'The server to load test.'),
+        make_option(u'--workers', type=u'int', default=4, help=u'How many engine workers start runs and write steps.'),
+        make_option(u'--pollers', type=u'int', default=8, help=u'How many dashboards poll the steps of runs and the queue.'),
+        make_option(u'--editors', type=u'int', default=1, help=u'How many users edit tests.'),
+        make_option(u'--duration', type=u'int', default=60, help=u'How many seconds to load the server for.'),
+        make_option(u'--steps', type=u'int', default=20, help=u'How many steps every run has.'),
+        make_option(u'--poll-interval', type=u'float', dest=u'poll_interval', default=1.0, help=u'How many seconds dashboards wait between polls.'),
+        make_option(u'--tests', type=u'int', default=10, help=u'How many tests to create to run and edit.'),
+        make_option(u'--keep', action=u'store_true', default=False, help=u'Keep the tests, runs and steps created.'),
+        make_option(u'--output', help=u'Write the json results to this file instead of stdout.'),
+    )
+
+    def handle(self, *args, **options):
+        self.stderr.write(u'loading {} for {} seconds'.format(options[u'url'], options[u'duration']))
+        try:
+            results = load.run_load_test(
+                options[u'url'],
+                workers=options[u'workers'],
+                pollers=options[u'pollers'],
+                editors=options[u'editors'],
+                duration=options[u'duration'],
+                steps_per_run=options[u'steps'],
+                poll_interval=options[u'poll_interval'],
+                tests=options[u'tests'],
+                keep=options[u'keep'],
+            )
+        except ValueError as e:
+            raise CommandError(unicode(e))
+
+        for result in results[u'results']:
+            self.stderr.write(u'{:<24} {:>7} req {:>4} err {:>8.1f}/s  p50 {:>8.1f}ms  p95 {:>8.1f}ms  p99 {:>8.1f}ms  locks {:>8.1f}ms'.format(
+                result[u'endpoint'], result[u'requests'], result[u'errors'], result[u'throughput'], result[u'latency_ms'][u'median'],
+                result[u'latency_ms'][u'p95'], result[u'latency_ms'][u'p99'], result[u'lock_wait_ms']))
+        if not results[u'lock_waits_sampled']:
+            self.stderr.write(u'lock waits are only sampled with postgresql')
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options[u'output']:
+            with open(options[u'output'], u'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
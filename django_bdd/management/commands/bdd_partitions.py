@@ -0,0 +1,75 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from django_bdd import partitions
+
+
+class Command(BaseCommand):
+    help = u'Creates upcoming monthly partitions of the run and step tables and detaches old ones (PostgreSQL only).'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--convert', action=u'store_true', default=False, help=u'Turn the plain tables into partitioned ones first, only needed once.'),
+        make_option(u'--months-ahead', type=u'int', dest=u'months_ahead', default=3, help=u'How many months of partitions to create past the current one.'),
+        make_option(u'--detach-older-than', type=u'int', dest=u'detach_older_than', help=u'Detach partitions that ended more than this many months ago.'),
+        make_option(u'--drop', action=u'store_true', default=False, help=u'Drop the detached partitions instead of keeping them as plain tables.'),
+        make_option(u'--dry-run', action=u'store_true', dest=u'dry_run', default=False, help=u'Print the sql instead of running it.'),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != u'postgresql':
+            raise CommandError(u'partitioning needs postgresql, the database is {}'.format(connection.vendor))
+        if options[u'convert'] and options[u'detach_older_than'] is not None:
+            raise CommandError(u'convert the tables before detaching partitions from them')
+
+        with transaction.atomic():
+            statements = self.get_statements(options)
+            if options[u'dry_run']:
+                for statement in statements:
+                    self.stdout.write(statement + u';')
+                return
+
+            # a conversion that fails halfway is rolled back, the tables are left as they were
+            cursor = connection.cursor()
+            for statement in statements:
+                self.stdout.write(statement)
+                cursor.execute(statement)
+
+        # run ids moved between partitions, the bounds used for pruning are stale
+        partitions.refresh_partition_bounds()
+
+    def get_statements(self, options):
+        statements = []
+        today = datetime.date.today()
+
+        # where the monthly partitions of each table start
+        first_months = {}
+        if options[u'convert']:
+            cursor = connection.cursor()
+            for table, column in partitions.TABLES:
+                if not options[u'dry_run']:
+                    # no rows can be written past the legacy partition's end while converting
+                    cursor.execute(u'LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(table))
+                legacy_end = partitions.get_legacy_end(table, column, today)
+                statements.extend(partitions.get_conversion_sql(table, column, legacy_end))
+                first_months[table] = legacy_end
+
+        for table, column in partitions.TABLES:
+            for months in range(options[u'months_ahead'] + 1):
+                month = partitions.month_start(today, months)
+                # the legacy partition covers the months up to its end
+                if month >= first_months.get(table, month):
+                    statements.append(partitions.get_create_partition_sql(table, month))
+
+        if options[u'detach_older_than'] is not None:
+            cutoff = partitions.month_start(today, -options[u'detach_older_than'])
+            for table, column in partitions.TABLES:
+                for name, end in partitions.get_partitions(table):
+                    if end <= cutoff:
+                        statements.append(u'ALTER TABLE {} DETACH PARTITION {}'.format(table, name))
+                        if options[u'drop']:
+                            statements.append(u'DROP TABLE {}'.format(name))
+
+        return statements
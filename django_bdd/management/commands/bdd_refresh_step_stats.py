@@ -0,0 +1,18 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_bdd import steps
+
+
+class Command(BaseCommand):
+    help = u'Aggregates the steps of the runs that finished since the last refresh into the step definition report.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--max-runs', type=u'int', dest=u'max_runs', default=None, help=u'Stop after aggregating this many runs.'),
+    )
+
+    def handle(self, *args, **options):
+        result = steps.refresh_step_stats(max_runs=options[u'max_runs'])
+        self.stdout.write(u'aggregated {} steps of {} runs, up to run {}'.format(
+            result[u'steps'], result[u'runs'], steps.get_refresh_cursor()))
@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_bdd import runs
+
+
+class Command(BaseCommand):
+    help = u'Marks running test runs that stopped saving steps as errors. Run it every few minutes, from cron for example.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(u'--minutes', type=u'int', default=None, help=u'How long a run may go without saving a step, BDD_STUCK_RUN_MINUTES by default.'),
+        make_option(u'--dry-run', action=u'store_true', dest=u'dry_run', default=False, help=u'Only list the stuck runs.'),
+    )
+
+    def handle(self, *args, **options):
+        if options[u'dry_run']:
+            for run in runs.find_stuck_runs(options[u'minutes']):
+                self.stdout.write(u'run {} made no progress since {}'.format(run.id, run.last_progress))
+            return
+
+        for run_id in runs.mark_stuck_runs(options[u'minutes']):
+            self.stdout.write(u'marked run {} as an error'.format(run_id))
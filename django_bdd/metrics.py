@@ -0,0 +1,246 @@
+"""
+Performance metrics for views and api actions.
+
+MetricsMiddleware times every request and breaks the time down into database,
+s3 url signing, template rendering and step introspection time. Code that does
+any of those wraps it in timer() so the time is added to the current request.
+At the end of a request every measurement is sent to the configured sinks.
+
+settings.BDD_METRICS_SINKS lists the sinks to use, either by name or by dotted
+path to a class taking no arguments (default [u'memory']):
+    u'memory' - aggregates histograms in process, served by the bdd-metrics view
+    u'statsd' - sends timers to BDD_STATSD_HOST:BDD_STATSD_PORT over udp
+    u'cloudwatch' - puts metrics in CLOUDWATCH_NAMESPACE through S3Util
+"""
+import bisect
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.template.base import Template
+from django.utils.module_loading import import_by_path
+
+# upper bounds of the histogram buckets, milliseconds for timers and plain
+# numbers for counts like db queries
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+
+# names of the measurements taken for every request
+WALL_TIME = u'wall_ms'
+DB_QUERIES = u'db_queries'
+DB_TIME = u'db_ms'
+S3_SIGN_TIME = u's3_sign_ms'
+TEMPLATE_TIME = u'template_ms'
+STEP_INTROSPECTION_TIME = u'step_introspection_ms'
+
+log = logging.getLogger(u'django-bdd')
+
+# the measurements of the request being handled by this thread
+_local = threading.local()
+
+
+class Histogram(object):
+    """Counts values into HISTOGRAM_BUCKETS so percentiles can be estimated
+    without keeping every value around.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket the percentile falls in."""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return HISTOGRAM_BUCKETS[i] if i < len(HISTOGRAM_BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            u'count': self.count,
+            u'sum': self.total,
+            u'mean': self.total / self.count if self.count else None,
+            u'min': self.min,
+            u'max': self.max,
+            u'p50': self.percentile(50),
+            u'p95': self.percentile(95),
+            u'p99': self.percentile(99),
+            u'buckets': dict(zip([unicode(b) for b in HISTOGRAM_BUCKETS] + [u'inf'], self.buckets)),
+        }
+
+
+class InMemorySink(object):
+    """Keeps a histogram per metric and view in this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def record(self, name, value, view):
+        with self.lock:
+            key = (name, view)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].add(value)
+
+    def snapshot(self):
+        """Returns {view: {metric: histogram dict}}."""
+        with self.lock:
+            result = {}
+            for (name, view), histogram in self.histograms.items():
+                result.setdefault(view, {})[name] = histogram.to_dict()
+            return result
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+
+class StatsdSink(object):
+    """Sends every measurement to statsd as a timer, named bdd.<view>.<metric>."""
+
+    def __init__(self):
+        self.address = (getattr(settings, u'BDD_STATSD_HOST', u'localhost'), getattr(settings, u'BDD_STATSD_PORT', 8125))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, name, value, view):
+        packet = u'bdd.{}.{}:{:.3f}|ms'.format(view.replace(u'.', u'_').replace(u' ', u'.'), name, value)
+        try:
+            self.socket.sendto(packet.encode(u'utf-8'), self.address)
+        except socket.error as e:
+            log.debug(u'unable to send metric to statsd: {}'.format(unicode(e)))
+
+
+class CloudWatchSink(object):
+    """Puts every measurement in cloudwatch with the view as a dimension. This
+    makes an api call per measurement, so it's only meant for low traffic.
+    """
+
+    def __init__(self):
+        from s3util.s3util import S3Util
+        self.s3_util = S3Util(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_ACCESS_KEY, cloudwatch_namespace=settings.CLOUDWATCH_NAMESPACE)
+
+    def record(self, name, value, view):
+        self.s3_util.put_metric(name, value, dimensions={u'view': view})
+
+
+SINKS = {
+    u'memory': InMemorySink,
+    u'statsd': StatsdSink,
+    u'cloudwatch': CloudWatchSink,
+}
+
+_sinks = None
+
+
+def get_sinks():
+    """Returns the sinks configured with BDD_METRICS_SINKS."""
+    global _sinks
+    if _sinks is None:
+        sinks = []
+        for name in getattr(settings, u'BDD_METRICS_SINKS', [u'memory']):
+            sink_class = SINKS[name] if name in SINKS else import_by_path(name)
+            sinks.append(sink_class())
+        _sinks = sinks
+    return _sinks
+
+
+def get_memory_sink():
+    """Returns the in memory sink, if one is configured."""
+    for sink in get_sinks():
+        if isinstance(sink, InMemorySink):
+            return sink
+    return None
+
+
+def start_request():
+    """Starts collecting measurements for the request handled by this thread."""
+    _local.timings = {}
+    _local.active = set()
+
+
+def finish_request():
+    """Stops collecting and returns the measurements of the current request."""
+    timings = getattr(_local, u'timings', None) or {}
+    _local.timings = None
+    return timings
+
+
+@contextmanager
+def timer(name):
+    """Adds the time spent in the block to the current request's measurement
+    with the given name. Nested timers with the same name only count once, and
+    outside a request this does nothing.
+    """
+    timings = getattr(_local, u'timings', None)
+    if timings is None or name in _local.active:
+        yield
+        return
+
+    _local.active.add(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + (time.time() - start) * 1000.0
+        _local.active.discard(name)
+
+
+def record(view, timings):
+    """Sends a request's measurements to every sink."""
+    for sink in get_sinks():
+        for name, value in timings.items():
+            try:
+                sink.record(name, value, view)
+            except Exception as e:
+                log.error(u'unable to record metric {} with {}: {}'.format(name, sink, unicode(e)))
+
+
+_templates_instrumented = False
+
+
+def instrument_templates():
+    """Wraps Template.render so template rendering time gets measured. Views
+    render through django.shortcuts.render, so there's no other hook for it.
+    """
+    global _templates_instrumented
+    if _templates_instrumented:
+        return
+    _templates_instrumented = True
+
+    render = Template.render
+
+    def timed_render(self, context):
+        with timer(TEMPLATE_TIME):
+            return render(self, context)
+    Template.render = timed_render
+
+
+def count_queries():
+    """Returns the number of queries and the time spent on them so far in
+    this request, over every database connection.
+    """
+    count = 0
+    seconds = 0.0
+    for connection in connections.all():
+        count += len(connection.queries)
+        seconds += sum(float(query[u'time']) for query in connection.queries)
+    return count, seconds * 1000.0
@@ -0,0 +1,80 @@
+import time
+
+from django.core.cache import cache
+from django.db import connections
+
+from django_bdd import metrics, routers
+
+
+class MetricsMiddleware(object):
+    """Measures wall, database, s3 url signing, template and step
+    introspection time for every view and api action, and sends them to the
+    sinks in BDD_METRICS_SINKS. Add it to MIDDLEWARE_CLASSES to turn it on.
+    """
+
+    def __init__(self):
+        metrics.instrument_templates()
+
+    def process_request(self, request):
+        # queries are only recorded with the debug cursor on
+        request._bdd_debug_cursors = [(connection, connection.use_debug_cursor) for connection in connections.all()]
+        for connection in connections.all():
+            connection.use_debug_cursor = True
+
+        request._bdd_queries = metrics.count_queries()
+        request._bdd_start = time.time()
+        metrics.start_request()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # url names tell api actions apart too, like runs-list and runs-detail
+        match = getattr(request, u'resolver_match', None)
+        request._bdd_view = (match and match.url_name) or view_func.__name__
+
+    def process_response(self, request, response):
+        if not hasattr(request, u'_bdd_start'):
+            return response
+
+        timings = metrics.finish_request()
+        timings[metrics.WALL_TIME] = (time.time() - request._bdd_start) * 1000.0
+
+        queries, query_time = metrics.count_queries()
+        timings[metrics.DB_QUERIES] = queries - request._bdd_queries[0]
+        timings[metrics.DB_TIME] = query_time - request._bdd_queries[1]
+
+        for connection, use_debug_cursor in request._bdd_debug_cursors:
+            connection.use_debug_cursor = use_debug_cursor
+
+        view = u'{} {}'.format(request.method, getattr(request, u'_bdd_view', u'unresolved'))
+        metrics.record(view, timings)
+        return response
+
+
+class ReplicaMiddleware(object):
+    """Lets ReplicaRouter send the reads of read-only views to the replica,
+    and keeps a user on the primary for a while after they write anything,
+    with a cookie or, for clients without cookies, a flag in the cache.
+    """
+
+    def process_request(self, request):
+        routers.start_request()
+        if request.method not in (u'GET', u'HEAD'):
+            routers.pin_to_primary()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if routers.is_pinned() or routers.PRIMARY_COOKIE in request.COOKIES or routers.PRIMARY_HEADER in request.META:
+            return None
+        match = getattr(request, u'resolver_match', None)
+        if not (match and match.url_name in routers.get_replica_views()):
+            return None
+        # clients without cookies, like the engine, are pinned in the cache
+        if not request.COOKIES and cache.get(routers.get_primary_cache_key(request)):
+            return None
+        routers.use_replica()
+
+    def process_response(self, request, response):
+        if routers.is_pinned():
+            response.set_cookie(routers.PRIMARY_COOKIE, u'1', max_age=routers.get_sticky_seconds(), httponly=True)
+            if not request.COOKIES:
+                cache.set(routers.get_primary_cache_key(request), True, routers.get_sticky_seconds())
+        routers.reset()
+        return response
@@ -1,6 +1,20 @@
-from django.db import models
+import logging
+import threading
+
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from taggit.managers import TaggableManager
 
+from django_bdd.partitions import prune_runs
+
+log = logging.getLogger(u'django-bdd')
+
+# the runs this thread is deleting, their steps don't update their counters
+_deleting = threading.local()
+
 
 # statuses
 NEW = 'new'
@@ -9,15 +23,40 @@ PASSED = 'passed'
 FAILED = 'failed'
 ERROR = 'error'
 SKIPPED = 'skipped'
+CANCELLED = 'cancelled'
 STATUS_CHOICES = (
     (NEW, 'New'),
     (RUNNING, 'Running'),
     (PASSED, 'Passed'),
     (FAILED, 'Failed'),
     (ERROR, 'Error'),
-    (SKIPPED, 'Skipped')
+    (SKIPPED, 'Skipped'),
+    (CANCELLED, 'Cancelled')
 )
 
+# runs in these statuses are done, their steps and report don't change anymore
+FINISHED_STATUSES = (PASSED, FAILED, ERROR, SKIPPED, CANCELLED)
+
+# runs in these statuses are queued or in progress, and can be cancelled
+QUEUED_STATUSES = (NEW, RUNNING)
+
+# the TestRun counter of the steps in each finished status
+STEP_COUNTERS = {
+    PASSED: u'passed_steps',
+    FAILED: u'failed_steps',
+    SKIPPED: u'skipped_steps',
+    ERROR: u'error_steps',
+}
+
+# the SuiteRun counter of the runs in each finished status
+RUN_COUNTERS = {
+    PASSED: u'passed_runs',
+    FAILED: u'failed_runs',
+    SKIPPED: u'skipped_runs',
+    ERROR: u'error_runs',
+    CANCELLED: u'cancelled_runs',
+}
+
 
 # Model Docs: https://docs.djangoproject.com/en/1.6/topics/db/models/
 
@@ -52,18 +91,222 @@ class Test(models.Model):
         )
 
 
+class SuiteRun(models.Model):
+    """
+    model for a group of runs started together, like a regression suite
+
+    the counters are kept up to date as the runs finish, so a suite's progress
+    and status are one row, however many runs it has
+    """
+    user = models.CharField(max_length=254, db_index=True, help_text='The user who started the suite.')
+    name = models.CharField(max_length=600, blank=True, help_text='The name of the suite.')
+    tagged = models.CharField(max_length=600, blank=True, help_text='The tags the tests were selected by, joined with +, if any.')
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True, help_text='The time the suite was started.')
+    timestamp_end = models.DateTimeField(null=True, blank=True, help_text='The time the last run of the suite finished.')
+    status = models.CharField(max_length=60, choices=STATUS_CHOICES, default=RUNNING, db_index=True, help_text='The aggregate status of the runs.')
+    notify = models.BooleanField(default=False, help_text='Whether the user gets one email when the suite finishes instead of one per run.')
+
+    # run counters, see TestRun.update_suite_counters
+    run_count = models.IntegerField(default=0, help_text='How many runs the suite has.')
+    finished_runs = models.IntegerField(default=0, help_text='How many of the runs finished.')
+    passed_runs = models.IntegerField(default=0, help_text='How many of the runs passed.')
+    failed_runs = models.IntegerField(default=0, help_text='How many of the runs failed.')
+    skipped_runs = models.IntegerField(default=0, help_text='How many of the runs were skipped.')
+    error_runs = models.IntegerField(default=0, help_text='How many of the runs errored.')
+    cancelled_runs = models.IntegerField(default=0, help_text='How many of the runs were cancelled.')
+    duration = models.FloatField(default=0.0, help_text='How long the finished runs took in total.')
+
+    class Meta:
+        db_table = u'scenario_suite_runs'
+
+    def __unicode__(self):
+        return u'{} - "{}" - {}'.format(
+            self.id,
+            self.name,
+            self.status
+        )
+
+    def get_status(self):
+        """Returns the status of the suite from its counters, the same way a
+        sharded run's status comes from its shards."""
+        if self.finished_runs < self.run_count:
+            return RUNNING
+        elif self.cancelled_runs:
+            return CANCELLED
+        elif self.error_runs:
+            return ERROR
+        elif self.failed_runs:
+            return FAILED
+        elif self.skipped_runs == self.run_count:
+            return SKIPPED
+        return PASSED
+
+    def finish(self):
+        """Sets the suite's status once every run finished.
+
+        @return: whether the suite was finished by this call, only one of the
+            runs finishing at the same time gets to
+        @rtype: bool
+        """
+        status = self.get_status()
+        if status == RUNNING:
+            return False
+        now = timezone.now()
+        if not SuiteRun.objects.filter(id=self.id, status=RUNNING).update(status=status, timestamp_end=now):
+            return False
+        self.status = status
+        self.timestamp_end = now
+        return True
+
+    def send_notification(self):
+        """Emails the user the results of the finished suite, if it was
+        started with notify. Call it outside of transactions, it talks to
+        the mail server."""
+        if not self.notify:
+            return
+        try:
+            from django_bdd.notifications import notify_suite
+            notify_suite(self)
+        except Exception:
+            log.exception(u'unable to send the results of suite {}'.format(self.id))
+
+    @property
+    def queued_runs(self):
+        return self.run_count - self.finished_runs
+
+    def get_progress(self):
+        """Returns the percentage of each kind of run, for progress bars.
+
+        @rtype: dict
+        """
+        total = float(self.run_count) or 1.0
+        progress = dict((field, 100.0 * getattr(self, field) / total) for field in RUN_COUNTERS.values())
+        progress[u'finished'] = 100.0 * self.finished_runs / total
+        return progress
+
+
 class TestRun(models.Model):
     test = models.ForeignKey(Test, on_delete=models.CASCADE, help_text='The test this test run is associated with.')
-    user = models.CharField(max_length=254, help_text='The user who created the test run.')
+    user = models.CharField(max_length=254, db_index=True, help_text='The user who created the test run.')
     example_text = models.TextField(blank=True, help_text='The Behave Example: text to run the test with, if any.')
-    timestamp = models.DateTimeField(null=True, blank=True, auto_now_add=True, help_text='The time the test run was created.')
-    status = models.CharField(max_length=60, choices=STATUS_CHOICES, default=NEW, help_text='The current status of the test run.')
+    timestamp = models.DateTimeField(null=True, blank=True, auto_now_add=True, db_index=True, help_text='The time the test run was created.')
+    status = models.CharField(max_length=60, choices=STATUS_CHOICES, default=NEW, db_index=True, help_text='The current status of the test run.')
     text = models.TextField(blank=True, help_text='The report from Behave on what happened during the test.')
     duration = models.FloatField(default=0.0, help_text='How long the test took.')
+    steps_hash = models.CharField(max_length=40, blank=True, db_index=True, help_text='The sha1 of the test steps the run was created with.')
+
+    # scenario outlines can be split into shards, child runs that each run a slice of the example table
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='shards', on_delete=models.CASCADE, help_text='The run this run is a shard of, if any.')
+    shard_count = models.IntegerField(default=0, help_text='How many shards this run was split into, 0 if it was not split.')
+    shard_row_offset = models.IntegerField(default=0, help_text='How many example rows come before this shard in the parent run.')
+
+    # big example tables are uploaded as a dataset and stored in chunks, example_text then only has the header row
+    example_row_count = models.IntegerField(default=0, help_text='How many uploaded example rows the run has, 0 if its rows are in example_text.')
+
+    # step counters, kept up to date as steps are saved so progress can be shown without querying the steps
+    # a sharded run counts the steps of all its shards
+    step_count = models.IntegerField(default=0, help_text='How many steps the run has so far.')
+    passed_steps = models.IntegerField(default=0, help_text='How many of the steps passed.')
+    failed_steps = models.IntegerField(default=0, help_text='How many of the steps failed.')
+    skipped_steps = models.IntegerField(default=0, help_text='How many of the steps were skipped.')
+    error_steps = models.IntegerField(default=0, help_text='How many of the steps errored.')
+    current_step = models.IntegerField(default=0, help_text='The number of the step saved last, 0 before the first one.')
+
+    # the watchdog marks running runs that stop progressing as errors
+    last_progress = models.DateTimeField(null=True, blank=True, help_text='The time the run started running or last saved a step.')
+
+    # only the runs the suite started are in it, not their shards
+    suite = models.ForeignKey(SuiteRun, null=True, blank=True, related_name='runs', on_delete=models.SET_NULL, help_text='The suite the run was started in, if any.')
+    counted_status = models.CharField(max_length=60, blank=True, help_text='The status the run is counted with in its suite.')
+    counted_duration = models.FloatField(default=0.0, help_text='The duration the run is counted with in its suite.')
 
     class Meta:
         db_table = u'scenario_runs'
 
+    def save(self, *args, **kwargs):
+        # a run starts progressing once it's claimed, however long it was queued
+        if self.status == RUNNING and self._saved_status != RUNNING and not self.shard_count:
+            self.last_progress = timezone.now()
+            if kwargs.get(u'update_fields') is not None:
+                kwargs[u'update_fields'] = list(kwargs[u'update_fields']) + [u'last_progress']
+        if not self.suite_id:
+            super(TestRun, self).save(*args, **kwargs)
+        else:
+            # the suite's counters change in the same transaction as the run
+            with transaction.atomic():
+                counted = self.swap_counted()
+                super(TestRun, self).save(*args, **kwargs)
+                finished_suite = self.update_suite_counters(*counted)
+            # the email waits until the counters are committed and their rows unlocked
+            if finished_suite is not None:
+                finished_suite.send_notification()
+        self._saved_status = self.status
+
+    def swap_counted(self):
+        """Records that the run is counted with its status and duration in
+        its suite, and returns what it was counted with before.
+
+        The cancel and finish helpers write the status with conditional
+        updates of their own before saving, so the run's status doesn't tell
+        what was counted. The row is locked until the save commits, so saves
+        of the same run from objects loaded at different times, like the
+        engine finishing a run that was cancelled meanwhile, each move the
+        counters from what the save before them counted.
+
+        @return: the status the run was counted with, None if it wasn't, and
+            the duration
+        @rtype: (unicode or None, float)
+        """
+        # only finished runs count their duration
+        duration = self.duration if self.status in FINISHED_STATUSES else 0.0
+        counted = None, 0.0
+        if self.pk is not None:
+            runs = prune_runs(TestRun.objects.filter(id=self.pk), self.pk)
+            counted = runs.select_for_update().values_list(u'counted_status', u'counted_duration').first() or counted
+            if counted != (self.status, duration):
+                runs.update(counted_status=self.status, counted_duration=duration)
+        # saved along with the rest of the run, it mustn't overwrite the update with a stale value
+        self.counted_status = self.status
+        self.counted_duration = duration
+        return counted[0] or None, counted[1]
+
+    def update_suite_counters(self, old_status, old_duration):
+        """Moves this run from the suite counter of the status it was counted
+        with to the one of its status, and finishes the suite with its last
+        run.
+
+        @param old_status: the status the run was counted with, None if it wasn't
+        @param old_duration: the duration the run was counted with
+        @type old_duration: float
+        @return: the suite if this finished it, None otherwise
+        @rtype: SuiteRun or None
+        """
+        duration = self.counted_duration
+        if (old_status, old_duration) == (self.status, duration):
+            return None
+
+        changes = {}
+        if duration != old_duration:
+            changes[u'duration'] = F(u'duration') + (duration - old_duration)
+        if self.status in FINISHED_STATUSES and old_status not in FINISHED_STATUSES:
+            changes[u'finished_runs'] = F(u'finished_runs') + 1
+        elif old_status in FINISHED_STATUSES and self.status not in FINISHED_STATUSES:
+            changes[u'finished_runs'] = F(u'finished_runs') - 1
+        if old_status != self.status:
+            if old_status in RUN_COUNTERS:
+                changes[RUN_COUNTERS[old_status]] = F(RUN_COUNTERS[old_status]) - 1
+            if self.status in RUN_COUNTERS:
+                changes[RUN_COUNTERS[self.status]] = F(RUN_COUNTERS[self.status]) + 1
+        if not changes:
+            return None
+
+        SuiteRun.objects.filter(id=self.suite_id).update(**changes)
+        if self.status in FINISHED_STATUSES:
+            suite = SuiteRun.objects.get(id=self.suite_id)
+            if suite.status == RUNNING and suite.finish():
+                return suite
+        return None
+
     def __unicode__(self):
         return u'%s - "%s" - %s' % (
             self.id,
@@ -71,6 +314,55 @@ class TestRun(models.Model):
             self.status
         )
 
+    def update_from_shards(self):
+        """Aggregates the status, duration and report of this run's shards.
+
+        The parent run is never NEW, so the engine doesn't pick up the whole
+        example table, it stays RUNNING until every shard is done.
+        """
+        shards = list(self.shards.order_by(u'shard_row_offset').values_list(u'status', u'duration', u'text'))
+        if not shards:
+            return
+
+        statuses = set(status for status, duration, text in shards)
+        if statuses & set(QUEUED_STATUSES):
+            status = RUNNING
+        elif CANCELLED in statuses:
+            # the rest of the shards were cancelled along with it
+            status = CANCELLED
+        elif ERROR in statuses:
+            status = ERROR
+        elif FAILED in statuses:
+            status = FAILED
+        elif statuses == set([SKIPPED]):
+            status = SKIPPED
+        else:
+            status = PASSED
+
+        # the shards run side by side, so the run took as long as the slowest one
+        duration = max(duration for status, duration, text in shards)
+        text = u'\n'.join(text for status, duration, text in shards if text)
+
+        if (status, duration, text) != (self.status, self.duration, self.text):
+            self.status = status
+            self.duration = duration
+            self.text = text
+            self.save(update_fields=[u'status', u'duration', u'text'])
+
+    @property
+    def finished_steps(self):
+        return self.passed_steps + self.failed_steps + self.skipped_steps + self.error_steps
+
+    def get_progress(self):
+        """Returns the percentage of each kind of step, for progress bars.
+
+        @rtype: dict
+        """
+        total = float(self.step_count) or 1.0
+        progress = dict((field, 100.0 * getattr(self, field) / total) for field in STEP_COUNTERS.values())
+        progress[u'finished'] = 100.0 * self.finished_steps / total
+        return progress
+
 
 class TestRunStep(models.Model):
     """
@@ -80,7 +372,7 @@ class TestRunStep(models.Model):
     num = models.IntegerField(help_text='The order of the step in the test run.')
     example_row_num = models.IntegerField(default=1, help_text='The test permutation row number in the Behave example table.')
     text = models.TextField(blank=True, help_text='The step text.')
-    status = models.CharField(max_length=60, choices=STATUS_CHOICES, default=NEW, help_text='The status of this particular step in a run.')
+    status = models.CharField(max_length=60, choices=STATUS_CHOICES, default=NEW, db_index=True, help_text='The status of this particular step in a run.')
     timestamp_start = models.DateTimeField(null=True, blank=True, auto_now_add=True, help_text='The time the step began to run')
     timestamp_end = models.DateTimeField(null=True, blank=True, help_text='The time the step implementation completed.')
     duration = models.FloatField(default=0.0, help_text='How long the step took.')
@@ -89,6 +381,44 @@ class TestRunStep(models.Model):
     class Meta:
         db_table = u'scenario_run_steps'
 
+    def save(self, *args, **kwargs):
+        # the run's counters change in the same transaction as the step
+        counted_status = getattr(self, u'_counted_status', None)
+        with transaction.atomic():
+            super(TestRunStep, self).save(*args, **kwargs)
+            self.update_run_counters(counted_status, self.status, created=counted_status is None)
+        self._counted_status = self.status
+
+    def update_run_counters(self, old_status, new_status, created=False, deleted=False):
+        """Moves this step from the counter of its old status to the one of
+        its new status, on its run and the run that's sharded into it.
+
+        @param old_status: the status the step was counted with, None if it wasn't
+        @param new_status: the status to count the step with, None to stop counting it
+        """
+        changes = {}
+        if created:
+            changes[u'step_count'] = F(u'step_count') + 1
+        elif deleted:
+            changes[u'step_count'] = F(u'step_count') - 1
+        if old_status != new_status:
+            if old_status in STEP_COUNTERS:
+                changes[STEP_COUNTERS[old_status]] = F(STEP_COUNTERS[old_status]) - 1
+            if new_status in STEP_COUNTERS:
+                changes[STEP_COUNTERS[new_status]] = F(STEP_COUNTERS[new_status]) + 1
+
+        run_changes = dict(changes)
+        if not deleted:
+            run_changes[u'current_step'] = self.num
+            run_changes[u'last_progress'] = timezone.now()
+        if not run_changes:
+            return
+
+        # narrowed down to the run's partition, the step belongs to one run
+        prune_runs(TestRun.objects.filter(id=self.run_id), self.run_id).update(**run_changes)
+        if changes:
+            TestRun.objects.filter(shards=self.run_id).update(**changes)
+
     def __unicode__(self):
         return u'{} - {} - {} - {} - {}'.format(
             self.id,
@@ -99,12 +429,34 @@ class TestRunStep(models.Model):
         )
 
 
+class TestRunExampleChunk(models.Model):
+    """
+    model for a chunk of the example rows uploaded for a test run
+    """
+    run = models.ForeignKey(TestRun, on_delete=models.CASCADE, help_text='The run these example rows are for.')
+    first_row = models.IntegerField(help_text='The example row number of the first row in the chunk, starting at 1.')
+    row_count = models.IntegerField(help_text='How many rows the chunk has.')
+    rows = models.TextField(help_text='The rows as a json list of lists of values, in the order of the run\'s header row.')
+
+    class Meta:
+        db_table = u'scenario_run_example_chunks'
+        index_together = [(u'run', u'first_row')]
+
+    def __unicode__(self):
+        return u'{} - run {} - rows {}-{}'.format(
+            self.id,
+            self.run_id,
+            self.first_row,
+            self.first_row + self.row_count - 1
+        )
+
+
 class TestEditHistory(models.Model):
     """
     model for test scenario edit history
     """
     test = models.ForeignKey(Test, help_text='The test this test version is associated with.')
-    user = models.CharField(max_length=254, help_text='The user who created (or edited) the test case.')
+    user = models.CharField(max_length=254, db_index=True, help_text='The user who created (or edited) the test case.')
     timestamp = models.DateTimeField(null=True, blank=True, auto_now_add=True, help_text='The time the test was edited.')
     version = models.IntegerField(default=1, help_text='The version number of the test history entry.')
     steps = models.TextField(blank=True, help_text='The step text for this version of the test.')
@@ -119,3 +471,124 @@ class TestEditHistory(models.Model):
             self.user,
             self.version
         )
+
+
+class StepStats(models.Model):
+    """
+    model for the aggregated timing and failures of a step definition across runs
+    """
+    definition = models.TextField(help_text='The step definition, blank for steps that match no definition.')
+    definition_hash = models.CharField(max_length=40, unique=True, help_text='The sha1 of the step definition.')
+    count = models.IntegerField(default=0, help_text='How many times steps matching the definition ran.')
+    failures = models.IntegerField(default=0, help_text='How many of those steps failed or errored.')
+    total_duration = models.FloatField(default=0.0, help_text='The total time spent in the definition.')
+    min_duration = models.FloatField(null=True, blank=True, help_text='The shortest time a step took.')
+    max_duration = models.FloatField(null=True, blank=True, help_text='The longest time a step took.')
+    buckets = models.TextField(blank=True, help_text='Json list of step counts per duration histogram bucket.')
+
+    class Meta:
+        db_table = u'scenario_step_stats'
+
+    def __unicode__(self):
+        return u'{} - "{}" - {}'.format(
+            self.id,
+            self.definition,
+            self.count
+        )
+
+
+class StepStatsRefresh(models.Model):
+    """
+    model for a refresh of the step stats, the latest one says where the next one starts
+    """
+    timestamp = models.DateTimeField(auto_now_add=True, help_text='The time of the refresh.')
+    last_run_id = models.IntegerField(help_text='Every run up to this id has been aggregated.')
+    runs = models.IntegerField(default=0, help_text='How many runs were aggregated.')
+    steps = models.IntegerField(default=0, help_text='How many steps were aggregated.')
+
+    class Meta:
+        db_table = u'scenario_step_stats_refreshes'
+
+    def __unicode__(self):
+        return u'{} - up to run {}'.format(
+            self.id,
+            self.last_run_id
+        )
+
+
+@receiver(post_save, sender=TestRun)
+def update_parent_run(sender, instance, **kwargs):
+    """Keeps a sharded run's aggregate status up to date as its shards are saved."""
+    if instance.parent_id:
+        instance.parent.update_from_shards()
+
+
+@receiver(post_delete, sender=TestRun)
+def uncount_suite_run(sender, instance, **kwargs):
+    """Takes a deleted run out of its suite's counters, the suite can
+    finish without it."""
+    if not instance.suite_id:
+        return
+
+    changes = {u'run_count': F(u'run_count') - 1}
+    if instance.counted_status in FINISHED_STATUSES:
+        changes[u'finished_runs'] = F(u'finished_runs') - 1
+        changes[u'duration'] = F(u'duration') - instance.counted_duration
+        changes[RUN_COUNTERS[instance.counted_status]] = F(RUN_COUNTERS[instance.counted_status]) - 1
+    with transaction.atomic():
+        SuiteRun.objects.filter(id=instance.suite_id).update(**changes)
+        suite = SuiteRun.objects.filter(id=instance.suite_id, status=RUNNING).first()
+        finished = suite is not None and suite.finish()
+    if finished:
+        suite.send_notification()
+
+
+@receiver(post_init, sender=TestRun)
+def remember_saved_status(sender, instance, **kwargs):
+    # the status the run was loaded or last saved with, None until it's saved
+    instance._saved_status = instance.status if instance.pk else None
+
+
+@receiver(post_init, sender=TestRunStep)
+def remember_counted_status(sender, instance, **kwargs):
+    # the status the step is counted with on its run, None until it's saved
+    instance._counted_status = instance.status if instance.pk else None
+
+
+def _get_deleting_runs():
+    if not hasattr(_deleting, u'runs'):
+        _deleting.runs = set()
+    return _deleting.runs
+
+
+@receiver(pre_delete, sender=TestRun)
+def start_deleting_run(sender, instance, using, **kwargs):
+    # every pre_delete of a delete is sent before its first post_delete, so the steps see all the runs deleted with them
+    _get_deleting_runs().add((using, instance.pk))
+    if instance.parent_id:
+        # the counters move in the database, the object's may be stale
+        fields = [u'step_count'] + list(STEP_COUNTERS.values())
+        instance._step_counters = TestRun.objects.using(using).filter(id=instance.pk).values(*fields).first()
+
+
+@receiver(post_delete, sender=TestRun)
+def finish_deleting_run(sender, instance, using, **kwargs):
+    deleting = _get_deleting_runs()
+    deleting.discard((using, instance.pk))
+    # a shard's steps were deleted without a word to the run sharded into them
+    counters = getattr(instance, u'_step_counters', None)
+    if counters and (using, instance.parent_id) not in deleting:
+        changes = dict((field, F(field) - value) for field, value in counters.items())
+        TestRun.objects.using(using).filter(id=instance.parent_id).update(**changes)
+
+
+@receiver(post_delete, sender=TestRunStep)
+def uncount_step(sender, instance, using, **kwargs):
+    # a run being deleted isn't recounted step by step
+    if (using, instance.run_id) not in _get_deleting_runs():
+        instance.update_run_counters(instance._counted_status, None, deleted=True)
+
+
+# connect the tag cloud's and push channel's signal handlers
+import django_bdd.tags
+import django_bdd.events
@@ -4,7 +4,7 @@ from django.conf import settings
 from s3util.s3util import S3Util
 from django_bdd.email import send_email
 
-from django_bdd.models import PASSED, FAILED  # for highlighting results
+from django_bdd.models import SuiteRun, TestRun, PASSED, FAILED  # for highlighting results
 
 METRIC_EMAIL_RESULTS_SENT = u'EmailResultsSent'
 METRIC_EMAIL_RESULTS_FAILURE = u'EmailResultsFailure'
@@ -56,11 +56,25 @@ HTML_EMAIL = u"""\
 """
 
 
+def in_notifying_suite(test_run):
+    """Returns whether the run, or the run it's a shard of, belongs to a
+    suite that emails its user once for all of its runs.
+    """
+    suite_id = test_run.suite_id
+    if not suite_id and test_run.parent_id:
+        suite_id = TestRun.objects.filter(id=test_run.parent_id).values_list(u'suite_id', flat=True).first()
+    return bool(suite_id) and SuiteRun.objects.filter(id=suite_id, notify=True).exists()
+
+
 def notify(test_run):
     """Builds a notification email for a test run and sends it.
     :param test_run: the test run object to send an email about
     :type test_run: TestRun
     """
+    if in_notifying_suite(test_run):
+        log.info(u'run {} is part of a suite that sends one email for all its runs'.format(test_run.id))
+        return
+
     s3_util = S3Util(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_ACCESS_KEY, cloudwatch_namespace=settings.CLOUDWATCH_NAMESPACE)
 
     # validate the user to make sure we can even try to send an email
@@ -135,3 +149,89 @@ def notify(test_run):
 
     # record a metric to track how many emails are getting sent
     s3_util.put_metric(METRIC_EMAIL_RESULTS_SENT, 1, dimensions={u'email': user})
+
+
+SUITE_URL = u'{root}/bdd/tests/suites/{suite_id}'
+SUITE_TEXT_EMAIL = u"""
+BDD Suite Results
+
+{suite_name}
+
+Your suite of {run_count} test runs completed in {suite_duration} seconds of test time:
+
+{results}
+
+You can view these results in more detail at: {url}
+
+Thanks for using BDD!
+"""
+
+SUITE_HTML_EMAIL = u"""\
+<html>
+    <head></head>
+    <body>
+        <h1>BDD Suite Results</h1>
+        <h2>{suite_name} <span style="BACKGROUND-COLOR: {status_color}">[{suite_status}]</span></h2>
+        <h3>Your suite of {run_count} test runs completed in {suite_duration} seconds of test time:</h3>
+        <p>
+            {results}
+        </p>
+        <p>You can view these results in more detail at: {url}</p>
+        <p>Thanks for using BDD!</p>
+    </body>
+</html>
+"""
+
+
+def notify_suite(suite):
+    """Builds one notification email for all the runs of a suite and sends it.
+    :param suite: the finished suite to send an email about
+    :type suite: SuiteRun
+    """
+    s3_util = S3Util(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_ACCESS_KEY, cloudwatch_namespace=settings.CLOUDWATCH_NAMESPACE)
+
+    user = suite.user
+    if not user:
+        log.error(u"suite has no user specified, can't send an email")
+        s3_util.put_metric(METRIC_EMAIL_RESULTS_FAILURE, 1)
+        return
+    elif settings.EMAIL_DOMAIN not in user:
+        user += settings.EMAIL_DOMAIN
+
+    # one line per run instead of per step, suites have hundreds of runs
+    text_results  = u'Run Results\n'
+    text_results += u'-----------\n'
+    html_results = u'<ul>'
+    for test_name, status in suite.runs.order_by(u'test__name').values_list(u'test__name', u'status'):
+        text_results += u'* {test_name} [{run_status}]\n'.format(test_name=test_name, run_status=status)
+        html_results += u'<li>{test_name} <span style="background-color:{status_color}">[{run_status}]</span></li>'.format(
+            test_name=test_name,
+            status_color=get_status_color(status),
+            run_status=status
+        )
+    html_results += u'</ul>\n\n'
+
+    url = SUITE_URL.format(root=settings.ROOT_URL, suite_id=suite.id)
+    duration = (u'%.2f' % suite.duration).rstrip(u'0').rstrip(u'.')
+    name = suite.name or u'Suite {}'.format(suite.id)
+
+    text = SUITE_TEXT_EMAIL.format(
+        suite_name=name,
+        run_count=suite.run_count,
+        suite_duration=duration,
+        results=text_results,
+        url=url
+    )
+    html = SUITE_HTML_EMAIL.format(
+        suite_name=name,
+        status_color=get_status_color(suite.status),
+        suite_status=suite.status,
+        run_count=suite.run_count,
+        suite_duration=duration,
+        results=html_results,
+        url=url
+    )
+    subject = u'[BDD] Suite Results for {suite_name} [{suite_status}]'.format(suite_name=name, suite_status=suite.status)
+
+    send_email(receivers=[user], subject=subject, html_email=html, text_email=text)
+    s3_util.put_metric(METRIC_EMAIL_RESULTS_SENT, 1, dimensions={u'email': user})
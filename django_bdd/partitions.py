@@ -0,0 +1,220 @@
+"""
+Monthly partitioning of the run and step tables on PostgreSQL.
+
+scenario_runs is partitioned on timestamp and scenario_run_steps on
+timestamp_start, one partition per month, with PostgreSQL's declarative
+partitioning (PostgreSQL 11 or later). Almost all traffic is about recent
+runs, so with partitioning their indexes stay small and old months can be
+detached without a big delete and vacuum.
+
+It's optional. Set BDD_PARTITIONING = True and convert the tables once with
+    ./manage.py bdd_partitions --convert
+which turns the existing table into a <table>_legacy partition holding
+everything up to the end of the month of its newest row, monthly partitions
+start after that. The conversion runs in one transaction with the tables
+locked, so it either happens completely or not at all. Then run
+    ./manage.py bdd_partitions --months-ahead 3 --detach-older-than 12
+from cron to keep creating upcoming partitions and detaching old ones.
+
+Partitioned tables can't have a primary key or be referenced by foreign keys
+without the partition key, so the conversion makes (id, timestamp) the
+primary key and drops the foreign keys pointing at scenario_runs. Django
+emulates the cascading deletes anyway.
+
+Queries prune partitions with prune_runs() and prune_steps(). Ids grow with
+time, so the first id of every partition tells which month a run id is from,
+and a run's steps never start before the run was created.
+"""
+import bisect
+import datetime
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+# the partitioned tables and the timestamp column they're partitioned on
+RUN_TABLE = (u'scenario_runs', u'timestamp')
+STEP_TABLE = (u'scenario_run_steps', u'timestamp_start')
+TABLES = (RUN_TABLE, STEP_TABLE)
+
+# indexes the partitioned tables get, the partitions inherit them
+INDEXES = {
+    u'scenario_runs': [u'test_id', u'parent_id', u'status', u'steps_hash', u'timestamp', u'user'],
+    u'scenario_run_steps': [u'run_id', u'status'],
+}
+
+LEGACY_SUFFIX = u'_legacy'
+PARTITION_UPPER_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+
+PARTITION_BOUNDS_CACHE_KEY = u'bdd:partition-bounds'
+PARTITION_BOUNDS_CACHE_SECONDS = 60 * 60
+
+# runs and steps written around midnight at the end of a month can end up on
+# either side of the partition boundary, and steps start a little after their
+# run, so ranges are widened by this much
+BOUNDARY_SLACK = datetime.timedelta(days=1)
+
+
+def is_enabled():
+    return getattr(settings, u'BDD_PARTITIONING', False) and connection.vendor == u'postgresql'
+
+
+def month_start(date, months=0):
+    """Returns the first day of the month the date is in, moved by months."""
+    month = date.year * 12 + date.month - 1 + months
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return u'{}_p{:04d}{:02d}'.format(table, month.year, month.month)
+
+
+def get_legacy_end(table, column, today=None):
+    """Returns where the legacy partition of a table being converted ends:
+    the start of the month after its newest row, or of this month if it's
+    empty. Every existing row has to fit into it for it to be attached.
+
+    @rtype: datetime.date
+    """
+    today = today or datetime.date.today()
+    cursor = connection.cursor()
+    # truncated in the session's time zone, like the partition bounds are read
+    cursor.execute(u"SELECT (date_trunc('month', max({column})) + interval '1 month')::date FROM {table}".format(
+        table=table, column=column))
+    end = cursor.fetchone()[0]
+    return max(end, month_start(today)) if end else month_start(today)
+
+
+def get_conversion_sql(table, column, legacy_end):
+    """Returns the statements that turn a plain table into a partitioned one,
+    with the existing rows in a legacy partition that ends at legacy_end, see
+    get_legacy_end.
+    """
+    legacy = table + LEGACY_SUFFIX
+    statements = [
+        # nothing can reference a partitioned table by id alone
+        u"""DO $$ DECLARE r record; BEGIN
+            FOR r IN SELECT conname, conrelid::regclass AS tbl FROM pg_constraint
+                     WHERE contype = 'f' AND confrelid = '{table}'::regclass LOOP
+                EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', r.tbl, r.conname);
+            END LOOP; END $$""".format(table=table),
+        u'ALTER TABLE {table} RENAME TO {legacy}'.format(table=table, legacy=legacy),
+        u"UPDATE {legacy} SET {column} = '1970-01-01' WHERE {column} IS NULL".format(legacy=legacy, column=column),
+        u'ALTER TABLE {legacy} ALTER COLUMN {column} SET NOT NULL'.format(legacy=legacy, column=column),
+        u'CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ({column})'.format(
+            table=table, legacy=legacy, column=column),
+        u'ALTER TABLE {table} ADD PRIMARY KEY (id, {column})'.format(table=table, column=column),
+        # the id sequence would go away with the legacy partition otherwise
+        u'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id'.format(table=table),
+    ]
+    for index_column in INDEXES.get(table, []):
+        # quoted, user is a reserved word
+        statements.append(u'CREATE INDEX {table}_{column}_idx ON {table} ("{column}")'.format(table=table, column=index_column))
+    statements.append(u"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ('{end}')".format(
+        table=table, legacy=legacy, end=legacy_end))
+    return statements
+
+
+def get_create_partition_sql(table, month):
+    return u"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM ('{start}') TO ('{end}')".format(
+        name=partition_name(table, month), table=table, start=month, end=month_start(month, 1))
+
+
+def get_partitions(table):
+    """Returns the partitions of a table with the date their range ends at,
+    oldest first.
+
+    @rtype: list((unicode, datetime.date))
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        u'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i '
+        u'JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass',
+        [table]
+    )
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = PARTITION_UPPER_BOUND_RE.search(bound or u'')
+        if match:
+            end = datetime.datetime.strptime(match.group(1)[:10], u'%Y-%m-%d').date()
+            partitions.append((name, end))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def get_partition_bounds():
+    """Returns the first run id and the date range of every run partition
+    that has rows, oldest first. Cached, the command refreshes it.
+
+    @rtype: list((int, datetime.date or None, datetime.date))
+    """
+    bounds = cache.get(PARTITION_BOUNDS_CACHE_KEY)
+    if bounds is None:
+        bounds = []
+        cursor = connection.cursor()
+        start = None
+        for name, end in get_partitions(RUN_TABLE[0]):
+            cursor.execute(u'SELECT min(id) FROM {}'.format(name))
+            first_id = cursor.fetchone()[0]
+            if first_id is not None:
+                bounds.append((first_id, start, end))
+            start = end
+        cache.set(PARTITION_BOUNDS_CACHE_KEY, bounds, PARTITION_BOUNDS_CACHE_SECONDS)
+    return bounds
+
+
+def refresh_partition_bounds():
+    cache.delete(PARTITION_BOUNDS_CACHE_KEY)
+    return get_partition_bounds()
+
+
+def _to_datetime(date):
+    value = datetime.datetime.combine(date, datetime.time())
+    return timezone.make_aware(value, timezone.utc) if settings.USE_TZ else value
+
+
+def get_run_time_range(run_id):
+    """Returns the range of timestamps a run with the id can have, or None if
+    it can't be narrowed down.
+
+    @rtype: (datetime.datetime or None, datetime.datetime or None)
+    """
+    bounds = get_partition_bounds()
+    i = bisect.bisect_right([first_id for first_id, start, end in bounds], int(run_id)) - 1
+    if i < 0:
+        return None
+
+    first_id, start, end = bounds[i]
+    if i == len(bounds) - 1:
+        # later partitions may not have rows yet, the run can be in any of them
+        end = None
+    return (_to_datetime(start) - BOUNDARY_SLACK if start else None), (_to_datetime(end) + BOUNDARY_SLACK if end else None)
+
+
+def prune_runs(queryset, run_id):
+    """Narrows a TestRun queryset down to the partitions a run id can be in."""
+    if not is_enabled():
+        return queryset
+
+    time_range = get_run_time_range(run_id)
+    if time_range is None:
+        return queryset
+
+    start, end = time_range
+    if start:
+        queryset = queryset.filter(timestamp__gte=start)
+    if end:
+        queryset = queryset.filter(timestamp__lt=end)
+    return queryset
+
+
+def prune_steps(queryset, run):
+    """Narrows a TestRunStep queryset of a run down to the partitions its
+    steps can be in, steps never start before their run was created.
+
+    @type run: django_bdd.models.TestRun
+    """
+    if not is_enabled() or run is None or run.timestamp is None:
+        return queryset
+    return queryset.filter(timestamp_start__gte=run.timestamp - BOUNDARY_SLACK)
@@ -0,0 +1,164 @@
+"""
+Database router that sends the reads of read-only views to a replica.
+
+The engine writes step results to the primary all day, so the heavy pages and
+the api endpoints dashboards poll can read from a replica instead. Only GET
+and HEAD requests to the views in BDD_REPLICA_VIEWS read from the replica,
+everything else (and everything outside a request, like the engine's
+management commands) uses the primary.
+
+To keep users from seeing stale data, a request that writes pins its user to
+the primary: ReplicaMiddleware sets a cookie that sends their reads to
+the primary for BDD_REPLICA_STICKY_SECONDS (default 15). Clients that don't
+keep cookies, like the engine and scripts using the api, are pinned by their
+REMOTE_USER and address in the django cache instead, which needs a shared
+cache when the server runs several processes. Any client can also send an
+X-BDD-Primary header to read from the primary. Views that cause a
+write somewhere else, like run_test posting to the api, call pin_to_primary()
+themselves. Requests that aren't GET or HEAD count as writes, and so does
+saving or deleting a model. Once a request writes, the rest of it reads from
+the primary too.
+
+Settings:
+    DATABASE_ROUTERS = [u'django_bdd.routers.ReplicaRouter']
+    MIDDLEWARE_CLASSES += (u'django_bdd.middleware.ReplicaMiddleware',)
+    BDD_REPLICA_DATABASE = u'replica'
+
+Two SQLite connections to the same file behave like a replica without lag,
+which is enough to run the app and its tests with the router turned on. The
+TEST_MIRROR makes the test runner point the replica at the test database:
+    DATABASES = {
+        u'default': {u'ENGINE': u'django.db.backends.sqlite3', u'NAME': u'bdd.sqlite3'},
+        u'replica': {u'ENGINE': u'django.db.backends.sqlite3', u'NAME': u'bdd.sqlite3',
+                     u'TEST_MIRROR': u'default'},
+    }
+"""
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+# url names of the views and api actions that only read
+REPLICA_VIEWS = (
+    u'bdd-test-list',
+    u'bdd-all-runs',
+    u'bdd-test-run',
+    u'bdd-test-runs',
+    u'bdd-test-run-detail',
+    u'bdd-test-queue',
+    u'bdd-compare-runs',
+    u'bdd-compare-runs-api',
+    u'bdd-export-features',
+    u'bdd-export-history',
+    u'bdd-step-stats',
+    u'bdd-step-stats-api',
+    u'bdd-suite-runs',
+    u'bdd-suite-run',
+    u'bdd-suite-runs-api',
+    u'bdd-suite-run-api',
+    u'test-list',
+    u'test-detail',
+    u'runs-list',
+    u'runs-detail',
+    u'steps-list',
+    u'steps-detail',
+)
+
+# requests with this cookie read from the primary
+PRIMARY_COOKIE = u'bdd_primary'
+
+# requests with an X-BDD-Primary header read from the primary
+PRIMARY_HEADER = u'HTTP_X_BDD_PRIMARY'
+
+# cookieless clients with this key in the cache read from the primary
+PRIMARY_CACHE_KEY = u'bdd:primary:{}:{}'
+
+# the routing state of the request handled by this thread
+_local = threading.local()
+
+
+def get_replica_database():
+    """Returns the alias of the replica, or None if there isn't one."""
+    return getattr(settings, u'BDD_REPLICA_DATABASE', None)
+
+
+def get_replica_views():
+    return getattr(settings, u'BDD_REPLICA_VIEWS', REPLICA_VIEWS)
+
+
+def get_sticky_seconds():
+    return getattr(settings, u'BDD_REPLICA_STICKY_SECONDS', 15)
+
+
+def get_primary_cache_key(request):
+    """Returns the cache key pinning a client that doesn't keep cookies."""
+    return PRIMARY_CACHE_KEY.format(request.META.get(u'REMOTE_USER', u''), request.META.get(u'REMOTE_ADDR', u''))
+
+
+def start_request():
+    """Starts routing a request, its reads go to the primary until
+    use_replica() is called.
+    """
+    _local.use_replica = False
+    _local.pinned = False
+
+
+def use_replica():
+    """Sends the rest of this request's reads to the replica, unless it
+    already wrote something.
+    """
+    _local.use_replica = not is_pinned()
+
+
+def pin_to_primary():
+    """Sends the rest of this request's reads to the primary, and the user's
+    next requests too for BDD_REPLICA_STICKY_SECONDS.
+    """
+    _local.use_replica = False
+    _local.pinned = True
+
+
+def reset():
+    """Stops routing, outside of requests everything uses the primary."""
+    _local.use_replica = None
+    _local.pinned = False
+
+
+def is_pinned():
+    return getattr(_local, u'pinned', False)
+
+
+class ReplicaRouter(object):
+    """Reads from BDD_REPLICA_DATABASE when ReplicaMiddleware allows it,
+    writes always go to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if getattr(_local, u'use_replica', False) and get_replica_database():
+            return get_replica_database()
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # get_or_create and the like ask for the write database without
+        # necessarily writing, so pinning happens on save and delete instead
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica has the same data, objects from either can be related
+        return True
+
+    def allow_syncdb(self, db, model):
+        # tables are created on the primary and replicated from there
+        if db == get_replica_database():
+            return False
+        return None
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def model_written(sender, **kwargs):
+    # only requests get pinned, outside of them everything uses the primary anyway
+    if getattr(_local, u'use_replica', None) is not None:
+        pin_to_primary()
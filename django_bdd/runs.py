@@ -0,0 +1,439 @@
+"""
+Helpers for creating, finishing and cancelling test runs.
+
+A scenario outline's example table can be split into shards: one parent run
+that aggregates the status of several child runs, each running a slice of the
+example rows. The engine claims the child runs independently, so a big example
+table no longer runs serialized on a single device.
+
+Starting a run also coalesces duplicates: if an identical run (same test,
+steps and example text) the same user started is still waiting in the queue,
+that run is handed back instead of queueing another one. Runs of other users
+are left alone, the run's user is the one notified when it finishes. Sharded
+runs are never coalesced, a start asking for shards gets them.
+settings.BDD_RUN_COALESCE_WINDOW is how many seconds old a queued run can be
+to be reused (default 300, 0 turns it off).
+
+Queued and running runs can be cancelled, the engine and the executor leave
+cancelled runs alone. A run whose engine died would stay running forever, so
+the bdd_watchdog command marks running runs that haven't saved a step for
+settings.BDD_STUCK_RUN_MINUTES (default 30) as errors.
+"""
+import datetime
+import hashlib
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+from django.utils import timezone
+
+from django_bdd.models import Test, TestRun, TestRunStep, NEW, RUNNING, ERROR, SKIPPED, CANCELLED, QUEUED_STATUSES,\
+    STEP_COUNTERS
+from django_bdd.partitions import prune_runs, prune_steps
+
+# marks the start of an example table embedded in the scenario text
+EXAMPLES_MARKER = u'Examples:'
+
+# the step counters of TestRun, see TestRunStep.update_run_counters
+COUNTER_FIELDS = (u'step_count', u'current_step') + tuple(sorted(STEP_COUNTERS.values()))
+
+# how many runs the counters are recounted for at a time
+BACKFILL_BATCH_SIZE = 500
+
+# how cancelled and stuck runs are reported
+CANCEL_TEXT = u'The run was cancelled by {}.'
+STUCK_TEXT = u'The run was marked as an error because no step was saved for {} minutes, since {}.'
+
+log = logging.getLogger(u'django-bdd')
+
+
+def get_example_table(steps, example_text=u''):
+    """Returns the lines of the example table a run would use, the header row
+    first. The example text of the run takes precedence over an Examples:
+    table embedded in the scenario.
+
+    @param steps: the scenario steps text
+    @type steps: unicode
+    @param example_text: the example text the run is created with
+    @type example_text: unicode
+    @return: the table lines, empty if there is no example table
+    @rtype: list(unicode)
+    """
+    if not example_text and EXAMPLES_MARKER in steps:
+        example_text = steps.split(EXAMPLES_MARKER, 1)[1]
+
+    table = []
+    for line in example_text.splitlines():
+        line = line.strip()
+        if line.startswith(u'|'):
+            table.append(line)
+        elif table and line:
+            # anything that isn't a table row ends the table
+            break
+    return table
+
+
+def split_example_table(table, shards):
+    """Splits an example table into contiguous slices of rows, each with the
+    header row.
+
+    @param table: the table lines, the header row first
+    @type table: list(unicode)
+    @param shards: how many slices to make at most
+    @type shards: int
+    @return: (row offset, example text) for every slice
+    @rtype: list((int, unicode))
+    """
+    header, rows = table[0], table[1:]
+    shards = max(1, min(shards, len(rows)))
+
+    # spread the rows evenly, the first few slices get one extra row if needed
+    size, extra = divmod(len(rows), shards)
+    slices = []
+    offset = 0
+    for i in range(shards):
+        count = size + (1 if i < extra else 0)
+        slices.append((offset, u'\n'.join([header] + rows[offset:offset + count])))
+        offset += count
+    return slices
+
+
+def hash_steps(steps):
+    """Returns the sha1 of scenario steps, used to tell if two runs would run
+    the same thing.
+    """
+    return hashlib.sha1(steps.encode(u'utf-8')).hexdigest()
+
+
+def find_queued_run(test, user, steps_hash, example_text):
+    """Returns an unsharded run of the test the user started that hasn't
+    been picked up yet and would run the same steps and examples, or None.
+    """
+    window = getattr(settings, u'BDD_RUN_COALESCE_WINDOW', 300)
+    if not window:
+        return None
+
+    since = timezone.now() - datetime.timedelta(seconds=window)
+    return TestRun.objects.filter(
+        test=test,
+        user=user,
+        status=NEW,
+        steps_hash=steps_hash,
+        example_text=example_text,
+        parent__isnull=True,
+        shard_count=0,
+        timestamp__gte=since
+    ).order_by(u'id').first()
+
+
+def create_run(test, user, example_text=u'', shards=1, force=False):
+    """Queues a run of the test, unless an identical run is already queued.
+
+    @param test: the test to run
+    @type test: django_bdd.models.Test
+    @param user: the user starting the run
+    @type user: unicode
+    @param example_text: the example text to run the test with, if any
+    @type example_text: unicode
+    @param shards: how many runs to split the example rows into
+    @type shards: int
+    @param force: queue a new run even if an identical one is queued already
+    @type force: bool
+    @return: the run, and whether it was an already queued run
+    @rtype: (django_bdd.models.TestRun, bool)
+    """
+    steps_hash = hash_steps(test.steps)
+
+    with transaction.atomic():
+        # a sharded start would lose its shards to an unsharded run
+        if not force and shards <= 1:
+            # lock the test so concurrent starts can't both miss each other's run
+            list(Test.objects.select_for_update().filter(pk=test.pk).values_list(u'pk'))
+
+            test_run = find_queued_run(test, user, steps_hash, example_text)
+            if test_run is not None:
+                log.info(u'test {} already has run {} queued, reusing it'.format(test.id, test_run.id))
+                return test_run, True
+
+        if shards > 1:
+            test_run = create_sharded_run(test, user, example_text, shards, steps_hash=steps_hash)
+        else:
+            test_run = test.testrun_set.create(user=user, example_text=example_text, steps_hash=steps_hash)
+
+    return test_run, False
+
+
+def create_sharded_run(test, user, example_text, shards, steps_hash=u''):
+    """Creates a parent run for the test with one child run per slice of the
+    example table. If the table has a single row no sharding happens.
+
+    @param test: the test to run
+    @type test: django_bdd.models.Test
+    @param user: the user starting the run
+    @type user: unicode
+    @param example_text: the example text given when starting the run, if any
+    @type example_text: unicode
+    @param shards: how many child runs to split the example rows into
+    @type shards: int
+    @param steps_hash: the hash of the test steps to record on the runs
+    @type steps_hash: unicode
+    @return: the run to hand back to the user
+    @rtype: django_bdd.models.TestRun
+    """
+    table = get_example_table(test.steps, example_text)
+    slices = split_example_table(table, shards) if len(table) > 2 else []
+    if len(slices) < 2:
+        log.debug(u'not enough example rows to shard a run of test {}'.format(test.id))
+        return test.testrun_set.create(user=user, example_text=example_text, steps_hash=steps_hash)
+
+    with transaction.atomic():
+        # the parent is never NEW, only its shards get picked up by the engine
+        parent = test.testrun_set.create(user=user, example_text=example_text, steps_hash=steps_hash, status=RUNNING, shard_count=len(slices))
+        for offset, text in slices:
+            test.testrun_set.create(user=user, example_text=text, steps_hash=steps_hash, parent=parent, shard_row_offset=offset)
+
+    log.debug(u'split run {} of test {} into {} shards'.format(parent.id, test.id, len(slices)))
+    return parent
+
+
+def get_run_steps(run, *ordering):
+    """Returns the steps of a run. The steps of a sharded run are collected
+    from its shards, with their example row numbers shifted so they line up
+    with the parent's example table.
+
+    @param run: the run to get the steps of
+    @type run: django_bdd.models.TestRun
+    @param ordering: the fields to order the steps by
+    @return: the steps of the run
+    @rtype: list(django_bdd.models.TestRunStep) or QuerySet
+    """
+    if not run.shard_count:
+        return prune_steps(TestRunStep.objects.filter(run_id=run.id), run).order_by(*ordering)
+
+    offsets = dict(run.shards.values_list(u'id', u'shard_row_offset'))
+    steps = list(prune_steps(TestRunStep.objects.filter(run_id__in=offsets.keys()), run))
+    for step in steps:
+        step.example_row_num += offsets[step.run_id]
+    steps.sort(key=lambda step: tuple(getattr(step, field) for field in ordering))
+    return steps
+
+
+def count_run_steps(run_ids):
+    """Counts the steps of runs that aren't sharded from the steps themselves.
+
+    @return: {run id: {counter field: value}}
+    @rtype: dict
+    """
+    counters = dict((run_id, dict((field, 0) for field in COUNTER_FIELDS)) for run_id in run_ids)
+    steps = TestRunStep.objects.filter(run__in=run_ids).values(u'run', u'status').annotate(count=Count(u'id'), last=Max(u'num'))
+    for row in steps.order_by():
+        run_counters = counters[row[u'run']]
+        run_counters[u'step_count'] += row[u'count']
+        run_counters[u'current_step'] = max(run_counters[u'current_step'], row[u'last'])
+        if row[u'status'] in STEP_COUNTERS:
+            run_counters[STEP_COUNTERS[row[u'status']]] += row[u'count']
+    return counters
+
+
+def count_shard_steps(run_ids):
+    """Counts the steps of sharded runs from the counters of their shards.
+    Shards run side by side, so sharded runs have no current step.
+
+    @return: {run id: {counter field: value}}
+    @rtype: dict
+    """
+    counters = dict((run_id, dict((field, 0) for field in COUNTER_FIELDS)) for run_id in run_ids)
+    sums = [Sum(field) for field in COUNTER_FIELDS if field != u'current_step']
+    for row in TestRun.objects.filter(parent__in=run_ids).values(u'parent').annotate(*sums).order_by():
+        for field in COUNTER_FIELDS:
+            if field != u'current_step':
+                counters[row[u'parent']][field] = row[u'{}__sum'.format(field)] or 0
+    return counters
+
+
+def _backfill(runs, count, batch_size):
+    updated = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(runs.filter(id__gt=last_id).order_by(u'id').values(u'id', *COUNTER_FIELDS)[:batch_size])
+            if not batch:
+                return updated
+
+            counters = count([run[u'id'] for run in batch])
+            for run in batch:
+                values = counters[run[u'id']]
+                if any(run[field] != values[field] for field in COUNTER_FIELDS):
+                    TestRun.objects.filter(id=run[u'id']).update(**values)
+                    updated += 1
+        last_id = batch[-1][u'id']
+
+
+def backfill_run_counters(batch_size=BACKFILL_BATCH_SIZE):
+    """Recounts the step counters of every run, for runs from before there
+    were counters and steps written with bulk_create. Only runs whose
+    counters are off get updated.
+
+    @return: how many runs were updated
+    @rtype: int
+    """
+    updated = _backfill(TestRun.objects.filter(shard_count=0), count_run_steps, batch_size)
+    # sharded runs are counted from their shards, which are up to date now
+    updated += _backfill(TestRun.objects.filter(shard_count__gt=0), count_shard_steps, batch_size)
+    return updated
+
+
+def finish_run(run, status, duration, text):
+    """Saves the outcome of a run and lets the user know. Runs that were
+    cancelled or finished in the meantime are left as they are.
+
+    @type run: django_bdd.models.TestRun
+    @return: whether the run was finished
+    @rtype: bool
+    """
+    # only one of the executor, the watchdog and a cancel gets to finish a run
+    if not TestRun.objects.filter(id=run.id, status__in=QUEUED_STATUSES).update(status=status, duration=duration, text=text):
+        log.info(u'run {} was already finished, leaving it {}'.format(run.id, TestRun.objects.get(id=run.id).status))
+        return False
+
+    # steps the run was in the middle of didn't get to finish
+    for step in run.testrunstep_set.filter(status=RUNNING):
+        step.status = ERROR
+        step.save(update_fields=[u'status'])
+
+    # saved again so the run events go out and a sharded parent is updated
+    run.status = status
+    run.duration = duration
+    run.text = text
+    run.save(update_fields=[u'status', u'duration', u'text'])
+
+    # a shard finishing can finish its parent run, the user hears about that one
+    notified = run
+    if run.parent_id:
+        notified = TestRun.objects.get(id=run.parent_id)
+        if notified.status in QUEUED_STATUSES:
+            return True
+    try:
+        from django_bdd.notifications import notify
+        notify(notified)
+    except Exception:
+        log.exception(u'unable to send the results of run {}'.format(notified.id))
+    return True
+
+
+def select_runs(run_ids=None, test_ids=None, user=None, tags=None):
+    """Returns the queued and running runs matching everything given, for
+    cancelling.
+
+    @param run_ids: the ids of the runs
+    @param test_ids: only runs of these tests
+    @param user: only runs this user started
+    @param tags: only runs of tests tagged with every one of these
+    @rtype: QuerySet
+    """
+    if not (run_ids or test_ids or user or tags):
+        raise ValueError(u'give run ids, test ids, a user or tags to select the runs')
+
+    queryset = TestRun.objects.filter(status__in=QUEUED_STATUSES)
+    if run_ids:
+        queryset = queryset.filter(id__in=run_ids)
+    if test_ids:
+        queryset = queryset.filter(test__in=test_ids)
+    if user:
+        queryset = queryset.filter(user=user)
+    for tag in set(tags or []):
+        queryset = queryset.filter(test__tags__name=tag)
+    return queryset
+
+
+def cancel_runs(queryset, user):
+    """Cancels the queued and running runs in queryset. Cancelling a sharded
+    run cancels its shards.
+
+    @param queryset: the runs to cancel, finished ones are skipped
+    @type queryset: QuerySet
+    @param user: who cancelled them, for the run report
+    @type user: unicode
+    @return: the ids of the runs that were cancelled, shards included
+    @rtype: list(int)
+    """
+    queued = queryset.filter(status__in=QUEUED_STATUSES).values(u'id')
+    # sharded runs are cancelled through their shards, they follow along in update_from_shards
+    runs = TestRun.objects.filter(Q(id__in=queued) | Q(parent__in=queued), status__in=QUEUED_STATUSES, shard_count=0)
+
+    cancelled = []
+    text = CANCEL_TEXT.format(user)
+    for run in runs.order_by(u'id'):
+        # the run may have been claimed or finished since, the engine and executor update it the same way
+        if not TestRun.objects.filter(id=run.id, status__in=QUEUED_STATUSES).update(status=CANCELLED, text=text):
+            continue
+
+        # the step it was in the middle of doesn't get to finish
+        for step in run.testrunstep_set.filter(status=RUNNING):
+            step.status = SKIPPED
+            step.save(update_fields=[u'status'])
+
+        # saved again so the run and queue events go out and a sharded parent is updated
+        run.status = CANCELLED
+        run.text = text
+        run.save(update_fields=[u'status', u'text'])
+        cancelled.append(run.id)
+
+    log.info(u'{} cancelled runs {}'.format(user, cancelled))
+    return cancelled
+
+
+def get_stuck_run_minutes():
+    return getattr(settings, u'BDD_STUCK_RUN_MINUTES', 30)
+
+
+def find_stuck_runs(minutes=None, now=None):
+    """Returns the running runs that haven't saved a step for minutes.
+
+    @param minutes: how long a run may go without progress, BDD_STUCK_RUN_MINUTES by default
+    @param now: the time to measure from, now by default
+    A run that has neither progress nor steps yet starts being watched from
+    now, and is judged on a later call.
+
+    @return: the runs, each with the time of its last progress as last_progress
+    @rtype: list(django_bdd.models.TestRun)
+    """
+    now = now or timezone.now()
+    cutoff = now - datetime.timedelta(minutes=minutes or get_stuck_run_minutes())
+    # the running runs are few, shards are checked rather than the runs sharded into them
+    runs = TestRun.objects.filter(status=RUNNING, shard_count=0)
+
+    stuck = []
+    for run in runs.filter(Q(last_progress__lt=cutoff) | Q(last_progress__isnull=True)).order_by(u'id'):
+        if run.last_progress is None:
+            # runs from before progress was kept, or claimed behind the orm's back
+            steps = prune_steps(TestRunStep.objects.filter(run_id=run.id), run)
+            stats = steps.aggregate(last_start=Max(u'timestamp_start'), last_end=Max(u'timestamp_end'))
+            run.last_progress = max(filter(None, [stats[u'last_start'], stats[u'last_end']]) or [None])
+            if run.last_progress is None:
+                # when it was queued says nothing about when it was claimed
+                prune_runs(TestRun.objects.filter(id=run.id, last_progress__isnull=True), run.id).update(last_progress=now)
+                continue
+        if run.last_progress < cutoff:
+            stuck.append(run)
+    return stuck
+
+
+def mark_stuck_runs(minutes=None, now=None):
+    """Marks the running runs that haven't saved a step for minutes as
+    errors, with the reason in their report, and lets their users know.
+
+    @return: the ids of the runs that were marked
+    @rtype: list(int)
+    """
+    minutes = minutes or get_stuck_run_minutes()
+    now = now or timezone.now()
+    marked = []
+    for run in find_stuck_runs(minutes, now):
+        since = run.last_progress.isoformat() if run.last_progress else u'it was started'
+        text = u'\n'.join(filter(None, [run.text, STUCK_TEXT.format(minutes, since)]))
+        if finish_run(run, ERROR, run.duration, text):
+            log.warning(u'run {} made no progress since {}, marked it as an error'.format(run.id, since))
+            marked.append(run.id)
+    return marked
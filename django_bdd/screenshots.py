@@ -0,0 +1,220 @@
+"""
+Storage for test run step screenshots.
+
+Screenshots are content addressed: a screenshot's key is made from the sha1 of
+its bytes, so byte-identical screenshots (like the same login screen on every
+run) only get stored once. Small thumbnails for the result page's screenshot
+strip are generated the first time they're asked for and cached next to the
+originals.
+
+The backend is picked with settings.BDD_SCREENSHOT_STORAGE:
+    u's3' (default) - stores screenshots in settings.AWS_BUCKET
+    u'local' - stores screenshots on disk in settings.BDD_SCREENSHOT_ROOT, so
+               the service can be run without AWS
+"""
+import hashlib
+import logging
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+
+from django_bdd import metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# where content addressed screenshots and their thumbnails live in the storage
+SCREENSHOT_PREFIX = u'screenshots/'
+THUMBNAIL_PREFIX = u'thumbnails/'
+
+# the keys stored in TestRunStep.screenshot_s3_key don't include the extension
+SCREENSHOT_EXTENSION = u'.png'
+
+# bounding box of the thumbnails in the result page's screenshot strip
+THUMBNAIL_SIZE = (240, 240)
+
+# how long to remember that a thumbnail exists, saves a HEAD request per image
+THUMBNAIL_CACHE_SECONDS = 60 * 60 * 24
+
+log = logging.getLogger(u'django-bdd')
+
+
+def make_thumbnail(data):
+    """Scales a png screenshot down so it fits into THUMBNAIL_SIZE.
+    :param data: the png bytes of the screenshot
+    :type data: str
+    :return: the png bytes of the thumbnail, or the original bytes if PIL isn't installed
+    :rtype: str
+    """
+    if Image is None:
+        log.warning(u'PIL is not installed, using full size screenshots as thumbnails')
+        return data
+
+    image = Image.open(BytesIO(data))
+    image.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
+
+    output = BytesIO()
+    image.save(output, format=u'PNG', optimize=True)
+    return output.getvalue()
+
+
+class ScreenshotStorage(object):
+    """Base class for screenshot storage backends. Backends only need to know
+    how to read, write and link to keys, the deduping and thumbnail logic is
+    shared.
+    """
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def read(self, key):
+        raise NotImplementedError
+
+    def write(self, key, data):
+        raise NotImplementedError
+
+    def url(self, key):
+        raise NotImplementedError
+
+    def store(self, data):
+        """Stores a screenshot unless a byte-identical one is already stored.
+        :param data: the png bytes of the screenshot
+        :type data: str
+        :return: the key to save in TestRunStep.screenshot_s3_key
+        :rtype: unicode
+        """
+        key = SCREENSHOT_PREFIX + hashlib.sha1(data).hexdigest()
+        if self.exists(key):
+            log.debug(u'screenshot {} already stored, skipping upload'.format(key))
+        else:
+            log.debug(u'storing screenshot {}'.format(key))
+            self.write(key, data)
+        return key
+
+    def thumbnail_url(self, key):
+        """Returns the url to a thumbnail of the screenshot, creating the
+        thumbnail first if it doesn't exist yet.
+        :param key: the key of the full size screenshot
+        :type key: unicode
+        """
+        thumbnail_key = THUMBNAIL_PREFIX + key
+        cache_key = u'bdd:thumbnail:{}'.format(hashlib.sha1(thumbnail_key.encode(u'utf-8')).hexdigest())
+
+        if not cache.get(cache_key):
+            if not self.exists(thumbnail_key):
+                log.debug(u'creating thumbnail for screenshot {}'.format(key))
+                self.write(thumbnail_key, make_thumbnail(self.read(key)))
+            cache.set(cache_key, True, THUMBNAIL_CACHE_SECONDS)
+
+        return self.url(thumbnail_key)
+
+
+class S3ScreenshotStorage(ScreenshotStorage):
+    """Keeps screenshots in the AWS_BUCKET s3 bucket."""
+
+    def __init__(self):
+        self._s3_util = None
+        self._bucket = None
+
+    @property
+    def s3_util(self):
+        if self._s3_util is None:
+            from s3util.s3util import S3Util
+            self._s3_util = S3Util(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_ACCESS_KEY, s3_bucket=settings.AWS_BUCKET)
+        return self._s3_util
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            import boto
+            connection = boto.connect_s3(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_ACCESS_KEY)
+            self._bucket = connection.get_bucket(settings.AWS_BUCKET, validate=False)
+        return self._bucket
+
+    def exists(self, key):
+        return self.bucket.get_key(key + SCREENSHOT_EXTENSION) is not None
+
+    def read(self, key):
+        s3_key = self.bucket.get_key(key + SCREENSHOT_EXTENSION)
+        if s3_key is None:
+            raise IOError(u'no screenshot stored with key {}'.format(key))
+        return s3_key.get_contents_as_string()
+
+    def write(self, key, data):
+        s3_key = self.bucket.new_key(key + SCREENSHOT_EXTENSION)
+        s3_key.set_contents_from_string(data, headers={u'Content-Type': u'image/png'})
+
+    def url(self, key):
+        with metrics.timer(metrics.S3_SIGN_TIME):
+            return self.s3_util.make_s3_url(key, extension=SCREENSHOT_EXTENSION)
+
+
+class LocalScreenshotStorage(ScreenshotStorage):
+    """Keeps screenshots on disk under BDD_SCREENSHOT_ROOT, they're served by
+    the bdd-screenshot view.
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root or settings.BDD_SCREENSHOT_ROOT)
+
+    def path(self, key):
+        """Returns the file path of a key, making sure it stays inside the root."""
+        path = os.path.abspath(os.path.join(self.root, key + SCREENSHOT_EXTENSION))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(u'invalid screenshot key: {}'.format(key))
+        return path
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def read(self, key):
+        with open(self.path(key), u'rb') as f:
+            return f.read()
+
+    def write(self, key, data):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # write to a temp file first so readers never see half written images
+        temp_path = u'{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, u'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+
+    def url(self, key):
+        return reverse(u'bdd-screenshot', kwargs={u'key': key})
+
+
+SCREENSHOT_STORAGES = {
+    u's3': S3ScreenshotStorage,
+    u'local': LocalScreenshotStorage,
+}
+
+_storage = None
+
+
+def get_screenshot_storage():
+    """Returns the screenshot storage backend configured with BDD_SCREENSHOT_STORAGE."""
+    global _storage
+    if _storage is None:
+        backend = getattr(settings, u'BDD_SCREENSHOT_STORAGE', u's3')
+        log.debug(u'using {} screenshot storage'.format(backend))
+        _storage = SCREENSHOT_STORAGES[backend]()
+    return _storage
+
+
+def set_screenshot_storage(storage):
+    """Replaces the configured screenshot storage backend, e.g. with a
+    LocalScreenshotStorage to keep benchmarks and data generation off s3.
+    :return: the backend that was in use before
+    """
+    global _storage
+    previous, _storage = _storage, storage
+    return previous
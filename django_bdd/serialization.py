@@ -0,0 +1,196 @@
+"""
+Fast serialization of run and step listings.
+
+The rest framework serializers build every field of every row through a field
+object, which is most of the time spent listing the steps of a long run. The
+functions here build the same payloads straight from values_list() rows and
+render them with json, formatting datetimes up front the way the rest
+framework's encoder does, so the output is byte for byte the same as the
+serializers' and check_compatibility() can compare the two. Set
+BDD_FAST_SERIALIZATION = False to go back to the serializers.
+
+simplejson is used to render when it's installed, it's faster than json on
+python 2 and renders the same types the same way.
+
+Responses of at least BDD_GZIP_MIN_BYTES (default 8192) are gzipped for
+clients that accept it, steps of big runs compress tenfold.
+"""
+from collections import OrderedDict
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.middleware.gzip import GZipMiddleware
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.templatetags.rest_framework import replace_query_param
+from rest_framework.utils.encoders import JSONEncoder
+
+from django_bdd.models import TestRunStep
+from django_bdd.partitions import prune_steps
+from django_bdd.runs import get_run_steps
+from django_bdd.screenshots import get_screenshot_storage
+from django_bdd.serializers import TestRunSerializer, TestRunStepSerializer
+
+# the fields of the payloads, in the order the serializers put them in
+STEP_FIELDS = TestRunStepSerializer.Meta.fields
+RUN_FIELDS = TestRunSerializer.Meta.fields
+
+# the columns the step payloads are built from, the screenshot key stands in for its url
+STEP_COLUMNS = STEP_FIELDS[:-1] + (u'screenshot_s3_key',)
+
+DATETIME_FIELDS = (u'timestamp_start', u'timestamp_end')
+
+# renders anything the rows don't already have in json form, like lazy strings
+_default = JSONEncoder().default
+
+
+def is_enabled():
+    return getattr(settings, u'BDD_FAST_SERIALIZATION', True)
+
+
+def get_gzip_min_bytes():
+    return getattr(settings, u'BDD_GZIP_MIN_BYTES', 8 * 1024)
+
+
+def format_datetime(value):
+    """Formats a datetime like the rest framework's json encoder: iso 8601
+    with milliseconds, and Z for utc.
+
+    @type value: datetime.datetime or None
+    @rtype: unicode or None
+    """
+    if value is None:
+        return None
+    formatted = value.isoformat()
+    if value.microsecond:
+        formatted = formatted[:23] + formatted[26:]
+    if formatted.endswith(u'+00:00'):
+        formatted = formatted[:-6] + u'Z'
+    return formatted
+
+
+def render(data):
+    """Renders data as json the way the rest framework's JSONRenderer does.
+
+    @rtype: str
+    """
+    return json.dumps(data, default=_default, ensure_ascii=True)
+
+
+def build_steps(rows):
+    """Builds the payloads of steps.
+
+    @param rows: STEP_COLUMNS values_list rows
+    @return: the same dicts TestRunStepSerializer(steps, many=True).data has
+    @rtype: list(OrderedDict)
+    """
+    storage = get_screenshot_storage()
+    datetimes = [STEP_FIELDS.index(field) for field in DATETIME_FIELDS]
+    payloads = []
+    for row in rows:
+        values = list(row)
+        for index in datetimes:
+            values[index] = format_datetime(values[index])
+        values[-1] = storage.url(values[-1]) if values[-1] else u''
+        payloads.append(OrderedDict(zip(STEP_FIELDS, values)))
+    return payloads
+
+
+def serialize_steps(run, queryset):
+    """Returns the payloads of the steps of a run.
+
+    @param run: the run, or None if it doesn't exist
+    @type run: django_bdd.models.TestRun
+    @param queryset: the run's steps ordered by num, used if it isn't sharded
+    @rtype: list(OrderedDict)
+    """
+    if run is None or not run.shard_count:
+        return build_steps(queryset.values_list(*STEP_COLUMNS))
+
+    # like runs.get_run_steps, the shards' example row numbers are shifted to line up with the parent's
+    offsets = dict(run.shards.values_list(u'id', u'shard_row_offset'))
+    steps = prune_steps(TestRunStep.objects.filter(run_id__in=offsets.keys()), run)
+    num = STEP_COLUMNS.index(u'num')
+    row_num = STEP_COLUMNS.index(u'example_row_num')
+    rows = []
+    for row in steps.values_list(u'run_id', *STEP_COLUMNS):
+        row = list(row)
+        run_id = row.pop(0)
+        row[row_num] += offsets[run_id]
+        rows.append(row)
+    rows.sort(key=lambda row: row[num])
+    return build_steps(rows)
+
+
+def serialize_runs(rows):
+    """Builds the payloads of runs.
+
+    @param rows: RUN_FIELDS values_list rows
+    @return: the same dicts TestRunSerializer(runs, many=True).data has
+    @rtype: list(OrderedDict)
+    """
+    return [OrderedDict(zip(RUN_FIELDS, row)) for row in rows]
+
+
+def paginated(request, page, results):
+    """Wraps a page of results like the rest framework's PaginationSerializer.
+
+    @type page: django.core.paginator.Page
+    """
+    url = request.build_absolute_uri()
+    return OrderedDict([
+        (u'count', page.paginator.count),
+        (u'next', replace_query_param(url, u'page', page.next_page_number()) if page.has_next() else None),
+        (u'previous', replace_query_param(url, u'page', page.previous_page_number()) if page.has_previous() else None),
+        (u'results', results),
+    ])
+
+
+def gzip_response(request, response):
+    """Gzips a rendered response if it's big enough and the client accepts gzip."""
+    if response.streaming or len(response.content) < get_gzip_min_bytes():
+        return response
+    return GZipMiddleware().process_response(request, response)
+
+
+def json_response(content, status=200):
+    """Returns a response of json that was already rendered.
+
+    @type content: str
+    """
+    return HttpResponse(content, content_type=u'application/json', status=status)
+
+
+def check_compatibility(run_queryset, step_queryset, sharded_run=None):
+    """Renders runs and steps both with the serializers and the fast path.
+
+    @param sharded_run: a sharded run to check the steps of too, they're
+        collected from its shards
+    @type sharded_run: django_bdd.models.TestRun
+    @return: descriptions of the payloads that don't come out the same
+    @rtype: list(unicode)
+    """
+    renderer = JSONRenderer()
+    differences = []
+    expected = renderer.render(TestRunSerializer(run_queryset, many=True).data)
+    actual = render(serialize_runs(run_queryset.values_list(*RUN_FIELDS)))
+    if actual != expected:
+        differences.append(u'runs: expected {!r}, got {!r}'.format(expected, actual))
+
+    expected = renderer.render(TestRunStepSerializer(step_queryset, many=True).data)
+    actual = render(build_steps(step_queryset.values_list(*STEP_COLUMNS)))
+    if actual != expected:
+        differences.append(u'steps: expected {!r}, got {!r}'.format(expected, actual))
+
+    if sharded_run is not None:
+        # the steps api serves sharded runs like this with the serializers
+        expected = renderer.render(TestRunStepSerializer(get_run_steps(sharded_run, u'num'), many=True).data)
+        actual = render(serialize_steps(sharded_run, None))
+        if actual != expected:
+            differences.append(u'sharded run steps: expected {!r}, got {!r}'.format(expected, actual))
+    return differences
@@ -1,7 +1,5 @@
-from django.conf import settings
-from s3util.s3util import S3Util
-
-from django_bdd.models import Test, TestRun, TestRunStep
+from django_bdd.models import SuiteRun, Test, TestRun, TestRunStep
+from django_bdd.screenshots import get_screenshot_storage
 from rest_framework import serializers
 
 
@@ -15,7 +13,44 @@ class TestSerializer(serializers.ModelSerializer):
 class TestRunSerializer(serializers.ModelSerializer):
     class Meta:
         model = TestRun
-        fields = ('id', 'example_text', 'status', 'text', 'duration')
+        fields = (
+            'id',
+            'example_text',
+            'example_row_count',
+            'status',
+            'text',
+            'duration',
+            'step_count',
+            'passed_steps',
+            'failed_steps',
+            'skipped_steps',
+            'error_steps',
+            'current_step'
+        )
+        read_only_fields = fields
+
+
+class SuiteRunSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SuiteRun
+        fields = (
+            'id',
+            'user',
+            'name',
+            'tagged',
+            'status',
+            'notify',
+            'timestamp',
+            'timestamp_end',
+            'run_count',
+            'finished_runs',
+            'passed_runs',
+            'failed_runs',
+            'skipped_runs',
+            'error_runs',
+            'cancelled_runs',
+            'duration'
+        )
         read_only_fields = fields
 
 
@@ -50,14 +85,12 @@ class TestRunStepSerializer(serializers.ModelSerializer):
 
     def get_screenshot_url(self, obj):
         """
-        The database stores s3 keys, but any users of the service need those to
-        be full urls. Return s3 urls that expire after 365 days.
+        The database stores screenshot keys, but any users of the service need
+        those to be full urls. With s3 storage these expire after 365 days.
         """
-        s3_util = S3Util(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_ACCESS_KEY, s3_bucket=settings.AWS_BUCKET)
-
         screenshot_url = ''
         if obj.screenshot_s3_key:
-            screenshot_url = s3_util.make_s3_url(obj.screenshot_s3_key)
+            screenshot_url = get_screenshot_storage().url(obj.screenshot_s3_key)
 
         return screenshot_url
 
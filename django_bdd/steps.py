@@ -0,0 +1,477 @@
+"""
+Mapping step texts back to the step definitions that run them, and the
+per definition hot-spot report built on that.
+
+Step definitions come from mobilebdd.runner.get_available_steps() and look
+like behave's default parse patterns, e.g. u'I tap on "{text}"'. Every
+definition is compiled into a regex once, with the {placeholders} matching
+anything, and the definition a step text maps to is remembered, since the
+same step texts come up over and over.
+
+Scenarios are checked against the same catalog before they're saved or
+queued, so a typo doesn't claim a device only to fail at the undefined step.
+BDD_STEP_VALIDATION decides what happens to scenarios with undefined steps:
+    u'reject' (default) - they can't be saved or started
+    u'warn' - they're saved and started, the undefined steps are reported
+    u'off' - steps aren't checked
+Scenario outline steps are checked with every row of their example table
+filled in, and aren't checked at all while there's no table yet.
+
+The report aggregates the steps of finished runs into StepStats, one row per
+definition, with a duration histogram (see metrics.Histogram) so the p95 can
+be estimated without keeping every duration around. It's refreshed
+incrementally with
+    ./manage.py bdd_refresh_step_stats
+from cron. Every refresh starts after the last run the previous one got to
+and stops at the first run that's still queued or running, so no run is
+counted twice or skipped. Runs stuck unfinished for longer than
+BDD_STEP_STATS_MAX_WAIT_HOURS (default 24) are skipped instead of holding
+the report up.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import re
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from django_bdd import metrics, runs
+from django_bdd.models import StepStats, StepStatsRefresh, TestRun, TestRunStep, FINISHED_STATUSES, FAILED, ERROR,\
+    PASSED
+
+# keywords step texts start with, they aren't part of the step definitions
+STEP_KEYWORDS = (u'Given', u'When', u'Then', u'And', u'But', u'*')
+STEP_KEYWORD_RE = re.compile(u'^\s*(?:{})\s+'.format(u'|'.join(re.escape(keyword) for keyword in STEP_KEYWORDS)), re.UNICODE)
+
+# {name} and {name:format} placeholders of parse patterns
+PLACEHOLDER_RE = re.compile(r'\{[^{}]*\}')
+
+# <name> placeholders of scenario outlines
+VARIABLE_RE = re.compile(r'<([^<>\n\r]+)>')
+
+# table cells are separated by | unless it's escaped
+CELL_SEPARATOR_RE = re.compile(r'(?<!\\)\|')
+
+DOC_STRING_MARKERS = (u'"""', u'```')
+
+# what happens to scenarios with undefined steps
+VALIDATION_REJECT = u'reject'
+VALIDATION_WARN = u'warn'
+VALIDATION_OFF = u'off'
+
+# how many leading words the step catalog is indexed by
+INDEX_WORDS = 2
+
+# how many definitions are compiled into one regex
+MAX_GROUPS = 99
+
+# how many step texts the step catalog remembers the definition of
+MATCH_CACHE_SIZE = 100000
+
+# the step stats of steps that match no step definition are kept under this
+UNDEFINED_STEP = u''
+
+# steps that ran, skipped and queued steps took no time and didn't fail
+EXECUTED_STATUSES = (PASSED, FAILED, ERROR)
+
+# how many runs a refresh aggregates per transaction
+REFRESH_BATCH_SIZE = 500
+
+# columns the report can be sorted by
+SORT_FIELDS = (u'definition', u'count', u'failures', u'failure_rate', u'total', u'mean', u'p95', u'max')
+
+log = logging.getLogger(u'django-bdd')
+
+_catalog_lock = threading.Lock()
+_catalog = None
+
+
+def strip_keyword(text):
+    """Returns a step text without its leading Given/When/Then/And/But."""
+    return STEP_KEYWORD_RE.sub(u'', text, count=1).strip()
+
+
+def definition_pattern(definition):
+    """Returns the regex source a step text has to match fully to be run by
+    a step definition, placeholders match anything.
+    """
+    parts = PLACEHOLDER_RE.split(strip_keyword(definition))
+    return u'(?:.+?)'.join(re.escape(part) for part in parts) + u'\\Z'
+
+
+def compile_definitions(definitions):
+    """Compiles definitions into as few regexes as possible, every definition
+    is an alternative in a group of its own so the match tells which one it
+    was. Python can't have more than 100 groups in a regex.
+
+    @param definitions: (index, definition) in the order they should be tried
+    @return: (regex, [(index, definition)]) for every regex
+    @rtype: list((re.RegexObject, list((int, unicode))))
+    """
+    compiled = []
+    for start in range(0, len(definitions), MAX_GROUPS):
+        chunk = definitions[start:start + MAX_GROUPS]
+        alternatives = u'|'.join(u'({})'.format(definition_pattern(definition)) for i, definition in chunk)
+        compiled.append((re.compile(alternatives, re.UNICODE | re.DOTALL), chunk))
+    return compiled
+
+
+def _leading_words(definition):
+    """Returns up to INDEX_WORDS words a definition starts with, up to its
+    first placeholder.
+    """
+    words = []
+    for word in definition.split(None, INDEX_WORDS)[:INDEX_WORDS]:
+        if u'{' in word:
+            break
+        words.append(word)
+    return tuple(words)
+
+
+def hash_definition(definition):
+    return hashlib.sha1(definition.encode(u'utf-8')).hexdigest()
+
+
+class StepCatalog(object):
+    """The available step definitions, with every one compiled once."""
+
+    def __init__(self, definitions):
+        # longer definitions are more specific, u'I tap on "{text}" twice'
+        # should win over u'I tap on "{text}"'
+        self.definitions = sorted(set(definitions), key=lambda definition: (-len(definition), definition))
+
+        # definitions are indexed by up to INDEX_WORDS of their leading words,
+        # so a step is only tried against the few definitions that can match it
+        index = {}
+        for i, definition in enumerate(self.definitions):
+            index.setdefault(_leading_words(strip_keyword(definition)), []).append((i, definition))
+        self.index = dict((key, compile_definitions(definitions)) for key, definitions in index.items())
+
+        self.lock = threading.Lock()
+        self.matches = {}
+
+    def match(self, text):
+        """Returns the step definition that runs a step text, or None if
+        there isn't one.
+
+        @param text: the step text, with or without its keyword
+        @type text: unicode
+        @rtype: unicode or None
+        """
+        text = strip_keyword(text)
+        try:
+            return self.matches[text]
+        except KeyError:
+            pass
+
+        # the most specific definition of the ones matching in each index entry
+        matches = []
+        words = text.split(None, INDEX_WORDS)[:INDEX_WORDS]
+        for length in range(len(words) + 1):
+            for regex, definitions in self.index.get(tuple(words[:length]), []):
+                match = regex.match(text)
+                if match:
+                    matches.append(definitions[match.lastindex - 1])
+                    break
+        definition = min(matches)[1] if matches else None
+
+        with self.lock:
+            if len(self.matches) >= MATCH_CACHE_SIZE:
+                self.matches.clear()
+            self.matches[text] = definition
+        return definition
+
+
+def get_step_catalog():
+    """Returns the catalog of the step definitions loaded into behave. It's
+    built on first use, the definitions only change with a deploy.
+
+    @rtype: StepCatalog
+    """
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            with metrics.timer(metrics.STEP_INTROSPECTION_TIME):
+                # loads behave and every step definition, so it's only imported when needed
+                from mobilebdd import runner
+                _catalog = StepCatalog(runner.get_available_steps())
+        return _catalog
+
+
+def set_step_catalog(catalog):
+    """Replaces the step catalog, returns the previous one.
+
+    @type catalog: StepCatalog or None
+    @rtype: StepCatalog or None
+    """
+    global _catalog
+    with _catalog_lock:
+        previous = _catalog
+        _catalog = catalog
+        return previous
+
+
+def get_validation_mode():
+    return getattr(settings, u'BDD_STEP_VALIDATION', VALIDATION_REJECT)
+
+
+def iter_step_lines(steps):
+    """Yields the line number and text of every step of a scenario, leaving
+    out doc strings, tables and the Examples: table.
+
+    @type steps: unicode
+    @rtype: iter((int, unicode))
+    """
+    doc_string = None
+    for line_num, line in enumerate(steps.splitlines(), 1):
+        line = line.strip()
+        if doc_string:
+            if line.startswith(doc_string):
+                doc_string = None
+            continue
+        if line.startswith(DOC_STRING_MARKERS):
+            doc_string = line[:3]
+        elif line.startswith(runs.EXAMPLES_MARKER):
+            return
+        elif STEP_KEYWORD_RE.match(line + u' '):
+            yield line_num, line
+
+
+def get_example_rows(steps, example_text=u''):
+    """Returns the rows of the example table a run would use, as dicts of
+    the variable values.
+
+    @rtype: list(dict)
+    """
+    table = runs.get_example_table(steps, example_text)
+    if len(table) < 2:
+        return []
+
+    def cells(line):
+        return [cell.strip().replace(u'\\|', u'|') for cell in CELL_SEPARATOR_RE.split(line.strip())[1:-1]]
+
+    header = cells(table[0])
+    return [dict(zip(header, cells(line))) for line in table[1:]]
+
+
+def find_undefined_steps(steps, example_text=u'', catalog=None):
+    """Returns the steps of a scenario that no step definition matches.
+
+    @param steps: the scenario steps text
+    @type steps: unicode
+    @param example_text: the example text a run is started with, if any
+    @type example_text: unicode
+    @type catalog: StepCatalog
+    @return: dicts with the line number, the step and the first example row
+             it's undefined with, if it has variables
+    @rtype: list(dict)
+    """
+    catalog = catalog or get_step_catalog()
+    rows = None
+    undefined = []
+    for line_num, text in iter_step_lines(steps):
+        if not VARIABLE_RE.search(text):
+            if catalog.match(text) is None:
+                undefined.append({u'line': line_num, u'step': text, u'example_row_num': None})
+            continue
+
+        if rows is None:
+            rows = get_example_rows(steps, example_text)
+        for row_num, row in enumerate(rows, 1):
+            filled = VARIABLE_RE.sub(lambda match: row.get(match.group(1), match.group(0)), text)
+            if catalog.match(filled) is None:
+                undefined.append({u'line': line_num, u'step': text, u'example_row_num': row_num})
+                break
+    return undefined
+
+
+def validate_steps(steps, example_text=u''):
+    """Checks a scenario's steps against the step catalog, unless
+    BDD_STEP_VALIDATION is off or the step definitions can't be loaded here.
+
+    @return: the undefined steps, see find_undefined_steps
+    @rtype: list(dict)
+    """
+    if get_validation_mode() == VALIDATION_OFF:
+        return []
+    try:
+        catalog = get_step_catalog()
+    except ImportError as e:
+        log.warning(u'unable to load the step definitions, steps are not validated: {}'.format(unicode(e)))
+        return []
+    return find_undefined_steps(steps, example_text, catalog)
+
+
+def is_rejected(undefined):
+    return bool(undefined) and get_validation_mode() == VALIDATION_REJECT
+
+
+def describe_undefined_steps(undefined):
+    """Returns a message for each undefined step.
+
+    @rtype: list(unicode)
+    """
+    messages = []
+    for step in undefined:
+        message = u'line {}: no step definition matches: {}'.format(step[u'line'], step[u'step'])
+        if step[u'example_row_num'] is not None:
+            message += u' with example row {}'.format(step[u'example_row_num'])
+        messages.append(message)
+    return messages
+
+
+def get_max_wait():
+    return datetime.timedelta(hours=getattr(settings, u'BDD_STEP_STATS_MAX_WAIT_HOURS', 24))
+
+
+def get_refresh_cursor():
+    """Returns the id of the last run the step stats have been refreshed up to."""
+    refresh = StepStatsRefresh.objects.order_by(u'-id').first()
+    return refresh.last_run_id if refresh else 0
+
+
+def _pick_runs(runs, now):
+    """Returns the ids of the finished runs to aggregate and the id of the
+    last run the refresh got to, stopping at the first run still in progress.
+    """
+    max_wait = get_max_wait()
+    run_ids = []
+    last_run_id = None
+    for run_id, status, timestamp in runs:
+        if status not in FINISHED_STATUSES:
+            if timestamp is not None and now - timestamp < max_wait:
+                break
+            log.warning(u'step stats are skipping run {} that has been {} since {}'.format(run_id, status, timestamp))
+        else:
+            run_ids.append(run_id)
+        last_run_id = run_id
+    return run_ids, last_run_id
+
+
+def _aggregate(run_ids, catalog):
+    """Returns {definition: Histogram} of durations in milliseconds and
+    {definition: failures} of the steps of the runs.
+    """
+    histograms = {}
+    failures = {}
+    steps = TestRunStep.objects.filter(run__in=run_ids, status__in=EXECUTED_STATUSES)
+    for text, status, duration in steps.values_list(u'text', u'status', u'duration').iterator():
+        definition = catalog.match(text)
+        if definition is None:
+            definition = UNDEFINED_STEP
+        if definition not in histograms:
+            histograms[definition] = metrics.Histogram()
+            failures[definition] = 0
+        histograms[definition].add(duration * 1000.0)
+        failures[definition] += status in (FAILED, ERROR)
+    return histograms, failures
+
+
+def _merge(histograms, failures):
+    """Adds the aggregated steps to the stored step stats."""
+    hashes = dict((hash_definition(definition), definition) for definition in histograms)
+    existing = dict((stats.definition_hash, stats) for stats in
+                    StepStats.objects.select_for_update().filter(definition_hash__in=list(hashes)))
+
+    new_stats = []
+    for definition_hash, definition in hashes.items():
+        histogram = histograms[definition]
+        stats = existing.get(definition_hash)
+        if stats is None:
+            stats = StepStats(definition=definition, definition_hash=definition_hash)
+        buckets = json.loads(stats.buckets) if stats.buckets else [0] * len(histogram.buckets)
+
+        stats.count += histogram.count
+        stats.failures += failures[definition]
+        stats.total_duration += histogram.total / 1000.0
+        stats.min_duration = histogram.min / 1000.0 if stats.min_duration is None else min(stats.min_duration, histogram.min / 1000.0)
+        stats.max_duration = histogram.max / 1000.0 if stats.max_duration is None else max(stats.max_duration, histogram.max / 1000.0)
+        stats.buckets = json.dumps([old + new for old, new in zip(buckets, histogram.buckets)])
+
+        if stats.id is None:
+            new_stats.append(stats)
+        else:
+            stats.save()
+    StepStats.objects.bulk_create(new_stats)
+
+
+def refresh_step_stats(catalog=None, max_runs=None, now=None):
+    """Aggregates the steps of the runs that finished since the last refresh.
+
+    @param catalog: the step definitions to map steps to, the ones loaded into
+                    behave by default
+    @type catalog: StepCatalog
+    @param max_runs: stop after this many runs, all of them by default
+    @type max_runs: int
+    @return: how many runs and steps were aggregated
+    @rtype: dict
+    """
+    catalog = catalog or get_step_catalog()
+    now = now or timezone.now()
+    result = {u'runs': 0, u'steps': 0}
+
+    while max_runs is None or result[u'runs'] < max_runs:
+        batch_size = REFRESH_BATCH_SIZE if max_runs is None else min(REFRESH_BATCH_SIZE, max_runs - result[u'runs'])
+        with transaction.atomic():
+            cursor = get_refresh_cursor()
+            # sharded parent runs have no steps of their own, their shards do
+            runs = TestRun.objects.filter(id__gt=cursor, shard_count=0).order_by(u'id')
+            runs = list(runs.values_list(u'id', u'status', u'timestamp')[:batch_size])
+            run_ids, last_run_id = _pick_runs(runs, now)
+            if last_run_id is None:
+                break
+
+            histograms, failures = _aggregate(run_ids, catalog)
+            _merge(histograms, failures)
+            steps = sum(histogram.count for histogram in histograms.values())
+            StepStatsRefresh.objects.create(last_run_id=last_run_id, runs=len(run_ids), steps=steps)
+
+        result[u'runs'] += len(run_ids)
+        result[u'steps'] += steps
+        if len(runs) < batch_size or last_run_id != runs[-1][0]:
+            # caught up, or waiting on a run in progress
+            break
+
+    return result
+
+
+def _estimate_p95(stats):
+    histogram = metrics.Histogram()
+    histogram.buckets = json.loads(stats.buckets) if stats.buckets else histogram.buckets
+    histogram.count = stats.count
+    histogram.max = stats.max_duration * 1000.0 if stats.max_duration is not None else None
+    p95 = histogram.percentile(95)
+    # the upper bound of a bucket can be well past the longest step in it
+    return min(p95 / 1000.0, stats.max_duration) if p95 is not None else None
+
+
+def get_step_report(sort=u'-total'):
+    """Returns the step stats of every definition, hottest first by default.
+
+    @param sort: one of SORT_FIELDS, prefixed with - to sort descending
+    @type sort: unicode
+    @rtype: list(dict)
+    """
+    report = []
+    for stats in StepStats.objects.all():
+        report.append({
+            u'definition': stats.definition,
+            u'count': stats.count,
+            u'failures': stats.failures,
+            u'failure_rate': float(stats.failures) / stats.count if stats.count else 0.0,
+            u'total': stats.total_duration,
+            u'mean': stats.total_duration / stats.count if stats.count else None,
+            u'p95': _estimate_p95(stats),
+            u'max': stats.max_duration,
+        })
+
+    field = sort.lstrip(u'-')
+    if field not in SORT_FIELDS:
+        raise ValueError(u'sort must be one of {}'.format(u', '.join(SORT_FIELDS)))
+    # None sorts before numbers in python 2, which puts them last when descending
+    report.sort(key=lambda row: row[field], reverse=sort.startswith(u'-'))
+    return report
@@ -0,0 +1,47 @@
+"""
+A file that streams what's written to it.
+
+Writers that want a file, like tarfile, zipfile and pyarrow's parquet writer,
+write to a StreamBuffer, and the view or command streaming the output drains
+what they wrote after every piece, so nothing bigger than a piece is ever held
+in memory.
+"""
+
+
+class StreamBuffer(object):
+    """A write-only, unseekable file that hands back what was written to it
+    since the last drain().
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError(u'write to a closed buffer')
+        # pyarrow writes buffers, not strings
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return False
+
+    def seek(self, offset, whence=0):
+        raise IOError(u'the buffer can only be written to the end')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
@@ -0,0 +1,83 @@
+"""
+Suites: many runs started together, like a release's regression suite.
+
+A suite starts one run of every test matching a tag expression or a list of
+test ids, and keeps counters of its runs by status and their total duration.
+The counters are updated as each run reaches a finished status, in the same
+transaction as the run (see TestRun.update_suite_counters), so whether the
+suite is green is one row to read, not hundreds of runs to query. The last
+run to finish sets the suite's status.
+
+A suite started with notify sends its user one email with every run's status
+when it finishes, instead of one email per run.
+"""
+import logging
+
+from django.db import transaction
+
+from django_bdd import steps
+from django_bdd.models import SuiteRun
+from django_bdd.runs import get_example_table, hash_steps
+from django_bdd.tags import select_tests
+
+log = logging.getLogger(u'django-bdd')
+
+
+def get_skip_reason(test):
+    """Returns why a test can't be run as part of a suite, or None if it can.
+
+    @type test: django_bdd.models.Test
+    @rtype: unicode or None
+    """
+    # suites have no way to give an outline its examples
+    if steps.VARIABLE_RE.search(test.steps) and not get_example_table(test.steps):
+        return u'the scenario outline has no examples'
+    undefined = steps.validate_steps(test.steps)
+    if steps.is_rejected(undefined):
+        return u'; '.join(steps.describe_undefined_steps(undefined))
+    return None
+
+
+def start_suite(user, test_ids=None, tags=None, name=u'', notify=False):
+    """Queues a run of every test matching everything given, as one suite.
+    Tests that can't be run are left out and reported.
+
+    @param user: the user starting the suite
+    @type user: unicode
+    @param test_ids: the ids of the tests
+    @type test_ids: list(int)
+    @param tags: only tests tagged with every one of these
+    @type tags: list(unicode)
+    @param name: the name of the suite, the tags by default
+    @type name: unicode
+    @param notify: send one email when the suite finishes instead of one per run
+    @type notify: bool
+    @return: the suite, and the tests left out with why
+    @rtype: (django_bdd.models.SuiteRun, list(dict))
+    @raise ValueError: if nothing is selected, or none of the tests can be run
+    """
+    if not (test_ids or tags):
+        raise ValueError(u'give test ids or tags to select the tests of the suite')
+
+    tests = []
+    skipped = []
+    for test in select_tests(test_ids, tags).order_by(u'id'):
+        reason = get_skip_reason(test)
+        if reason is None:
+            tests.append(test)
+        else:
+            skipped.append({u'test_id': test.id, u'name': test.name, u'reason': reason})
+    if not tests:
+        raise ValueError(u'none of the selected tests can be run')
+
+    tagged = u'+'.join(sorted(set(tags or [])))
+    with transaction.atomic():
+        # the run count is set up front, so runs finishing early can't finish the suite
+        suite = SuiteRun.objects.create(user=user, name=name or tagged, tagged=tagged, notify=notify, run_count=len(tests))
+        # suites always get runs of their own, a coalesced run would belong to another suite
+        for test in tests:
+            test.testrun_set.create(user=user, steps_hash=hash_steps(test.steps), suite=suite)
+
+    log.info(u'{} started suite {} with {} runs, skipped tests {}'.format(
+        user, suite.id, suite.run_count, [test[u'test_id'] for test in skipped]))
+    return suite, skipped
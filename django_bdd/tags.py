@@ -0,0 +1,175 @@
+"""
+Tag cloud for the scenario list, and bulk tagging.
+
+The tags used by tests, with how many tests use each one, are cached until the
+tags of any test change.
+
+Tags are added to, removed from and renamed across many tests at once with
+set-based queries on taggit's TaggedItem table, in one transaction. The tests
+themselves, their steps and their edit history are left alone.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from taggit.models import Tag, TaggedItem
+
+from django_bdd.models import Test
+
+TAG_CLOUD_CACHE_KEY = u'bdd:tag-cloud'
+
+# the cloud is invalidated whenever tags change, this is just a safety net
+TAG_CLOUD_CACHE_SECONDS = 60 * 60 * 24
+
+# how many tags are tagged onto tests per insert
+BULK_TAG_BATCH_SIZE = 500
+
+
+def get_tag_cloud():
+    """Returns the tags used by at least one test, ordered by name, each with
+    the number of tests using it as num_tests.
+    :rtype: list(taggit.models.Tag)
+    """
+    tag_cloud = cache.get(TAG_CLOUD_CACHE_KEY)
+    if tag_cloud is None:
+        content_type = ContentType.objects.get_for_model(Test)
+        tag_cloud = list(
+            Tag.objects.filter(taggit_taggeditem_items__content_type=content_type)
+            .annotate(num_tests=Count(u'taggit_taggeditem_items'))
+            .order_by(u'name')
+        )
+        cache.set(TAG_CLOUD_CACHE_KEY, tag_cloud, TAG_CLOUD_CACHE_SECONDS)
+    return tag_cloud
+
+
+def invalidate_tag_cloud():
+    cache.delete(TAG_CLOUD_CACHE_KEY)
+
+
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def tags_changed(sender, **kwargs):
+    invalidate_tag_cloud()
+
+
+def select_tests(test_ids=None, tags=None, search=None):
+    """Returns the tests a bulk tag change applies to, the ones matching
+    everything given.
+
+    @param test_ids: the ids of the tests
+    @type test_ids: list(int)
+    @param tags: only tests tagged with every one of these
+    @type tags: list(unicode)
+    @param search: only tests with this in their name
+    @type search: unicode
+    @rtype: QuerySet
+    """
+    if not (test_ids or tags or search):
+        raise ValueError(u'give test ids, tags or a search to select the tests to change')
+
+    queryset = Test.objects.all()
+    if test_ids:
+        queryset = queryset.filter(pk__in=test_ids)
+    # like the scenario list, tests need every tag
+    for tag in set(tags or []):
+        queryset = queryset.filter(tags__name=tag)
+    if search:
+        queryset = queryset.filter(name__icontains=search)
+    return queryset
+
+
+def _tagged_items(test_ids):
+    content_type = ContentType.objects.get_for_model(Test)
+    return TaggedItem.objects.filter(content_type=content_type, object_id__in=test_ids)
+
+
+def _get_or_create_tags(names):
+    tags = dict((tag.name, tag) for tag in Tag.objects.filter(name__in=names))
+    for name in names:
+        if name not in tags:
+            tags[name] = Tag.objects.create(name=name)
+    return tags.values()
+
+
+def _clean_names(names):
+    names = set(name.strip() for name in names if name.strip())
+    if not names:
+        raise ValueError(u'no tags given')
+    return names
+
+
+def add_tags(queryset, names):
+    """Tags every test in queryset with every one of names. Tests that
+    already have a tag are left as they are.
+
+    @type queryset: QuerySet
+    @type names: list(unicode)
+    @return: how many tags were added, one per test and tag
+    @rtype: int
+    """
+    names = _clean_names(names)
+    with transaction.atomic():
+        test_ids = list(queryset.order_by().values_list(u'pk', flat=True))
+        tags = _get_or_create_tags(names)
+        existing = set(_tagged_items(queryset.order_by().values(u'pk')).filter(tag__in=tags)
+                       .values_list(u'object_id', u'tag_id'))
+        content_type = ContentType.objects.get_for_model(Test)
+        # bulk_create sends no post_save, the cloud is invalidated once below
+        added = [TaggedItem(content_type=content_type, object_id=test_id, tag=tag)
+                 for test_id in test_ids for tag in tags if (test_id, tag.id) not in existing]
+        TaggedItem.objects.bulk_create(added, batch_size=BULK_TAG_BATCH_SIZE)
+    invalidate_tag_cloud()
+    return len(added)
+
+
+def remove_tags(queryset, names):
+    """Takes every one of names off every test in queryset.
+
+    @type queryset: QuerySet
+    @type names: list(unicode)
+    @return: how many tags were removed, one per test and tag
+    @rtype: int
+    """
+    names = _clean_names(names)
+    with transaction.atomic():
+        items = _tagged_items(queryset.order_by().values(u'pk')).filter(tag__name__in=names)
+        removed = items.count()
+        # a plain delete would load every item to send post_delete, the cloud is invalidated once below
+        items._raw_delete(router.db_for_write(TaggedItem))
+    invalidate_tag_cloud()
+    return removed
+
+
+def rename_tag(old, new, queryset=None):
+    """Renames a tag on the tests in queryset, or on every test. Tests that
+    already have the new tag just lose the old one. The old tag is deleted
+    once no test has it.
+
+    @type old: unicode
+    @type new: unicode
+    @param queryset: the tests to rename it on, all of them if None
+    @type queryset: QuerySet
+    @return: how many tests had the tag renamed
+    @rtype: int
+    """
+    old, new = old.strip(), new.strip()
+    if not old or not new:
+        raise ValueError(u'give the tag to rename and its new name')
+    if old == new:
+        return 0
+
+    tagged = Test.objects.filter(tags__name=old)
+    if queryset is not None:
+        tagged = tagged.filter(pk__in=queryset.order_by().values(u'pk'))
+
+    with transaction.atomic():
+        renamed = tagged.count()
+        if renamed:
+            add_tags(tagged, [new])
+            remove_tags(tagged, [old])
+        # other models may be tagged with it too
+        Tag.objects.filter(name=old, taggit_taggeditem_items__isnull=True).delete()
+    return renamed
@@ -1,36 +1,7 @@
 from django.conf.urls import patterns, url, include
-from rest_framework import routers
-from rest_framework_nested import routers as nested_routers
-from django_bdd import views
-
-# router docs
-# http://www.django-rest-framework.org/api-guide/routers
-# https://github.com/alanjds/drf-nested-routers
-# router code: https://github.com/tomchristie/django-rest-framework/blob/master/rest_framework/routers.py
-
-# setup and route urls for api calls
-# trailing slash removes the requirement of having a trailing slash to api calls
-# im just not used to it so imma nuke it
-# wrap into a default router to get the root list functionality
-api_router_tests = routers.DefaultRouter(trailing_slash=False)
-api_router_tests.register(r'tests', views.TestViewSet)
-
-# wire up a nested router to get specific runs of a test and their status
-api_router_runs = nested_routers.NestedSimpleRouter(api_router_tests, r'tests', lookup='test', trailing_slash=False)
-
-# since our views have custom queryset getters, the base name needs to be given
-# or else django will throw errors, cuz it cant route the request
-api_router_runs.register(r'runs', views.TestRunViewSet, base_name='runs')
-
-# wire up a nested router to runs to get the specific steps and their status
-api_router_steps = nested_routers.NestedSimpleRouter(api_router_runs, r'runs', lookup='run', trailing_slash=False)
-
-# since our views have custom queryset getters, the base name needs to be given
-# or else django will throw errors, cuz it cant route the request
-api_router_steps.register(r'steps', views.TestRunStepViewSet, base_name='steps')
-
-# Wire up our API using automatic URL routing.
-# Additionally, we include login URLs for the browseable API.
+from django_bdd import api, views
+
+# the api urls live in api_urls.py, so they can be served without the ui
 urlpatterns = patterns('',
     # these are for the ui
     url(r'^tests/$', views.tests, name='bdd-test-list'),
@@ -47,17 +18,32 @@ urlpatterns = patterns('',
     url(r'^tests/(?P<test_id>\d+)/runs$', views.test_runs, name='bdd-test-runs'),
     url(r'^tests/(?P<test_id>\d+)/runs/(?P<test_run_id>\d+)$', views.test_runs, name='bdd-test-run-detail'),
 
+    # step by step comparison of two runs
+    url(r'^tests/runs/(?P<base_run_id>\d+)/compare/(?P<other_run_id>\d+)$', views.compare_test_runs, name='bdd-compare-runs'),
+
+    # time spent in and failures of every step definition
+    url(r'^tests/steps/stats$', views.step_stats, name='bdd-step-stats'),
+
     # url for viewing the test queue
     url(r'^tests/queue$', views.test_queue, name='bdd-test-queue'),
+    url(r'^tests/runs/cancel$', views.cancel_test_runs, name='bdd-cancel-runs'),
+
+    # runs started together, with their progress kept on the suite
+    url(r'^tests/suites$', views.suite_runs, name='bdd-suite-runs'),
+    url(r'^tests/suites/start$', views.start_suite_run, name='bdd-start-suite'),
+    url(r'^tests/suites/(?P<suite_id>\d+)$', views.suite_run, name='bdd-suite-run'),
+
+    # server-sent events about runs and the queue, so pages don't have to poll
+    url(r'^tests/events$', api.event_stream, name='bdd-events'),
+
+    # screenshots, full size ones are only served from here with local screenshot storage
+    url(r'^tests/screenshots/(?P<key>.+)$', views.screenshot, name='bdd-screenshot'),
+    url(r'^tests/screenshot-thumbnails/(?P<key>.+)$', views.screenshot_thumbnail, name='bdd-screenshot-thumbnail'),
 
     # ajax calls made by ui
     url(r'^tests/(?P<test_id>\d+)/delete-modal$', views.delete_modal, name='bdd-delete-modal'),
     url(r'^tests/(?P<test_id>\d+)/scenario-outline-example-form$', views.scenario_outline_example_form, name='bdd-scenario-outline-example-form'),
 
     # for the api
-    url(r'^api/', include(api_router_tests.urls)),
-    # even though the nested router was init and django should technically
-    # know this is a 'subtree' of bdd_api, it dont. so have to add manually
-    url(r'^api/', include(api_router_runs.urls)),
-    url(r'^api/', include(api_router_steps.urls)),
+    url(r'^api/', include('django_bdd.api_urls')),
 )
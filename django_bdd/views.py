@@ -2,46 +2,44 @@ import codecs
 import logging
 import re
 import HTMLParser
-import requests
-from bs4 import BeautifulSoup
 
 from django import forms
 
-from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
 from django.db import connection
 from django.db.models import Q  # for complex queries (including 'OR' logic)
-from django.http import HttpResponse
+from django.http import HttpResponseNotModified, Http404
 from django.http.request import QueryDict
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.html import escape, strip_tags
-
-from rest_framework import viewsets
-from rest_framework.decorators import action
-from rest_framework.renderers import JSONRenderer
+from django.utils.http import is_safe_url
+from django.views.decorators.http import require_POST
+from django.views.static import serve
 
 from taggit.forms import TagField  # for letting users edit tags
-from taggit.models import Tag
 
-from django_tables2 import Table, TemplateColumn  # for displaying tables easily
+from django_tables2 import Column, RequestConfig, Table, TemplateColumn  # for displaying tables easily
 from django_ajax.decorators import ajax  # for rendering dynamic forms like scenario outline textboxes
 from tinymce.widgets import TinyMCE  # for editing scenario step text and autocomplete
 
-from s3util.s3util import S3Util
-from django_bdd.models import Test, TestRun, TestRunStep, TestEditHistory, NEW, RUNNING, FAILED,\
-    PASSED, SKIPPED, ERROR
-from django_bdd.serializers import TestSerializer, TestRunSerializer,\
-    TestRunStepSerializer
-from mobilebdd import runner
-
-# Check out this URL for more info on potential method overrides:
-# http://www.django-rest-framework.org/api-guide/viewsets
-
-# create the s3 utilities
-s3_util = S3Util(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_ACCESS_KEY, s3_bucket=settings.AWS_BUCKET)
+# requests and mobilebdd.runner (which loads behave and every step
+# definition) are imported by the views that use them, so starting a process
+# doesn't pay for them
+
+from django_bdd import events, partitions, routers, steps
+from django_bdd.api import add_screenshot_urls, filter_tags, get_cancelled_runs, get_compared_runs, get_list, get_user,\
+    is_true
+from django_bdd.caching import get_run_history_validators, get_run_validators, is_cacheable, not_modified,\
+    set_validators
+from django_bdd.comparison import compare_runs
+from django_bdd.models import SuiteRun, Test, TestRun, TestRunStep, NEW, RUNNING, FAILED, PASSED, SKIPPED, ERROR, CANCELLED
+from django_bdd.runs import cancel_runs, create_run, get_run_steps
+from django_bdd.suites import start_suite
+from django_bdd.tags import get_tag_cloud
+from django_bdd.screenshots import get_screenshot_storage, LocalScreenshotStorage, SCREENSHOT_EXTENSION
 
 # marker for dynamic fields in forms
 DYNAMIC_FIELD_MARKER = u'dynamic_'
@@ -53,7 +51,8 @@ RunStatusClasses = {
     FAILED: u'alert-danger',
     PASSED: u'alert-success',
     SKIPPED: u'alert-warning',
-    ERROR: u'alert-danger'
+    ERROR: u'alert-danger',
+    CANCELLED: u'alert-warning'
 }
 
 # mapping of test step statuses to css classes
@@ -63,7 +62,8 @@ StepStatusClasses = {
     FAILED: u'text-danger',
     PASSED: u'text-success',
     SKIPPED: u'text-warning',
-    ERROR: u'text-danger'
+    ERROR: u'text-danger',
+    CANCELLED: u'text-warning'
 }
 
 # list of label colors
@@ -79,16 +79,6 @@ LABEL_CLASSES = [
 log = logging.getLogger(u'django-bdd')
 
 
-def get_user(request):
-    """given a web request, attempts to pull 'REMOTE_USER' out of the request
-    :return: the user. defaults to 'nobody'
-    """
-    user = request.environ.get(u'REMOTE_USER', u'nobody')
-    if user == u'nobody':
-        log.error(u'user not detected through REMOTE_USER environment variable')
-    return user
-
-
 def steps_to_html(steps):
     # TinyMCE puts these characters there instead of spaces
     steps = steps.replace(u' ', u'\xa0')
@@ -116,36 +106,6 @@ def html_to_steps(html):
     return steps
 
 
-def filter_tags(test_queryset, tags):
-    """
-    @param test_queryset: a Test object query set
-    @type test_queryset: QuerySet
-    @param tags: list of tags
-    @type tags: list
-    """
-    # create a list of test ids to remove from the query set
-    to_remove = []
-    tags = set(tags)
-    for test in test_queryset:
-        test_tags = set(test.tags.names())
-        if not tags.issubset(test_tags):
-            to_remove.append(test.id)
-
-    # exclude the ids from the query set
-    test_queryset = test_queryset.exclude(id__in=to_remove)
-    return test_queryset
-
-
-class JSONResponse(HttpResponse):
-    """
-    An HttpResponse that renders its content into JSON.
-    """
-    def __init__(self, data, **kwargs):
-        content = JSONRenderer().render(data)
-        kwargs[u'content_type'] = u'application/json'
-        super(JSONResponse, self).__init__(content, **kwargs)
-
-
 @ajax
 def delete_modal(request, test_id=None):
     """Returns the html for the modal that includes a delete button for
@@ -220,222 +180,52 @@ def scenario_outline_example_form(request, test_id=None):
     return render(request, u'django_bdd/bddscenariooutlineform.html', {u'test': test, u'form': form})
 
 
-def get_step_variables(steps):
-    """
-    extracts any <xyz> style text from a bdd scenario. these are the variables
-    for a scenario outline.
-
-    @param steps: bdd scenario outline steps text
-    @type steps: unicode
-    @return: the parsed out set of variable names
-    @rtype: set(basestring)
-    """
-    return set(re.compile(r'<([^<>\n\r>]+)>').findall(steps))
-
-
-def form_examples(request, step_variables):
-    """
-    extract the examples from the request data, if possible
-
-    @param request: http request object
-    @type request rest_framework.request.Request
-    @param step_variables: set of variable names from the bdd test
-    @type step_variables: set(basestring)
-    @return: none if no examples or failed, or formed examples and an error msg,
-        if applicable
-    @rtype: (basestring, basestring)
-    """
-    if u'examples' not in request.DATA:
-        return None, None
-
-    examples = request.DATA[u'examples']
-    log.debug(u'request has examples:\n{}'.format(examples))
-
-    # examples should be an array of json objects, each object being an
-    # example row
-    if not isinstance(examples, list):
-        return None, u'examples payload was not an array'
-    if not examples:
-        return None, u'examples array was empty'
-
-    # form the actual gherkin example text (sans "Examples:", engine adds it)
-    text = [u'|' + u'|'.join(step_variables) + u'|']
-    for ex in examples:
-        # verify the example obj has all the expected headers/fields
-        ex_field_diffs = step_variables.difference(ex.keys())
-        if ex_field_diffs:
-            return None, u'an example object was missing some fields: {} given: {}'.format(ex_field_diffs, ex)
-
-        vals = [unicode(ex[key]) for key in step_variables]
-        text.append(u'|' + u'|'.join(vals) + u'|')
-    text = u'\n'.join(text)
-
-    log.debug(u'resulting example text\n{}'.format(text))
-    return text, None
-
-
-class TestViewSet(viewsets.ModelViewSet):
-    queryset = Test.objects.all()
-    serializer_class = TestSerializer
-
-    def update(self, request, pk=None):
-        """
-        Update the specified test.
+class TestRunTable(Table):
+    progress = TemplateColumn(template_name=u'django_bdd/progress.html', orderable=False, verbose_name=u'Progress')
+    view = TemplateColumn(u'<a href="{% url "bdd-test-run-detail" test_id=record.test_id test_run_id=record.id %}">View</a>', verbose_name=u'View')
 
-        Base code from https://github.com/tomchristie/django-rest-framework/blob/master/rest_framework/mixins.py
-        """
-        log.debug(u'updating test {} via api'.format(pk))
+    class Meta:
+        model = TestRun
+        exclude = (u'test', u'example_text', u'text', u'parent', u'shard_count', u'shard_row_offset', u'example_row_count',
+                   u'step_count', u'passed_steps', u'failed_steps', u'skipped_steps', u'error_steps', u'current_step',
+                   u'last_progress', u'suite', u'counted_status', u'counted_duration')
+        attrs = {u'class': u'table table-striped table-hover'}
 
-        test = self.get_object_or_none()
-        if test is None:
-            return JSONResponse({u'error': u'no test found with id {}'.format(pk)})
 
-        try:
-            test_serializer = TestSerializer(test, data=request.DATA)
-            if test_serializer.is_valid():
-                # save the test
-                test_serializer.save()
+class SuiteRunTable(Table):
+    progress = TemplateColumn(template_name=u'django_bdd/suite_progress.html', orderable=False, verbose_name=u'Progress')
+    view = TemplateColumn(u'<a href="{% url "bdd-suite-run" suite_id=record.id %}">View</a>', verbose_name=u'View')
 
-                # log an entry in the test edit history
-                # pull the user out of the data
-                user = test_serializer.data[u'user']
-                log.debug(u'user {} is updating test {} via api'.format(user, pk))
+    class Meta:
+        model = SuiteRun
+        fields = (u'id', u'name', u'user', u'timestamp', u'timestamp_end', u'status', u'run_count', u'duration')
+        attrs = {u'class': u'table table-striped table-hover'}
 
-                log.debug(u'querying test edit history')
-                test = Test.objects.get(pk=pk)
-                version = test.testedithistory_set.count() + 1
 
-                log.debug(u'saving test {} history version {}'.format(pk, version))
-                history_entry = test.testedithistory_set.create(user=user, version=version, steps=test.steps)
-                log.debug(u'created test {} history entry {}'.format(pk, history_entry.id))
+class StepStatsTable(Table):
+    definition = Column(verbose_name=u'Step Definition')
+    count = Column(verbose_name=u'Runs')
+    failures = Column()
+    failure_rate = Column(verbose_name=u'Failure Rate')
+    total = Column(verbose_name=u'Total (s)')
+    mean = Column(verbose_name=u'Mean (s)')
+    p95 = Column(verbose_name=u'p95 (s)')
+    max = Column(verbose_name=u'Max (s)')
 
-                return JSONResponse({}, status=200)
-            else:
-                return JSONResponse(test_serializer.errors, status=400)
-        except Exception as e:
-            log.error(u'exception when calling delete: {}'.format(unicode(e)))
+    class Meta:
+        order_by = u'-total'
+        attrs = {u'class': u'table table-striped table-hover'}
 
-        return JSONResponse({}, status=400)
+    def render_definition(self, value):
+        return value or u'(no step definition)'
 
-    def destroy(self, requset, pk=None):
-        """Delete the specified test."""
-        try:
-            log.debug(u'retrieving test {} to delete it'.format(pk))
-            test = Test.objects.get(pk=pk)
-
-            log.debug(u'deleting test {}'.format(pk))
-            test.delete()
-            log.debug(u'test {} deleted, returning success'.format(pk))
-
-            return JSONResponse({}, status=200)
-        except Exception as e:
-            log.error(u'exception when calling delete: {}'.format(unicode(e)))
-
-        return JSONResponse({}, status=400)
-
-    @action()
-    def start(self, request, pk=None):
-        """
-        creates a test run to be picked up by the engine.
-
-        also does extra stuff to allow specifying example rows through the run
-        api.
-
-        @param request: the http request
-        @type request: rest_framework.request.Request
-        @param pk: primary key to use to get data
-        @return: json response
-        """
-        log.info(u'starting test run with test {}'.format(pk))
-
-        # get the test
-        test = self.get_object_or_none()
-        if not test:
-            log.error(u'self.get_object() returned None, no test object to start a run with')
-            return JSONResponse({u'error': u'unknown test id: {}'.format(pk)}, status=400)
-
-        step_variables = get_step_variables(test.steps)
-
-        # pull the user out of the request data
-        user = request.DATA.get(u'user', None)
-        if user is None:
-            log.error(u'no user specified, returning error')
-            return JSONResponse({u'error': u'user not specified'}, status=400)
-
-        # this enables running example-less outlines through the api
-        example, error_msg = form_examples(request, step_variables)
-        if not example:
-            # set up blank text to create the test run with
-            example = u''
-
-        if error_msg:
-            log.error(error_msg)
-            return JSONResponse({u'error': error_msg}, status=400)
-
-        # ensure that if this run is an example-less outline, that we have
-        # example text
-        if step_variables and not example and not u'Examples:' in test.steps:
-            error_msg = u'a test run for a scenario outline was requested without ' \
-                        u'an example being provided in the request body or the step text'
-            log.error(error_msg)
-            return JSONResponse({u'error': error_msg}, status=400)
-
-        # create a test run for the engine package to pick up and run
-        # the status being "NEW" will trigger the engine to pick it up
-        log.debug(u'creating test run')
-
-        test_run = test.testrun_set.create(user=user, example_text=example)
-
-        log.debug(u'created test run')
-
-        serializer = TestRunSerializer(test_run)
-        return JSONResponse(serializer.data, status=200)
-
-
-class TestRunViewSet(viewsets.ModelViewSet):
-    serializer_class = TestRunSerializer
-
-    # if this isn't defined, then a call to the nested router will always
-    # return all the entries in the table
-    # http://www.django-rest-framework.org/api-guide/filtering.html#filtering-against-the-url
-    def get_queryset(self):
-        # in the auto url router, the key is labeled test_pk
-        # bdd/api/tests/123/runs, 123 -> test_pk
-        test_id = self.kwargs[u'test_pk']
-        # descend sort the runs, so we can get the latest run id
-        return TestRun.objects.filter(test=test_id).order_by(u'-id')
-
-
-class TestRunStepViewSet(viewsets.ModelViewSet):
-    serializer_class = TestRunStepSerializer
-
-    # turn off pagination for steps, if someone is getting step results they probably want them all
-    # http://www.django-rest-framework.org/api-guide/pagination
-    paginate_by = None
-
-    # if this isn't defined, then a call to the nested router will always
-    # return all the entries in the table
-    # http://www.django-rest-framework.org/api-guide/filtering.html#filtering-against-the-url
-    def get_queryset(self):
-        # in the auto url router, the key is labeled run_pk
-        # bdd/api/tests/1/runs/123/steps, 123 -> run_pk
-        run_id = self.kwargs[u'run_pk']
-        return TestRunStep.objects.filter(run=run_id).order_by(u'num')
-
-    def list(self, request, **kwargs):
-        """Returns a list of step results for a given test and run id."""
-        queryset = self.get_queryset()
-        serializer = TestRunStepSerializer(queryset, many=True)
-        return JSONResponse({u'steps': serializer.data}, status=200)
+    def render_failure_rate(self, value):
+        return u'{:.1%}'.format(value)
 
+    def render_seconds(self, value):
+        return u'{:.2f}'.format(value)
 
-class TestRunTable(Table):
-    view = TemplateColumn(u'<a href="{% url "bdd-test-run-detail" test_id=record.test_id test_run_id=record.id %}">View</a>', verbose_name=u'View')
-
-    class Meta:
-        model = TestRun
-        exclude = (u'test', u'example_text', u'text')
-        attrs = {u'class': u'table table-striped table-hover'}
+    render_total = render_mean = render_p95 = render_max = render_seconds
 
 
 class TestForm(forms.ModelForm):
@@ -514,8 +304,9 @@ class ScenarioOutlineExampleForm(forms.Form):
 
 def tests(request):
     """Print a list of tests."""
-    test_list = Test.objects.all()
-    tag_list = Tag.objects.all().order_by(u'name')
+    # the tags of every test on the page are fetched in one query
+    test_list = Test.objects.prefetch_related(u'tags')
+    tag_list = get_tag_cloud()
 
     # check if we need to filter the test list based on tags
     # defaults to empty list because we're always passing the list to the template
@@ -528,11 +319,8 @@ def tests(request):
         log.debug(u'displaying tests for search tags: {}'.format(tags))
 
         # order the list by name if search tags are specified
-        # this list contains tests if they have any of the tags passed in, so it's still 'unfiltered'
-        test_list = test_list.filter(tags__name__in=tags).distinct().order_by(u'name')
-
         # return only the tests that have every tag specified
-        test_list = filter_tags(test_list, tags)
+        test_list = filter_tags(test_list, tags).order_by(u'name')
     else:
         # order the list by newest -> oldest if there are no tags specified
         test_list = test_list.order_by(u'-id')
@@ -554,17 +342,19 @@ def tests(request):
 
 
 class ResultStep:
-    def __init__(self, text, status=u'new', duration=0.0, pair_id=u'', screenshot_url=u''):
+    def __init__(self, text, status=u'new', duration=0.0, pair_id=u'', screenshot_key=u'', screenshot_url=u''):
         self.text = text
         self.status = status
         self.duration = duration
         self.pair_id = pair_id
+        self.screenshot_key = screenshot_key
         self.screenshot_url = screenshot_url
         self.css_class = StepStatusClasses.get(status, u'')
 
 
 class ResultScreenshot:
-    def __init__(self, url, pair_id=''):
+    def __init__(self, key, url, pair_id=''):
+        self.key = key
         self.url = url
         self.pair_id = pair_id
 
@@ -584,32 +374,51 @@ def test_runs(request, test_id=None, test_run_id=None):
         log.debug(u'test id given: {}'.format(test_id))
         test = Test.objects.get(id=test_id)
         if test_run_id:
-            test_run = TestRun.objects.get(id=test_run_id)
+            test_run = partitions.prune_runs(TestRun.objects.all(), test_run_id).get(id=test_run_id)
         else:
             try:
                 test_run = test.testrun_set.latest(u'id')
             except TestRun.DoesNotExist:
                 log.error(u'could not find the latest run for test {}'.format(test_id))
                 messages.error(request, u'Unable to find latest run for test {}'.format(test_id))
-        test_runs = test.testrun_set.all()
+        test_runs = test.testrun_set.filter(parent__isnull=True)
     elif test_run_id:
         log.debug(u'test run id given {}'.format(test_run_id))
-        test_run = TestRun.objects.get(id=test_run_id)
+        test_run = partitions.prune_runs(TestRun.objects.all(), test_run_id).get(id=test_run_id)
         test = test_run.test
-        test_runs = test.testrun_set.all()
+        test_runs = test.testrun_set.filter(parent__isnull=True)
     else:
         # just use all runs if neither id is specified
-        test_runs = TestRun.objects.all()
+        # shards are left out, their parent run stands in for them
+        test_runs = TestRun.objects.filter(parent__isnull=True)
+
+    if test_run and test_run.parent_id:
+        # show the whole sharded run rather than a single shard of it
+        test_run = test_run.parent
+
+    # a finished run's page only changes when the run history of the test does
+    etag = last_modified = None
+    if test and test_run and is_cacheable(test_run):
+        history_etag, history_modified = get_run_history_validators(test.id)
+        etag, last_modified = get_run_validators(test_run, history_etag, request.get_full_path())
+        last_modified = max(filter(None, [last_modified, history_modified]))
+        if not_modified(request, etag, last_modified):
+            return HttpResponseNotModified()
 
     if test_run:
         log.debug(u'showing test_run with id {}'.format(test_run.id))
 
+        if test_run.shard_count and test_run.status == RUNNING:
+            # make sure the aggregate is current even if the shards were
+            # updated behind the orm's back
+            test_run.update_from_shards()
+
         # get the test run status class
         test_run_status = RunStatusClasses.get(test_run.status, u'')
 
         # get the steps from the db
         try:
-            test_steps = TestRunStep.objects.filter(run_id=test_run.id).order_by(u'example_row_num', u'num')
+            test_steps = get_run_steps(test_run, u'example_row_num', u'num')
         except TestRunStep.DoesNotExist:
             log.error(u'couldnt find test steps for run: {}'.format(test_run.id))
             messages.error(request, u'Unable to find test steps for test run {}'.format(test_run.id))
@@ -624,7 +433,8 @@ def test_runs(request, test_id=None, test_run_id=None):
             # id__lt is a shortcut for "id < x" (less than)
             # if the status is new or running and the id is less than the run_id being queried
             # it's before us in the queue
-            queue_position = len(TestRun.objects.filter(Q(status=NEW) | Q(status=RUNNING), id__lt=test_run.id))
+            # sharded parent runs aren't in the queue themselves, their shards are
+            queue_position = len(TestRun.objects.filter(Q(status=NEW) | Q(status=RUNNING), id__lt=test_run.id, shard_count=0))
 
             # say "your test is next in the queue" or "your test is 5th in the queue"
             if queue_position == 0:
@@ -634,6 +444,8 @@ def test_runs(request, test_id=None, test_run_id=None):
 
     # match steps with the test run
     if test_run and test_steps:
+        screenshot_storage = get_screenshot_storage()
+
         # index to find matches between steps and screens
         screen_idx = 1
         for step in test_steps:
@@ -644,9 +456,10 @@ def test_runs(request, test_id=None, test_run_id=None):
                 pair_id = screen_idx
                 screen_idx += 1
 
-                # we know the s3 key so just form a url out of it
-                screenshot_url = s3_util.make_s3_url(step.screenshot_s3_key, extension=u'.png')
-                screenshots.append(ResultScreenshot(screenshot_url, pair_id=pair_id))
+                # we know the key so just form a url out of it, the image itself
+                # only gets loaded when the user clicks through to it
+                screenshot_url = screenshot_storage.url(step.screenshot_s3_key)
+                screenshots.append(ResultScreenshot(step.screenshot_s3_key, screenshot_url, pair_id=pair_id))
 
             if not step.example_row_num in step_sets:
                 # create a new list to hold the steps in if it doesn't exist already
@@ -659,9 +472,23 @@ def test_runs(request, test_id=None, test_run_id=None):
                 status=step.status,
                 duration=step.duration,
                 pair_id=pair_id,
+                screenshot_key=step.screenshot_s3_key,
                 screenshot_url=screenshot_url
             ))
 
+    # the run before this one, to compare this run with
+    previous_run_id = None
+    if test_run:
+        previous_run_id = TestRun.objects.filter(test=test_run.test_id, parent__isnull=True, id__lt=test_run.id)\
+            .order_by(u'-id').values_list(u'id', flat=True).first()
+
+    # the ids of the runs whose events the result page listens to
+    event_run_ids = []
+    if test_run:
+        event_run_ids = [test_run.id]
+        if test_run.shard_count:
+            event_run_ids.extend(test_run.shards.values_list(u'id', flat=True))
+
     if test_run and test_run.text:
         # break apart the failure text, if it exists, make it readable
         test_run.text = test_run.text.split(u'\n')
@@ -672,7 +499,7 @@ def test_runs(request, test_id=None, test_run_id=None):
     table = TestRunTable(test_runs)
     table.order_by = u'-id'
 
-    return render(request, u'django_bdd/bddresult.html', {
+    response = render(request, u'django_bdd/bddresult.html', {
         u'title': u'Test Runs',
         u'table': table,
         u'test': test,
@@ -680,10 +507,47 @@ def test_runs(request, test_id=None, test_run_id=None):
         u'test_run_status': test_run_status,
         u'screenshots': screenshots,
         u'step_sets': step_sets,
-        u'queue_position': queue_position
+        u'queue_position': queue_position,
+        u'previous_run_id': previous_run_id,
+        u'event_run_ids': event_run_ids,
+        u'push_events': events.is_cross_process()
+    })
+
+    if etag:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def compare_test_runs(request, base_run_id, other_run_id):
+    log.info(u'compare test runs')
+
+    base, other = get_compared_runs(base_run_id, other_run_id)
+    comparison = add_screenshot_urls(compare_runs(base, other))
+    for step in comparison[u'steps']:
+        step[u'sides'] = [step[u'base'], step[u'other']]
+        for side in step[u'sides']:
+            if side is not None:
+                side[u'css_class'] = StepStatusClasses.get(side[u'status'], u'')
+
+    return render(request, u'django_bdd/bddcompare.html', {
+        u'title': u'Compare Runs',
+        u'base': base,
+        u'other': other,
+        u'base_status': RunStatusClasses.get(base.status, u''),
+        u'other_status': RunStatusClasses.get(other.status, u''),
+        u'comparison': comparison,
     })
 
 
+def step_stats(request):
+    log.info(u'step stats')
+
+    table = StepStatsTable(steps.get_step_report())
+    RequestConfig(request, paginate=False).configure(table)
+
+    return render(request, u'django_bdd/table.html', {u'title': u'Step Definitions', u'table': table})
+
+
 def test_queue(request):
     log.info('test_queue')
 
@@ -691,7 +555,8 @@ def test_queue(request):
     current_user = get_user(request)
 
     # filter the test runs by new/running statuses
-    test_runs = TestRun.objects.filter(Q(status=NEW) | Q(status=RUNNING))
+    # sharded parent runs aren't in the queue themselves, their shards are
+    test_runs = TestRun.objects.filter(Q(status=NEW) | Q(status=RUNNING), shard_count=0).select_related(u'test')
 
     # create the text that summarizes how many tests there are in the queue
     if not test_runs:
@@ -704,10 +569,108 @@ def test_queue(request):
     return render(request, u'django_bdd/bddqueue.html', {
         u'summary_text': summary_text,
         u'test_runs': test_runs,
-        u'current_user': current_user
+        u'current_user': current_user,
+        u'push_events': events.is_cross_process()
+    })
+
+
+@require_POST
+def cancel_test_runs(request):
+    """Cancels the runs selected by the posted form, like the cancel api,
+    and goes back to the page given as next.
+    """
+    log.info(u'cancel test runs')
+
+    try:
+        cancelled = cancel_runs(get_cancelled_runs(request.POST), get_user(request))
+    except ValueError as e:
+        messages.error(request, unicode(e))
+    else:
+        # the runs were cancelled by this request, don't show them from the replica
+        routers.pin_to_primary()
+        if cancelled:
+            messages.info(request, u'Cancelled {} test run{}.'.format(len(cancelled), u'' if len(cancelled) == 1 else u's'))
+        else:
+            messages.info(request, u'There were no queued or running test runs to cancel.')
+
+    next_url = request.POST.get(u'next')
+    if not next_url or not is_safe_url(next_url, host=request.get_host()):
+        return redirect(u'bdd-test-queue')
+    return redirect(next_url)
+
+
+def suite_runs(request):
+    log.info(u'suite runs')
+
+    table = SuiteRunTable(SuiteRun.objects.all(), order_by=u'-id')
+    RequestConfig(request, paginate={u'per_page': 50}).configure(table)
+
+    return render(request, u'django_bdd/table.html', {u'title': u'Suites', u'table': table})
+
+
+def suite_run(request, suite_id):
+    log.info(u'suite run')
+
+    # the suite's progress is its own row, the runs are only listed below it
+    suite = get_object_or_404(SuiteRun, id=suite_id)
+    table = TestRunTable(suite.runs.select_related(u'test'), order_by=u'id')
+    RequestConfig(request, paginate={u'per_page': 100}).configure(table)
+
+    return render(request, u'django_bdd/bddsuite.html', {
+        u'title': suite.name or u'Suite {}'.format(suite.id),
+        u'suite': suite,
+        u'status_class': RunStatusClasses.get(suite.status, u''),
+        u'table': table,
     })
 
 
+@require_POST
+def start_suite_run(request):
+    """Starts a suite of the tests with the posted tags, like the suites
+    api, and shows it.
+    """
+    log.info(u'start suite run')
+
+    try:
+        suite, skipped = start_suite(get_user(request), tags=get_list(request.POST, u'tagged', u'+'),
+                                     name=request.POST.get(u'name', u'').strip(), notify=is_true(request.POST.get(u'notify', False)))
+    except ValueError as e:
+        messages.error(request, unicode(e))
+        return redirect(u'bdd-test-list')
+
+    # the suite was created by this request, don't show it from the replica
+    routers.pin_to_primary()
+    for test in skipped:
+        messages.warning(request, u'Left out "{}": {}'.format(test[u'name'], test[u'reason']))
+    return redirect(u'bdd-suite-run', suite_id=suite.id)
+
+
+def screenshot(request, key):
+    """Serves a full size screenshot or thumbnail when screenshots are kept
+    in LocalScreenshotStorage. With s3 storage the urls point at s3 instead.
+    """
+    storage = get_screenshot_storage()
+    if not isinstance(storage, LocalScreenshotStorage):
+        raise Http404
+
+    # serve() makes sure the path doesn't escape the screenshot root
+    return serve(request, key + SCREENSHOT_EXTENSION, document_root=storage.root)
+
+
+def screenshot_thumbnail(request, key):
+    """Redirects to the thumbnail of a screenshot, creating it the first time
+    it's asked for. The result page's screenshot strip loads these instead of
+    the full size images.
+    """
+    storage = get_screenshot_storage()
+    try:
+        url = storage.thumbnail_url(key)
+    except (IOError, ValueError) as e:
+        log.error(u'unable to create thumbnail for screenshot {}: {}'.format(key, unicode(e)))
+        raise Http404
+    return redirect(url)
+
+
 def edit_test(request, test_id=None):
     log.info('edit test')
 
@@ -727,9 +690,15 @@ def edit_test(request, test_id=None):
     if request.method == u'POST':
         log.debug(u'{} is saving test {}'.format(user, test))
         form = TestForm(request.POST, instance=test)
-        if form.is_valid():
+        undefined = steps.validate_steps(form.cleaned_data[u'steps']) if form.is_valid() else []
+        if steps.is_rejected(undefined):
+            # shown inline with the steps, the test isn't saved
+            form._errors[u'steps'] = form.error_class(steps.describe_undefined_steps(undefined))
+        elif form.is_valid():
             log.debug(u'saving form')
             form.save()
+            for message in steps.describe_undefined_steps(undefined):
+                messages.warning(request, message)
 
             log.debug(u'querying test edit history')
             version = test.testedithistory_set.count() + 1
@@ -743,11 +712,10 @@ def edit_test(request, test_id=None):
         log.debug(u'{} is viewing test {}'.format(user, test))
         form = TestForm(instance=test)
 
-    # our own steps are already loaded into behave
-    steps = runner.get_available_steps()
-    steps.sort()
+    # our own steps are already loaded into behave, the catalog is built once per process
+    step_definitions = sorted(steps.get_step_catalog().definitions)
 
-    return render(request, u'django_bdd/bddform.html', {u'title': title, u'form': form, u'steps': steps})
+    return render(request, u'django_bdd/bddform.html', {u'title': title, u'form': form, u'steps': step_definitions})
 
 
 def delete_test(request, test_id=None):
@@ -757,10 +725,14 @@ def delete_test(request, test_id=None):
     url = request.build_absolute_uri(reverse(u'test-detail', args=(test_id,)))
 
     # use requests to post to the url
+    import requests
     response = requests.delete(url)
 
     # check the result
-    if not response.ok:
+    if response.ok:
+        # the test was deleted by another request, don't show it from the replica
+        routers.pin_to_primary()
+    else:
         # failed to delete the test
         log.error(u'unable to delete test {}'.format(test_id))
         pass
@@ -779,16 +751,27 @@ def run_test(request, test_id=None):
     url = request.build_absolute_uri(reverse(u'test-start', args=(test_id,)))
 
     # build the request data
-    data = {u'user': user}
+    data = {u'user': user, u'force': is_true(request.GET.get(u'force', False))}
 
     log.debug(u'posting to url {} with data {}'.format(url, data))
 
     # use requests to post to the url
+    import requests
     response = requests.post(url, data=data)
 
     # check the result
     if response.ok:
+        # the run was created by another request, read it back from the primary
+        routers.pin_to_primary()
         test_run_id = response.json().get(u'id', None)
+        if response.json().get(u'coalesced', False):
+            messages.info(request, u'An identical run of this test was already queued, showing that run instead.')
+        for message in steps.describe_undefined_steps(response.json().get(u'undefined_steps', [])):
+            messages.warning(request, message)
+    elif response.status_code == 400 and u'undefined_steps' in response.json():
+        log.error(u'test {} has undefined steps'.format(test_id))
+        for message in steps.describe_undefined_steps(response.json()[u'undefined_steps']):
+            messages.error(request, message)
     else:
         # failed to create a test run
         log.error(u'unable to run test {}'.format(test_id))
@@ -836,12 +819,23 @@ def run_scenario_outline_form_test(request, test_id=None):
         example_text = u'|' + u'|'.join(fields.keys()) + u'|' + u'\n'
         example_text += u'|' + u'|'.join(fields.values()) + u'|'
 
-        if test:
+        undefined = steps.validate_steps(test.steps, example_text) if test else []
+        if steps.is_rejected(undefined):
+            for message in steps.describe_undefined_steps(undefined):
+                messages.error(request, message)
+        elif test:
+            for message in steps.describe_undefined_steps(undefined):
+                messages.warning(request, message)
+
             # create a test run for the engine package to pick up and run
             # the status being "NEW" will trigger the engine to pick it up
+            # an identical run that's still queued gets reused unless forced
             log.debug(u'creating test run')
-            test_run = test.testrun_set.create(user=get_user(request), example_text=example_text)
+            force = is_true(request.POST.get(u'force', False))
+            test_run, coalesced = create_run(test, get_user(request), example_text=example_text, force=force)
             test_run_id = test_run.id
+            if coalesced:
+                messages.info(request, u'An identical run of this test was already queued, showing that run instead.')
             log.debug(u'created test run')
         else:
             log.error(u'no test id passed to run_scenario_outline_form_test')